@@ -1,11 +1,16 @@
 import json
 import logging
 import base64
-from typing import List, Optional
-from sqlalchemy.orm import Session
+import hashlib
+import secrets
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import case, exists, func, insert, select, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, joinedload
 from datetime import datetime
 
-from app.db.models import SmitheryCookie, APICallLog
+from app.db.models import SmitheryCookie, APICallLog, APIKey, APIKeyUsage, CallLogCounter
 
 logger = logging.getLogger(__name__)
 
@@ -87,7 +92,7 @@ def update_cookie(db: Session, cookie_id: int, name: Optional[str] = None, cooki
     return db_cookie
 
 def delete_cookie(db: Session, cookie_id: int) -> bool:
-    """删除 Cookie"""
+    """删除 Cookie，保留其调用日志（累计统计仍然计入这些调用）"""
     db_cookie = get_cookie_by_id(db, cookie_id)
     if not db_cookie:
         return False
@@ -130,6 +135,100 @@ def increment_cookie_usage(db: Session, cookie_id: int) -> None:
         db_cookie.last_used_at = datetime.utcnow()
         db.commit()
 
+def hash_api_key(key: str) -> str:
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def get_all_api_keys(db: Session) -> List[APIKey]:
+    """获取所有客户端 API Key"""
+    return db.query(APIKey).order_by(APIKey.created_at.desc()).all()
+
+def get_api_key_by_id(db: Session, key_id: int) -> Optional[APIKey]:
+    return db.query(APIKey).filter(APIKey.id == key_id).first()
+
+def get_api_key_by_hash(db: Session, key_hash: str) -> Optional[APIKey]:
+    return db.query(APIKey).filter(APIKey.key_hash == key_hash).first()
+
+def _apply_api_key_limits(db_key: APIKey, limits: Dict[str, Any]) -> None:
+    for field in ("rate_limit", "burst", "max_concurrency"):
+        if field in limits:
+            value = limits[field]
+            if value is not None and value <= 0:
+                raise ValueError(f"{field} 必须大于 0（不限制时留空）")
+            setattr(db_key, field, value)
+    if "allowed_models" in limits:
+        models = limits["allowed_models"]
+        db_key.allowed_models = json.dumps(models, ensure_ascii=False) if models else None
+
+def create_api_key(db: Session, name: str, **limits) -> Tuple[APIKey, str]:
+    """
+    创建客户端 API Key，返回 (记录, 明文密钥)。明文只在创建时返回一次，数据库只保存 SHA-256。
+    limits: rate_limit、burst、max_concurrency、allowed_models
+    """
+    if db.query(APIKey).filter(APIKey.name == name).first():
+        raise ValueError(f"名称 '{name}' 已被使用")
+    key = "sk-" + secrets.token_urlsafe(32)
+    db_key = APIKey(name=name, key_hash=hash_api_key(key), key_prefix=key[:10])
+    _apply_api_key_limits(db_key, limits)
+    db.add(db_key)
+    db.commit()
+    db.refresh(db_key)
+    logger.info(f"创建 API Key: {name} (ID: {db_key.id})")
+    return db_key, key
+
+def update_api_key(db: Session, key_id: int, name: Optional[str] = None, **limits) -> Optional[APIKey]:
+    """更新 API Key 的名称和限制，limits 中给出的字段（包括 None，表示不限制）才会修改"""
+    db_key = get_api_key_by_id(db, key_id)
+    if not db_key:
+        return None
+    if name is not None:
+        existing = db.query(APIKey).filter(APIKey.name == name).first()
+        if existing and existing.id != key_id:
+            raise ValueError(f"名称 '{name}' 已被使用")
+        db_key.name = name
+    _apply_api_key_limits(db_key, limits)
+    db_key.updated_at = datetime.utcnow()
+    db.commit()
+    db.refresh(db_key)
+    logger.info(f"更新 API Key: {db_key.name} (ID: {key_id})")
+    return db_key
+
+def toggle_api_key_status(db: Session, key_id: int) -> Optional[APIKey]:
+    """切换 API Key 启用/禁用状态"""
+    db_key = get_api_key_by_id(db, key_id)
+    if not db_key:
+        return None
+    db_key.is_active = not db_key.is_active
+    db_key.updated_at = datetime.utcnow()
+    db.commit()
+    db.refresh(db_key)
+    return db_key
+
+def delete_api_key(db: Session, key_id: int) -> bool:
+    """删除 API Key，保留其调用日志（api_key_id 置空）"""
+    db_key = get_api_key_by_id(db, key_id)
+    if not db_key:
+        return False
+    db.query(APICallLog).filter(APICallLog.api_key_id == key_id).update(
+        {APICallLog.api_key_id: None}, synchronize_session=False
+    )
+    db.query(APIKeyUsage).filter(APIKeyUsage.api_key_id == key_id).delete(synchronize_session=False)
+    db.delete(db_key)
+    db.commit()
+    logger.info(f"删除 API Key: {db_key.name} (ID: {key_id})")
+    return True
+
+def get_api_key_usage(db: Session) -> Dict[int, Dict[str, int]]:
+    """各 API Key 的累计用量（包括已归档的日志），只读取计数表：api_key_id -> 调用次数、失败次数和 token 数"""
+    return {
+        row.api_key_id: {
+            "calls": row.calls,
+            "error_calls": row.error_calls,
+            "prompt_tokens": row.prompt_tokens,
+            "completion_tokens": row.completion_tokens
+        }
+        for row in db.query(APIKeyUsage).all()
+    }
+
 def create_call_log(
     db: Session,
     cookie_id: int,
@@ -151,26 +250,163 @@ def create_call_log(
         duration_ms=duration_ms
     )
     db.add(log)
+    _increment_call_counters(db, {status: 1})
     db.commit()
     db.refresh(log)
     return log
 
-def get_call_logs(db: Session, limit: int = 100, cookie_id: Optional[int] = None) -> List[APICallLog]:
-    """获取调用日志"""
-    query = db.query(APICallLog).order_by(APICallLog.created_at.desc())
+def _increment_call_counters(db: Session, calls: Dict[str, int]) -> None:
+    """累加按状态的调用次数（随日志在同一事务中提交）"""
+    stmt = sqlite_insert(CallLogCounter).values([{"status": status, "calls": count} for status, count in calls.items()])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[CallLogCounter.status],
+        set_={"calls": CallLogCounter.calls + stmt.excluded.calls}
+    ))
+
+def _increment_api_key_usage(db: Session, logs: List[Dict[str, Any]]) -> None:
+    """按 API Key 累加调用次数和 token 数（随日志在同一事务中提交）"""
+    usage: Dict[int, List[int]] = {}
+    for log in logs:
+        key_id = log.get("api_key_id")
+        if key_id is None:
+            continue
+        row = usage.setdefault(key_id, [0, 0, 0, 0])
+        row[0] += 1
+        # 与 get_call_stats 一致：客户端断开（cancelled）不算失败
+        row[1] += log.get("status") == "error"
+        row[2] += log.get("prompt_tokens") or 0
+        row[3] += log.get("completion_tokens") or 0
+    if not usage:
+        return
+    stmt = sqlite_insert(APIKeyUsage).values([
+        {"api_key_id": key_id, "calls": calls, "error_calls": errors, "prompt_tokens": prompt, "completion_tokens": completion}
+        for key_id, (calls, errors, prompt, completion) in usage.items()
+    ])
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[APIKeyUsage.api_key_id],
+        set_={
+            "calls": APIKeyUsage.calls + stmt.excluded.calls,
+            "error_calls": APIKeyUsage.error_calls + stmt.excluded.error_calls,
+            "prompt_tokens": APIKeyUsage.prompt_tokens + stmt.excluded.prompt_tokens,
+            "completion_tokens": APIKeyUsage.completion_tokens + stmt.excluded.completion_tokens,
+        }
+    ))
+
+def write_call_log_batch(
+    db: Session,
+    logs: List[Dict[str, Any]],
+    usage: Dict[int, Tuple[int, datetime]]
+) -> None:
+    """
+    批量写入调用日志并累加 Cookie 使用计数、按状态的调用次数和各 API Key 的用量，整批只提交一次。
+    usage: cookie_id -> (本批调用次数, 最后使用时间)
+    """
+    if logs:
+        db.execute(insert(APICallLog), logs)
+        _increment_call_counters(db, Counter(log.get("status") or "success" for log in logs))
+        _increment_api_key_usage(db, logs)
+    for cookie_id, (count, last_used_at) in usage.items():
+        db.query(SmitheryCookie).filter(SmitheryCookie.id == cookie_id).update(
+            {
+                SmitheryCookie.usage_count: SmitheryCookie.usage_count + count,
+                SmitheryCookie.last_used_at: last_used_at
+            },
+            synchronize_session=False
+        )
+    db.commit()
+
+def get_call_logs(
+    db: Session,
+    limit: int = 100,
+    cookie_id: Optional[int] = None,
+    api_key_id: Optional[int] = None,
+    model: Optional[str] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    before: Optional[Tuple[datetime, int]] = None
+) -> List[APICallLog]:
+    """
+    按 (created_at, id) 倒序获取调用日志。before 为上一页最后一条的 (created_at, id)，
+    从它之后继续读取（键集分页，每页的代价与翻到第几页无关）；since/until 为创建时间的 [since, until) 区间。
+    Cookie 和 API Key 的名称随日志一起联表加载，不会逐条查询
+    """
+    query = db.query(APICallLog).options(
+        joinedload(APICallLog.cookie).load_only(SmitheryCookie.name),
+        joinedload(APICallLog.api_key).load_only(APIKey.name)
+    )
     if cookie_id:
         query = query.filter(APICallLog.cookie_id == cookie_id)
-    return query.limit(limit).all()
+    if api_key_id:
+        query = query.filter(APICallLog.api_key_id == api_key_id)
+    if model:
+        query = query.filter(APICallLog.model == model)
+    if status:
+        query = query.filter(APICallLog.status == status)
+    if since:
+        query = query.filter(APICallLog.created_at >= since)
+    if until and (before is None or until <= before[0]):
+        query = query.filter(APICallLog.created_at < until)
+    if before:
+        # 除行值比较外再给出 created_at 的上界（代替已不起作用的 until），SQLite 才会从游标位置开始读取索引
+        query = query.filter(APICallLog.created_at <= before[0], tuple_(APICallLog.created_at, APICallLog.id) < before)
+    return query.order_by(APICallLog.created_at.desc(), APICallLog.id.desc()).limit(limit).all()
+
+def get_call_logs_before(db: Session, cutoff: datetime, limit: int) -> List[APICallLog]:
+    """最早的一批创建时间早于 cutoff 的调用日志（用于归档）"""
+    return (
+        db.query(APICallLog)
+        .filter(APICallLog.created_at < cutoff)
+        .order_by(APICallLog.created_at, APICallLog.id)
+        .limit(limit)
+        .all()
+    )
+
+def delete_call_logs(db: Session, log_ids: List[int]) -> int:
+    """删除指定的调用日志（已归档），不影响累计统计"""
+    deleted = db.query(APICallLog).filter(APICallLog.id.in_(log_ids)).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+def init_call_log_counters(db: Session) -> None:
+    """
+    按状态的计数表和 API Key 用量表为空时（新建或刚升级的数据库）按现有日志初始化，
+    多个 worker 同时启动时只有一个生效
+    """
+    status = func.coalesce(APICallLog.status, "success")
+    db.execute(insert(CallLogCounter).from_select(
+        ["status", "calls"],
+        select(status, func.count())
+        .where(~exists().where(CallLogCounter.status.isnot(None)))
+        .group_by(status)
+    ))
+    db.execute(insert(APIKeyUsage).from_select(
+        ["api_key_id", "calls", "error_calls", "prompt_tokens", "completion_tokens"],
+        select(
+            APICallLog.api_key_id,
+            func.count(),
+            func.sum(case((status == "error", 1), else_=0)),
+            func.coalesce(func.sum(APICallLog.prompt_tokens), 0),
+            func.coalesce(func.sum(APICallLog.completion_tokens), 0)
+        )
+        .where(APICallLog.api_key_id.isnot(None), ~exists().where(APIKeyUsage.api_key_id.isnot(None)))
+        .group_by(APICallLog.api_key_id)
+    ))
+    db.commit()
 
 def get_call_stats(db: Session) -> dict:
-    """获取调用统计"""
-    total_calls = db.query(APICallLog).count()
-    success_calls = db.query(APICallLog).filter(APICallLog.status == "success").count()
-    error_calls = total_calls - success_calls
+    """获取调用统计（累计值，包括已归档的日志），只读取计数表"""
+    calls = dict(db.query(CallLogCounter.status, CallLogCounter.calls).all())
+    total_calls = sum(calls.values())
+    success_calls = calls.get("success", 0)
+    # 客户端中途断开的调用单独统计，不算作失败
+    cancelled_calls = calls.get("cancelled", 0)
+    error_calls = total_calls - success_calls - cancelled_calls
     
     return {
         "total_calls": total_calls,
         "success_calls": success_calls,
-        "error_calls": error_calls
+        "error_calls": error_calls,
+        "cancelled_calls": cancelled_calls
     }
 
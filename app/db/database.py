@@ -1,20 +1,53 @@
 import os
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 
-# 数据库文件路径
+from app.core.config import settings
+from app.services.metrics import db_seconds, statement_label
+
+# 数据库文件路径（可通过 DATABASE_URL 覆盖，例如基准测试使用临时数据库）
 DATABASE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "data")
 os.makedirs(DATABASE_DIR, exist_ok=True)
-DATABASE_URL = f"sqlite:///{os.path.join(DATABASE_DIR, 'smithery.db')}"
+DATABASE_URL = settings.DATABASE_URL or f"sqlite:///{os.path.join(DATABASE_DIR, 'smithery.db')}"
 
 # 创建数据库引擎
 engine = create_engine(
     DATABASE_URL, 
-    connect_args={"check_same_thread": False},  # SQLite 特定配置
+    connect_args={
+        "check_same_thread": False,  # SQLite 特定配置
+        "timeout": settings.DB_BUSY_TIMEOUT_MS / 1000
+    },
+    # WAL 模式下读写互不阻塞，使用连接池让管理端查询和日志写入并发进行
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_POOL_SIZE,
     echo=False  # 设置为 True 可以看到 SQL 语句
 )
 
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    每个新连接启用 WAL、NORMAL 同步级别和忙等待超时。
+    auto_vacuum 只对还没有建表的新数据库生效（已有数据库需运行 migrate_db.py 转换），之后删除日志空出的页可以增量归还
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={settings.DB_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+@event.listens_for(engine, "before_cursor_execute")
+def _start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+@event.listens_for(engine, "after_cursor_execute")
+def _record_statement_latency(conn, cursor, statement, parameters, context, executemany):
+    """每条语句的耗时计入 smithery_db_seconds（执行出错的语句不计入）"""
+    db_seconds.observe(time.perf_counter() - context._metrics_start, statement_label(statement))
+
 # 创建 SessionLocal 类
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -29,8 +62,54 @@ def get_db() -> Session:
     finally:
         db.close()
 
+# 旧版本建立、已被组合索引取代（或与主键重复）的调用日志索引，启动时删除，与新建的数据库保持一致
+_SUPERSEDED_INDEXES = (
+    "idx_call_logs_cookie_id", "idx_call_logs_model", "idx_call_logs_api_key_id", "idx_call_logs_created_at",
+    "ix_api_call_logs_cookie_id", "ix_api_call_logs_model", "ix_api_call_logs_api_key_id", "ix_api_call_logs_id",
+)
+
+def _add_missing_columns():
+    """create_all 不会修改已有的表：为旧数据库补上后来新增的可空列"""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                    ))
+            except OperationalError:
+                # 其他 worker 已经添加了该列
+                pass
+        # 新增列上的索引
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except OperationalError:
+                pass
+    with engine.begin() as conn:
+        for name in _SUPERSEDED_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
 def init_db():
     """初始化数据库，创建所有表"""
     from app.db.models import SmitheryCookie  # 导入模型以注册到 Base
-    Base.metadata.create_all(bind=engine)
+    try:
+        Base.metadata.create_all(bind=engine)
+    except OperationalError:
+        # 多个 worker 同时首次启动时，其他 worker 可能刚刚建好表，再检查一次即可
+        Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
+
+    from app.db import crud
+    db = SessionLocal()
+    try:
+        crud.init_call_log_counters(db)
+    finally:
+        db.close()
 
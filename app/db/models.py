@@ -1,11 +1,13 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, ForeignKey, Float, Index
 from sqlalchemy.orm import relationship
 from app.db.database import Base
 
 class SmitheryCookie(Base):
     """Smithery Cookie 数据模型"""
     __tablename__ = "smithery_cookies"
+    # 删除 Cookie 后保留其调用日志，ID 不能被新 Cookie 复用
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     name = Column(String(100), unique=True, nullable=False, index=True)
@@ -16,30 +18,92 @@ class SmitheryCookie(Base):
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
     
-    # 关联调用日志
-    call_logs = relationship("APICallLog", back_populates="cookie", cascade="all, delete-orphan")
+    # 关联调用日志；删除 Cookie 时保留其日志（cookie_id 保持原值），与 CallLogCounter 的累计统计一致
+    call_logs = relationship("APICallLog", back_populates="cookie", passive_deletes="all")
 
     def __repr__(self):
         return f"<SmitheryCookie(id={self.id}, name='{self.name}', usage_count={self.usage_count})>"
 
 
+class APIKey(Base):
+    """客户端 API Key：只能调用 /v1 接口，不能登录管理界面；数据库只保存哈希"""
+    __tablename__ = "api_keys"
+
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    name = Column(String(100), unique=True, nullable=False, index=True)
+    key_hash = Column(String(64), unique=True, nullable=False, index=True)  # SHA-256 十六进制
+    key_prefix = Column(String(16), nullable=False)  # 明文前几位，用于在管理界面辨认
+    is_active = Column(Boolean, default=True, nullable=False)
+    rate_limit = Column(Float, nullable=True)  # 每秒请求数，空表示不限制
+    burst = Column(Integer, nullable=True)  # 令牌桶容量，空表示等于 rate_limit（至少 1）
+    max_concurrency = Column(Integer, nullable=True)  # 同时进行的请求数上限，空表示不限制
+    allowed_models = Column(Text, nullable=True)  # 允许的模型 JSON 列表，空表示全部
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<APIKey(id={self.id}, name='{self.name}', prefix='{self.key_prefix}')>"
+
+
 class APICallLog(Base):
     """API 调用日志"""
     __tablename__ = "api_call_logs"
+    # 日志按 (created_at, id) 倒序分页：每个筛选条件一个 (筛选列, created_at) 索引，SQLite 的索引隐含 id（rowid），
+    # 带筛选的分页也能按索引顺序读取，不需要排序
+    __table_args__ = (
+        Index("ix_api_call_logs_cookie_id_created_at", "cookie_id", "created_at"),
+        Index("ix_api_call_logs_api_key_id_created_at", "api_key_id", "created_at"),
+        Index("ix_api_call_logs_model_created_at", "model", "created_at"),
+        Index("ix_api_call_logs_status_created_at", "status", "created_at"),
+    )
     
-    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    cookie_id = Column(Integer, ForeignKey("smithery_cookies.id"), nullable=False, index=True)
-    model = Column(String(50), nullable=False, index=True)  # 使用的模型
+    id = Column(Integer, primary_key=True, autoincrement=True)  # rowid，不需要单独的索引
+    cookie_id = Column(Integer, ForeignKey("smithery_cookies.id"), nullable=False)
+    api_key_id = Column(Integer, ForeignKey("api_keys.id"), nullable=True)  # 使用主密钥时为空
+    model = Column(String(50), nullable=False)  # 使用的模型
     prompt_tokens = Column(Integer, default=0)  # 提示词 token 数
     completion_tokens = Column(Integer, default=0)  # 完成 token 数
-    status = Column(String(20), default="success")  # success, error
+    status = Column(String(20), default="success")  # success, error, cancelled（客户端中途断开）
     error_message = Column(Text, nullable=True)  # 错误信息
     duration_ms = Column(Integer, nullable=True)  # 请求耗时（毫秒）
+    timings = Column(Text, nullable=True)  # 各阶段耗时（毫秒）的 JSON，例如 {"cookie": 0.1, "upstream_wait": 412.3}
+    # 单飞跟随者的调用：没有单独请求上游，Cookie 和 token 数与领导者相同，不计入 Cookie 的使用次数
+    coalesced = Column(Boolean, nullable=True)
+    # 单独的 created_at 索引供不带筛选的分页和归档按时间范围读取使用
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
     
     # 关联 Cookie
     cookie = relationship("SmitheryCookie", back_populates="call_logs")
+    api_key = relationship("APIKey")
     
     def __repr__(self):
         return f"<APICallLog(id={self.id}, model='{self.model}', status='{self.status}')>"
 
+
+class CallLogCounter(Base):
+    """
+    按状态累计的调用次数，由日志写入器随每批日志更新，统计不必扫描日志表。
+    含义是所有记录过的调用：日志被归档后仍然计入；删除 Cookie 或 API Key 时不删除其日志，计数也不扣减
+    """
+    __tablename__ = "call_log_counters"
+
+    status = Column(String(20), primary_key=True)
+    calls = Column(Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"<CallLogCounter(status='{self.status}', calls={self.calls})>"
+
+
+class APIKeyUsage(Base):
+    """按客户端 API Key 累计的调用次数和 token 数（包括已归档的日志），由日志写入器随每批日志更新，列出 API Key 时不必扫描日志表"""
+    __tablename__ = "api_key_usage"
+
+    api_key_id = Column(Integer, ForeignKey("api_keys.id"), primary_key=True)
+    calls = Column(Integer, default=0, nullable=False)
+    error_calls = Column(Integer, default=0, nullable=False)  # 状态不是 success 的调用
+    prompt_tokens = Column(Integer, default=0, nullable=False)
+    completion_tokens = Column(Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return f"<APIKeyUsage(api_key_id={self.api_key_id}, calls={self.calls})>"
+
@@ -1,36 +1,36 @@
+import time
 import uuid
 import logging
-from datetime import datetime, timedelta
-from typing import Optional, Dict
+from typing import Optional
 from fastapi import Header, HTTPException, Depends
 
-logger = logging.getLogger(__name__)
+from app.services.shared_state import shared_state
 
-# 简单的内存会话存储（生产环境建议使用 Redis）
-_sessions: Dict[str, dict] = {}
+logger = logging.getLogger(__name__)
 
 # Session 过期时间（小时）
 SESSION_EXPIRE_HOURS = 24
+# 过期会话的清理间隔（秒）；验证时会单独检查过期时间，清理只是回收空间
+SESSION_CLEANUP_INTERVAL = 60
+
+_next_cleanup = 0.0
 
 def create_session() -> str:
-    """创建新的会话 token"""
+    """创建新的会话 token（保存在共享状态中，所有 worker 都能验证）"""
     token = str(uuid.uuid4())
-    _sessions[token] = {
-        "created_at": datetime.utcnow(),
-        "expires_at": datetime.utcnow() + timedelta(hours=SESSION_EXPIRE_HOURS)
-    }
+    shared_state.put_session(token, time.time() + SESSION_EXPIRE_HOURS * 3600)
     logger.info(f"创建新会话: {token[:8]}...")
     return token
 
 def validate_session(token: str) -> bool:
     """验证会话 token 是否有效"""
-    if token not in _sessions:
+    expires_at = shared_state.session_expires_at(token)
+    if expires_at is None:
         return False
     
-    session = _sessions[token]
-    if datetime.utcnow() > session["expires_at"]:
+    if time.time() > expires_at:
         # 会话已过期，删除
-        del _sessions[token]
+        shared_state.delete_session(token)
         logger.info(f"会话已过期: {token[:8]}...")
         return False
     
@@ -38,23 +38,24 @@ def validate_session(token: str) -> bool:
 
 def invalidate_session(token: str) -> bool:
     """注销会话"""
-    if token in _sessions:
-        del _sessions[token]
+    if shared_state.delete_session(token):
         logger.info(f"注销会话: {token[:8]}...")
         return True
     return False
 
 def cleanup_expired_sessions():
-    """清理过期的会话"""
-    now = datetime.utcnow()
-    expired = [token for token, session in _sessions.items() if now > session["expires_at"]]
-    for token in expired:
-        del _sessions[token]
+    """清理过期的会话，每个清理间隔最多执行一次"""
+    global _next_cleanup
+    now = time.time()
+    if now < _next_cleanup:
+        return
+    _next_cleanup = now + SESSION_CLEANUP_INTERVAL
+    expired = shared_state.purge_sessions(now)
     if expired:
-        logger.info(f"清理了 {len(expired)} 个过期会话")
+        logger.info(f"清理了 {expired} 个过期会话")
 
-async def verify_admin_session(authorization: Optional[str] = Header(None)) -> str:
-    """验证管理员会话的依赖项"""
+def verify_admin_session(authorization: Optional[str] = Header(None)) -> str:
+    """验证管理员会话的依赖项（同步函数，FastAPI 在线程池中执行，访问共享状态不阻塞事件循环）"""
     if not authorization:
         raise HTTPException(status_code=401, detail="缺少认证令牌")
     
@@ -1,13 +1,15 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Any
+from typing import Dict, Any, Mapping, Optional, Union
 from fastapi.responses import StreamingResponse, JSONResponse
 
 class BaseProvider(ABC):
     @abstractmethod
     async def chat_completion(
         self,
-        request_data: Dict[str, Any]
-    ) -> StreamingResponse:
+        request_data: Dict[str, Any],
+        headers: Optional[Mapping[str, str]] = None,
+        api_key_id: Optional[int] = None
+    ) -> Union[StreamingResponse, JSONResponse]:
         pass
 
     @abstractmethod
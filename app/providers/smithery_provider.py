@@ -1,76 +1,283 @@
+import asyncio
 import json
 import time
 import logging
 import uuid
 import httpx
-from typing import Dict, Any, AsyncGenerator, List
+from urllib.parse import urlsplit
+from typing import Dict, Any, AsyncGenerator, Awaitable, List, Mapping, Optional, Set, Tuple, Union
 
 from fastapi import HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
 
 from app.core.config import settings
 from app.providers.base_provider import BaseProvider
-from app.utils.sse_utils import create_sse_data, create_chat_completion_chunk, DONE_CHUNK
+from app.services.call_log_writer import call_log_writer
+from app.services.cookie_health import is_cookie_failure, is_retriable_status
+from app.services.cookie_pool import cookie_pool, CookieLease, PooledCookie
+from app.services.metrics import (
+    inter_token_seconds, model_label, stream_duration_seconds, ttfb_seconds, upstream_responses_total
+)
+from app.services.response_cache import (
+    CachedCompletion, DIRECTIVE_BYPASS, DIRECTIVE_DEFAULT, DIRECTIVE_REFRESH, cache_directive, request_key, response_cache
+)
+from app.services.single_flight import Flight, FlightSubscription, SubscriberTooSlow, single_flight
+from app.services.token_counter import usage_estimator
+from app.utils.coalesce import coalesce_deltas
+from app.utils.sse_parser import decode_json, iter_sse_data, sse_event_type
+from app.utils.sse_utils import ChatCompletionChunkEncoder, DONE_CHUNK
+from app.utils.timing import PhaseTimer
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - [%(levelname)s] - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 上游（AI SDK）结束原因到 OpenAI finish_reason 的映射
+FINISH_REASON_MAP = {
+    "stop": "stop",
+    "length": "length",
+    "content-filter": "content_filter",
+    "tool-calls": "tool_calls",
+}
+
+# 需要完整解码的上游事件类型，其余事件（start、text-start 等）直接跳过
+FORWARDED_EVENT_TYPES = (b"text-delta", b"finish", b"finish-step", b"message-metadata")
+
+# 上游 usage 中可能出现的 (prompt, completion) 字段名：AI SDK v5、v4 和 OpenAI 格式
+USAGE_FIELDS = (
+    ("inputTokens", "outputTokens"),
+    ("promptTokens", "completionTokens"),
+    ("prompt_tokens", "completion_tokens"),
+)
+
+# 读到 [DONE] 后继续读完响应体剩余部分的最长时间（秒）
+DRAIN_TIMEOUT = 1.0
+
+# 客户端断开后补记调用日志的任务，保留引用避免完成前被回收
+_cancelled_log_tasks: Set[asyncio.Task] = set()
+
+
+def _parse_upstream_usage(data: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+    """从上游事件的 usage 或 messageMetadata.usage 中取出 (prompt_tokens, completion_tokens)"""
+    usage = data.get("usage")
+    if usage is None:
+        metadata = data.get("messageMetadata")
+        usage = metadata.get("usage") if isinstance(metadata, dict) else None
+    if not isinstance(usage, dict):
+        return None
+    for prompt_field, completion_field in USAGE_FIELDS:
+        if prompt_field in usage or completion_field in usage:
+            try:
+                return int(usage.get(prompt_field) or 0), int(usage.get(completion_field) or 0)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+async def _drain(events: AsyncGenerator[bytes, None]) -> None:
+    """
+    读完 [DONE] 之后的剩余响应体（通常只有分块结束标记）。
+    HTTP/1.1 连接只有在响应体读完时才会放回连接池，HTTP/2 流正常结束也不必发送 RST_STREAM。
+    """
+    async def consume():
+        async for _ in events:
+            pass
+
+    try:
+        await asyncio.wait_for(consume(), DRAIN_TIMEOUT)
+    except (asyncio.TimeoutError, httpx.HTTPError):
+        # 上游没有及时结束响应时放弃，关闭响应会直接关闭连接
+        pass
+
+
 class SmitheryProvider(BaseProvider):
+    """
+    上游 HTTP 客户端随应用生命周期创建和关闭（start / close，也可以用 async with）：
+    启动时预先建立到上游的连接，空闲时定期发送轻量请求保持连接，首个请求不必等待 DNS、TCP 和 TLS 握手。
+    """
+
     def __init__(self):
-        # 使用 httpx 异步客户端，启用 HTTP/2
-        self.client = httpx.AsyncClient(
-            http2=True,
-            timeout=httpx.Timeout(180.0, connect=10.0),
-            follow_redirects=True,
-            limits=httpx.Limits(max_keepalive_connections=10, max_connections=100)
-        )
-        self.cookie_index = 0
-        self.current_cookie_id = None  # 记录当前使用的 cookie ID
+        self.client: Optional[httpx.AsyncClient] = None
+        self._keepalive_task: Optional[asyncio.Task] = None
+        self._last_request = 0.0
     
     async def __aenter__(self):
+        await self.start()
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.client.aclose()
+        await self.close()
+
+    @staticmethod
+    def _build_client() -> httpx.AsyncClient:
+        # 使用 httpx 异步客户端，默认启用 HTTP/2
+        return httpx.AsyncClient(
+            http2=settings.UPSTREAM_HTTP2,
+            timeout=httpx.Timeout(
+                settings.API_REQUEST_TIMEOUT,
+                connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+                pool=settings.UPSTREAM_POOL_TIMEOUT
+            ),
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=settings.UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY
+            )
+        )
+
+    async def start(self) -> None:
+        """创建 HTTP 客户端，预热连接并启动保活任务"""
+        if self.client is not None:
+            return
+        self.client = self._build_client()
+        if settings.UPSTREAM_WARMUP_CONNECTIONS > 0:
+            await self._warm_up(settings.UPSTREAM_WARMUP_CONNECTIONS, log=True)
+            if settings.UPSTREAM_KEEPALIVE_INTERVAL > 0:
+                self._keepalive_task = asyncio.create_task(self._keepalive())
+
+    async def close(self) -> None:
+        """停止保活任务并关闭所有上游连接"""
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            try:
+                await self._keepalive_task
+            except asyncio.CancelledError:
+                pass
+            self._keepalive_task = None
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
 
-    def _get_cookie(self) -> str:
-        """从数据库轮换获取 Cookie 并记录使用"""
+    async def flush_cancelled_logs(self, timeout: float = 5.0) -> None:
+        """等待客户端断开后补记调用日志的任务完成；关闭时在停止日志写入器之前调用，避免这些日志丢失"""
+        if _cancelled_log_tasks:
+            await asyncio.wait(set(_cancelled_log_tasks), timeout=timeout)
+
+    @staticmethod
+    def _warm_up_url() -> str:
+        if settings.UPSTREAM_WARMUP_URL:
+            return settings.UPSTREAM_WARMUP_URL
+        parts = urlsplit(settings.CHAT_API_URL)
+        return f"{parts.scheme}://{parts.netloc}/"
+
+    async def _warm_up(self, connections: int, log: bool = False) -> None:
+        """
+        用 HEAD 请求建立（或保持）到上游的连接，响应状态码无关紧要。
+        先发一个请求：协商为 HTTP/2 时所有请求复用这一个连接；仍是 HTTP/1.1 时再并发发送其余请求，各占一个连接。
+        """
+        url = self._warm_up_url()
+        start = time.perf_counter()
         try:
-            from app.db.database import SessionLocal
-            from app.db import crud
+            response = await self.client.head(url)
+            http_version = response.http_version
+            if http_version != "HTTP/2" and connections > 1:
+                await asyncio.gather(*(self.client.head(url) for _ in range(connections - 1)))
+        except httpx.HTTPError as e:
+            logger.warning(f"预热上游连接失败（{url}）: {e}")
+            return
+        if log:
+            logger.info(
+                f"已预热上游连接: {url}（{http_version}，{(time.perf_counter() - start) * 1000:.0f} ms）"
+            )
+
+    async def _keepalive(self) -> None:
+        """上游空闲超过 UPSTREAM_KEEPALIVE_INTERVAL 时发送保活请求，避免连接被上游或中间设备关闭后首个请求重新握手"""
+        interval = settings.UPSTREAM_KEEPALIVE_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self._last_request < interval:
+                continue
+            await self._warm_up(settings.UPSTREAM_WARMUP_CONNECTIONS)
+
+    async def _acquire_cookie(self, exclude: Set[Union[int, str]]) -> Optional[CookieLease]:
+        """从内存 Cookie 池为本次请求租用进行中请求最少的健康 Cookie（不访问数据库）"""
+        if not len(cookie_pool):
+            raise HTTPException(
+                status_code=503,
+                detail="服务暂时不可用：未配置任何 Cookie。"
+            )
+        lease = await cookie_pool.acquire(exclude)
+        if lease is None and not exclude:
+            upstream_retry_in = cookie_pool.upstream_retry_in()
+            if upstream_retry_in > 0:
+                raise HTTPException(
+                    status_code=503,
+                    detail="服务暂时不可用：上游连续出现服务端或网络错误，正在退避，请稍后重试。",
+                    headers={"Retry-After": str(max(int(upstream_retry_in), 1))}
+                )
+            if cookie_pool.all_quarantined():
+                raise HTTPException(
+                    status_code=503,
+                    detail="服务暂时不可用：所有 Cookie 均处于熔断隔离中，请稍后重试。",
+                    headers={"Retry-After": str(max(int(cookie_pool.next_retry_in()), 1))}
+                )
+            raise HTTPException(
+                status_code=503,
+                detail="服务繁忙：所有 Cookie 均已达到并发上限，请稍后重试。",
+                headers={"Retry-After": "1"}
+            )
+        return lease
+
+    async def _open_with_failover(
+        self,
+        payload: Dict[str, Any],
+        model: str,
+        prompt_tokens: Awaitable[int],
+        timer: PhaseTimer,
+        api_key_id: Optional[int] = None
+    ) -> Tuple[CookieLease, httpx.Response]:
+        """
+        依次在健康的 Cookie 上打开上游流，直到成功或用完尝试次数。
+        首字节前的认证、限流和上游错误会透明地换下一个 Cookie 重试：认证和限流（401/403/429）计入该 Cookie 的熔断器，
+        5xx 和网络错误是上游整体的故障，计入所有 Cookie 共用的上游退避；退避开始后不再换 Cookie 重试。
+        prompt_tokens 是与上游请求并行计算的任务，只在需要记录失败日志时等待。
+        各次尝试的租用 Cookie、准备请求头和打开上游的耗时累加到 timer 的对应阶段。
+        """
+        tried: Set[Union[int, str]] = set()
+        last_error: Optional[HTTPException] = None
+        for attempt in range(1, max(settings.UPSTREAM_MAX_ATTEMPTS, 1) + 1):
+            lease = await self._acquire_cookie(tried)
+            timer.mark("cookie")
+            if lease is None:
+                break
+            tried.add(lease.cookie.key)
+            headers = self._prepare_headers(lease.cookie)
+            timer.mark("headers")
+            
+            logger.info(f"发送请求到 Smithery - Model: {model}, Cookie: {lease.cookie.name}, 第 {attempt} 次尝试")
+            logger.debug(f"请求头: {json.dumps({k: v[:50] + '...' if len(v) > 50 else v for k, v in headers.items()}, indent=2)}")
             
-            db = SessionLocal()
+            start_time = time.time()
             try:
-                active_cookies = crud.get_active_cookies(db)
-                
-                if not active_cookies:
-                    # 回退到环境变量
-                    if settings.AUTH_COOKIES:
-                        auth_cookie_obj = settings.AUTH_COOKIES[self.cookie_index]
-                        self.cookie_index = (self.cookie_index + 1) % len(settings.AUTH_COOKIES)
-                        self.current_cookie_id = None
-                        return auth_cookie_obj.header_cookie_string
-                    else:
-                        raise HTTPException(
-                            status_code=503,
-                            detail="服务暂时不可用：未配置任何 Cookie。"
-                        )
-                
-                # 轮询选择
-                db_cookie = active_cookies[self.cookie_index % len(active_cookies)]
-                self.cookie_index = (self.cookie_index + 1) % len(active_cookies)
-                self.current_cookie_id = db_cookie.id
-                
-                # 构造 AuthCookie 对象
-                from app.core.config import AuthCookie
-                auth_cookie = AuthCookie(db_cookie.cookie_data)
-                
-                return auth_cookie.header_cookie_string
-            finally:
-                db.close()
-        except Exception as e:
-            logger.error(f"获取 Cookie 失败: {e}")
-            raise HTTPException(status_code=503, detail=f"获取 Cookie 失败: {str(e)}")
+                response = await self._open_upstream_stream(headers, payload, timer)
+            except HTTPException as e:
+                duration_ms = int((time.time() - start_time) * 1000)
+                self._log_api_call(
+                    lease.cookie.id, model, await prompt_tokens, 0, "error", str(e.detail), duration_ms, timer.as_dict(),
+                    api_key_id
+                )
+                if not is_retriable_status(e.status_code):
+                    lease.release()
+                    raise
+                if is_cookie_failure(e.status_code):
+                    lease.fail(e.status_code, str(e.detail))
+                else:
+                    lease.upstream_fail(e.status_code, str(e.detail))
+                last_error = e
+                continue
+            except asyncio.CancelledError:
+                # 客户端在上游返回响应头前断开
+                lease.release()
+                self._log_cancelled(lease.cookie.id, model, prompt_tokens, [], start_time, timer, api_key_id)
+                raise
+            except BaseException:
+                lease.release()
+                raise
+            
+            lease.succeed()
+            return lease, response
+        
+        raise last_error
 
     def _convert_messages_to_smithery_format(self, openai_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
@@ -93,10 +300,18 @@ class SmitheryProvider(BaseProvider):
             })
         return smithery_messages
 
-    async def chat_completion(self, request_data: Dict[str, Any]) -> StreamingResponse:
+    async def chat_completion(
+        self,
+        request_data: Dict[str, Any],
+        headers: Optional[Mapping[str, str]] = None,
+        api_key_id: Optional[int] = None
+    ) -> Union[StreamingResponse, JSONResponse, Response]:
         """
-        处理聊天补全请求。
+        处理聊天补全请求。api_key_id 为发起请求的客户端 API Key（使用主密钥时为空），记录在调用日志中。
         此实现为无状态模式，完全依赖客户端发送的完整对话历史。
+        stream 为 false 时返回单个 chat.completion JSON，否则返回 SSE 流。
+        开启补全缓存时，确定性请求先查缓存，命中则直接回放，不占用 Cookie；
+        开启单飞合并时，与正在进行的请求相同的请求订阅其输出，不再单独请求上游。
         """
         
         # 1. 直接从客户端请求中获取完整的消息历史
@@ -108,103 +323,192 @@ class SmitheryProvider(BaseProvider):
         # 3. 准备请求
         model = request_data.get("model", "claude-haiku-4.5")
         payload = self._prepare_payload(model, smithery_formatted_messages)
-        headers = self._prepare_headers()
         
         request_id = f"chatcmpl-{uuid.uuid4()}"
         start_time = time.time()
-        cookie_id = self.current_cookie_id
+        timer = PhaseTimer()
+        stream = request_data.get("stream", True)
+        stream_options = request_data.get("stream_options")
+        include_usage = isinstance(stream_options, dict) and bool(stream_options.get("include_usage"))
+        
+        # 4. 规范请求哈希，补全缓存和单飞合并共用；X-Cache-Bypass 同时跳过两者
+        directive = cache_directive(headers)
+        cache_key: Optional[str] = None
+        flight_key: Optional[str] = None
+        if directive != DIRECTIVE_BYPASS and (response_cache.enabled or single_flight.enabled):
+            key = request_key(
+                model,
+                [(message["role"], message["parts"][0]["text"]) for message in smithery_formatted_messages],
+                payload["systemPrompt"],
+                request_data
+            )
+            cache_key = key if response_cache.accepts(request_data) else None
+            flight_key = key if single_flight.accepts(request_data) else None
+        
+        timer.mark("parse")
         
-        # 预检查：先发送请求检查认证（不等待完整响应）
-        logger.info(f"发送请求到 Smithery - Model: {model}")
-        logger.debug(f"请求头: {json.dumps({k: v[:50] + '...' if len(v) > 50 else v for k, v in headers.items()}, indent=2)}")
+        # 5. 查询补全缓存；X-Cache 响应头标明 HIT / MISS / REFRESH / BYPASS / SKIP（请求不可缓存）
+        response_headers: Dict[str, str] = {}
+        if response_cache.enabled:
+            response_cache.note_directive(directive)
+            if cache_key is not None and directive == DIRECTIVE_DEFAULT:
+                cached = await response_cache.get(cache_key)
+                if cached is not None:
+                    timer.mark("cache")
+                    return self._with_server_timing(
+                        self._replay_cached(cached, request_id, model, stream, include_usage), timer
+                    )
+            if directive == DIRECTIVE_BYPASS:
+                response_headers["X-Cache"] = "BYPASS"
+            elif cache_key is None:
+                response_headers["X-Cache"] = "SKIP"
+            else:
+                response_headers["X-Cache"] = "REFRESH" if directive == DIRECTIVE_REFRESH else "MISS"
+            timer.mark("cache")
         
+        # 6. 相同的请求正在生成时作为跟随者订阅，否则作为领导者登记，X-Single-Flight 响应头标明角色
+        flight: Optional[Flight] = None
+        if flight_key is not None:
+            subscription = single_flight.join(flight_key)
+            if subscription is not None:
+                response_headers["X-Single-Flight"] = "follower"
+                response = await self._respond_from_flight(
+                    subscription, request_id, model, stream, include_usage, request_data, response_headers,
+                    start_time, timer, api_key_id, follower=True
+                )
+                return self._with_server_timing(response, timer)
+            flight = single_flight.lead(flight_key)
+            response_headers["X-Single-Flight"] = "leader"
+        
+        # prompt token 数在等待上游响应头期间计算（按消息内容哈希缓存）
+        prompt_task = asyncio.create_task(usage_estimator.count_prompt(messages_from_client))
+        
+        # 只发起一次上游流式请求：先读取状态码和响应头，再把同一个响应体转发给客户端。
+        # 租约贯穿整个流式响应，Cookie ID 随请求传递，避免并发请求间互相覆盖
         try:
-            test_response = await self.client.post(
-                settings.CHAT_API_URL,
-                headers=headers,
-                json=payload,
-                timeout=2.0
+            lease, response = await self._open_with_failover(payload, model, prompt_task, timer, api_key_id)
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError):
+                # 没有可用 Cookie（503）或上游失败时不再需要 prompt token 数；客户端断开时补记的 cancelled 日志还要用它
+                prompt_task.cancel()
+            if flight is not None:
+                # 等待中的跟随者得到同样的错误
+                flight.fail(e if isinstance(e, HTTPException) else HTTPException(status_code=502, detail="上游请求已中断"))
+                single_flight.forget(flight)
+            raise
+        cookie_id = lease.cookie.id
+        upstream_closed = False
+
+        async def close_upstream():
+            # 流式响应结束时和后台任务中都会调用，只关闭一次
+            nonlocal upstream_closed
+            if upstream_closed:
+                return
+            upstream_closed = True
+            lease.release()
+            await response.aclose()
+
+        try:
+            prompt_tokens = await prompt_task
+        except BaseException:
+            # 客户端在这里断开（请求被取消）时，上游响应和租约还没有交给任何人关闭
+            if flight is not None:
+                flight.fail(HTTPException(status_code=502, detail="上游请求已中断"))
+                single_flight.forget(flight)
+            await close_upstream()
+            raise
+        timer.mark("prompt_tokens")
+        if settings.SERVER_TIMING_ENABLED:
+            # 流式响应的响应头在输出开始前发送，只包含到上游响应头为止的阶段；之后的阶段记录在调用日志中
+            response_headers["Server-Timing"] = timer.server_timing()
+
+        if flight is not None:
+            # 上游由独立的生产者任务读取，领导者和跟随者一样只是订阅者
+            subscription = flight.subscribe()
+            flight.start(self._produce_flight(
+                flight, response, close_upstream, model, prompt_tokens, cookie_id, start_time, cache_key, timer,
+                api_key_id
+            ), cookie_id, prompt_tokens)
+            return await self._respond_from_flight(
+                subscription, request_id, model, stream, include_usage, request_data, response_headers,
+                start_time, timer, api_key_id
+            )
+
+        if not stream:
+            # 非流式请求：消费完上游流后一次性返回 chat.completion 对象
+            return await self._collect_completion(
+                response, close_upstream, request_id, model, prompt_tokens, cookie_id, start_time,
+                timer, cache_key, response_headers, api_key_id
             )
-            # 如果是认证/权限错误，立即抛出（在返回StreamingResponse之前）
-            if test_response.status_code == 401:
-                logger.error("认证失败：Cookie可能已过期")
-                raise HTTPException(status_code=401, detail="认证失败，Cookie可能已过期")
-            elif test_response.status_code == 403:
-                logger.error("权限不足：Cookie可能缺少必要信息")
-                raise HTTPException(status_code=403, detail="权限不足，请复制完整的Cookie（包含PostHog）")
-            elif test_response.status_code >= 400:
-                error_text = test_response.text[:200] if hasattr(test_response, 'text') else str(test_response.status_code)
-                logger.error(f"上游API错误: {test_response.status_code} - {error_text}")
-                raise HTTPException(
-                    status_code=test_response.status_code,
-                    detail=f"上游API错误: {error_text}"
-                )
-        except httpx.TimeoutException:
-            # 超时是正常的（响应开始了但没完成），继续流式请求
-            pass
-        except httpx.HTTPError as e:
-            logger.error(f"HTTP请求错误: {e}")
-            raise HTTPException(status_code=502, detail=f"网络错误: {str(e)}")
 
         async def stream_generator() -> AsyncGenerator[bytes, None]:
-            completion_tokens = 0
+            parts: List[str] = []
+            upstream_result: Dict[str, Any] = {}
+            # 每个流创建一次编码器，分块只转义增量文本
+            encoder = ChatCompletionChunkEncoder(request_id, model)
+            
+            deltas = self._iter_text_deltas(response, upstream_result, model, start_time)
+            coalesce = self._coalesce_params(model, request_data)
+            if coalesce:
+                deltas = coalesce_deltas(deltas, *coalesce)
             
+            # 编码耗时单独累计（包含在 stream 阶段内），首个增量发出时记录 first_token
+            encode_time = 0.0
             try:
-                # 使用 httpx 异步发送流式请求
-                async with self.client.stream(
-                    "POST",
-                    settings.CHAT_API_URL,
-                    headers=headers,
-                    json=payload,
-                ) as response:
-
-                    # 流式处理 - 逐行实时转发
-                    async for line in response.aiter_lines():
-                        if not line:
-                            continue
-                        
-                        # 立即处理，不积累
-                        if line.startswith("data:"):
-                            content = line[5:].strip()
-                            if content == "[DONE]":
-                                break
-                            try:
-                                data = json.loads(content)
-                                if data.get("type") == "text-delta":
-                                    delta_content = data.get("delta", "")
-                                    if delta_content:
-                                        completion_tokens += len(delta_content)  # 粗略统计
-                                        chunk_data = create_chat_completion_chunk(request_id, model, delta_content)
-                                        yield create_sse_data(chunk_data)
-                            except json.JSONDecodeError:
-                                # 静默跳过无法解析的数据
-                                pass
+                # 流式处理 - 逐条实时转发（开启合并时按窗口合并后转发）
+                async for delta_content in deltas:
+                    if not parts:
+                        timer.mark("first_token")
+                    parts.append(delta_content)
+                    encode_start = time.perf_counter()
+                    chunk = encoder.encode(delta_content)
+                    encode_time += time.perf_counter() - encode_start
+                    yield chunk
+            
+                # 发送结束标志
+                finish_reason = upstream_result.get("finish_reason", "stop")
+                yield encoder.encode("", finish_reason)
+                usage = await self._usage(prompt_tokens, parts, upstream_result)
+                if include_usage:
+                    yield encoder.encode_usage(usage)
+                yield DONE_CHUNK
+                
+                # 只缓存完整结束的结果
+                if cache_key is not None:
+                    await response_cache.put(cache_key, "".join(parts), finish_reason, usage)
                 
-                    # 发送结束标志
-                    final_chunk = create_chat_completion_chunk(request_id, model, "", "stop")
-                    yield create_sse_data(final_chunk)
-                    yield DONE_CHUNK
-                    
-                    # 记录成功调用日志
-                    duration_ms = int((time.time() - start_time) * 1000)
-                    self._log_api_call(cookie_id, model, len(str(messages_from_client)), completion_tokens, "success", None, duration_ms)
-
-            except HTTPException:
-                # HTTP 异常直接向上抛出，不包装成 SSE
+                # 记录成功调用日志
+                timer.mark("stream")
+                timer.add("encode", encode_time)
                 duration_ms = int((time.time() - start_time) * 1000)
-                self._log_api_call(cookie_id, model, len(str(messages_from_client)), 0, "error", "HTTP错误", duration_ms)
+                self._log_api_call(
+                    cookie_id, model, usage["prompt_tokens"], usage["completion_tokens"], "success", None, duration_ms,
+                    timer.as_dict(), api_key_id
+                )
+
+            except (asyncio.CancelledError, GeneratorExit):
+                # 客户端断开：Starlette 取消输出任务（或生成器被关闭），finally 中随即关闭上游并释放租约
+                timer.add("encode", encode_time)
+                self._log_cancelled(cookie_id, model, prompt_tokens, parts, start_time, timer, api_key_id)
                 raise
             except Exception as e:
-                # 只有流式传输中的错误才包装成 SSE 响应
+                # 上游状态已在返回前检查过，这里只会是流式传输中的错误，包装成 SSE 响应
                 logger.error(f"流式传输错误: {e}", exc_info=True)
                 error_message = f"流式传输错误: {str(e)}"
-                error_chunk = create_chat_completion_chunk(request_id, model, error_message, "stop")
-                yield create_sse_data(error_chunk)
+                yield encoder.encode(error_message, "stop")
                 yield DONE_CHUNK
                 
-                # 记录失败日志
+                # 记录失败日志，completion_tokens 为出错前已转发的部分
+                timer.mark("stream")
+                timer.add("encode", encode_time)
                 duration_ms = int((time.time() - start_time) * 1000)
-                self._log_api_call(cookie_id, model, len(str(messages_from_client)), 0, "error", str(e), duration_ms)
+                usage = await self._usage(prompt_tokens, parts, {})
+                self._log_api_call(
+                    cookie_id, model, prompt_tokens, usage["completion_tokens"], "error", str(e), duration_ms, timer.as_dict(),
+                    api_key_id
+                )
+            finally:
+                await close_upstream()
 
         return StreamingResponse(
             stream_generator(), 
@@ -212,32 +516,497 @@ class SmitheryProvider(BaseProvider):
             headers={
                 "Cache-Control": "no-cache",
                 "X-Accel-Buffering": "no",  # 禁用 Nginx 缓冲
-            }
+                **response_headers,
+            },
+            # 客户端在开始读取前断开时，生成器不会运行，由后台任务兜底关闭上游连接并释放租约
+            background=BackgroundTask(close_upstream)
         )
 
-    def _prepare_headers(self) -> Dict[str, str]:
-        """准备请求头，包含动态的用户ID和会话ID"""
-        # 获取当前Cookie并解析用户ID
-        cookie_str = self._get_cookie()
-        logger.debug(f"使用Cookie（前100字符）: {cookie_str[:100]}...")
-        
-        # 尝试从当前使用的Cookie中获取用户ID
-        user_id = None
+    def _coalesce_params(self, model: str, request_data: Dict[str, Any]) -> Optional[Tuple[float, int]]:
+        """
+        解析增量合并参数，优先级：请求 stream_options > 按模型配置 > 全局配置。
+        返回 (时间窗口秒数, 字符阈值)，未开启时返回 None。
+        """
+        stream_options = request_data.get("stream_options") or {}
+        window_ms = settings.STREAM_COALESCE_MODELS.get(model, settings.STREAM_COALESCE_WINDOW_MS)
+        max_chars = settings.STREAM_COALESCE_MAX_CHARS
+        if isinstance(stream_options, dict):
+            window_ms = stream_options.get("coalesce_ms", window_ms)
+            max_chars = stream_options.get("coalesce_chars", max_chars)
+        try:
+            window_ms = float(window_ms)
+            max_chars = int(max_chars)
+        except (TypeError, ValueError):
+            return None
+        if window_ms <= 0:
+            return None
+        # 限制上限，避免客户端设置过大的窗口拖慢输出
+        return min(window_ms, 1000.0) / 1000, max(max_chars, 1)
+
+    async def _iter_text_deltas(
+        self,
+        response: httpx.Response,
+        result: Dict[str, Any],
+        model: str,
+        start_time: float
+    ) -> AsyncGenerator[str, None]:
+        """
+        解析上游 SSE，逐个产出 text-delta 的文本。
+        上游给出的结束原因写入 result["finish_reason"]，用量写入 result["usage"]：
+        finish-step 的用量按步骤累加，finish 或 message-metadata 中的用量是整条消息的总数，直接覆盖。
+        直接在字节上切分事件并取出 type，只完整解码需要的事件。
+        同时记录首字延迟（从 start_time 起）、增量间隔和流的持续时间指标。
+        """
+        label = model_label(model)
+        last_delta: Optional[float] = None
+        outcome = "cancelled"
         try:
-            from app.db.database import SessionLocal
-            from app.db import crud
-            if self.current_cookie_id:
-                db = SessionLocal()
+            events = iter_sse_data(response.aiter_bytes())
+            async for content in events:
+                if content == b"[DONE]":
+                    await _drain(events)
+                    break
+                if sse_event_type(content) not in FORWARDED_EVENT_TYPES:
+                    continue
                 try:
-                    db_cookie = crud.get_cookie_by_id(db, self.current_cookie_id)
-                    if db_cookie:
-                        from app.core.config import AuthCookie
-                        auth_obj = AuthCookie(db_cookie.cookie_data)
-                        user_id = auth_obj.user_id
-                finally:
-                    db.close()
-        except:
-            pass
+                    data = decode_json(content)
+                except ValueError:
+                    # 静默跳过无法解析的数据
+                    continue
+                event_type = data.get("type")
+                if event_type == "text-delta":
+                    delta_content = data.get("delta", "")
+                    if delta_content:
+                        now = time.time()
+                        if last_delta is None:
+                            ttfb_seconds.observe(now - start_time, label)
+                        else:
+                            inter_token_seconds.observe(now - last_delta, label)
+                        last_delta = now
+                        yield delta_content
+                else:
+                    if event_type == "finish":
+                        finish_reason = data.get("finishReason")
+                        if finish_reason:
+                            result["finish_reason"] = FINISH_REASON_MAP.get(finish_reason, "stop")
+                    usage = _parse_upstream_usage(data)
+                    if usage is not None:
+                        if event_type == "finish-step" and "usage" in result:
+                            usage = (result["usage"][0] + usage[0], result["usage"][1] + usage[1])
+                        result["usage"] = usage
+            outcome = "completed"
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            # 客户端断开时生成器被关闭，outcome 保持为 cancelled
+            stream_duration_seconds.observe(time.time() - start_time, label, outcome)
+
+    async def _produce_flight(
+        self,
+        flight: Flight,
+        response: httpx.Response,
+        close_upstream,
+        model: str,
+        prompt_tokens: int,
+        cookie_id: Optional[int],
+        start_time: float,
+        cache_key: Optional[str],
+        timer: PhaseTimer,
+        api_key_id: Optional[int] = None
+    ) -> None:
+        """单飞的生产者：把上游增量写入共享缓冲区，结束后记录一次调用日志并写入补全缓存"""
+        upstream_result: Dict[str, Any] = {}
+        try:
+            async for delta_content in self._iter_text_deltas(response, upstream_result, model, start_time):
+                if not flight.parts:
+                    timer.mark("first_token")
+                flight.append(delta_content)
+            finish_reason = upstream_result.get("finish_reason", "stop")
+            usage = await self._usage(prompt_tokens, flight.parts, upstream_result)
+            flight.finish(finish_reason, usage)
+            
+            timer.mark("stream")
+            duration_ms = int((time.time() - start_time) * 1000)
+            self._log_api_call(
+                cookie_id, model, usage["prompt_tokens"], usage["completion_tokens"], "success", None, duration_ms,
+                timer.as_dict(), api_key_id
+            )
+            if cache_key is not None:
+                await response_cache.put(cache_key, "".join(flight.parts), finish_reason, usage)
+        except asyncio.CancelledError:
+            self._log_cancelled(cookie_id, model, prompt_tokens, flight.parts, start_time, timer, api_key_id)
+            raise
+        except Exception as e:
+            logger.error(f"流式传输错误: {e}", exc_info=True)
+            flight.fail(e)
+            timer.mark("stream")
+            duration_ms = int((time.time() - start_time) * 1000)
+            usage = await self._usage(prompt_tokens, flight.parts, {})
+            self._log_api_call(
+                cookie_id, model, prompt_tokens, usage["completion_tokens"], "error", str(e), duration_ms, timer.as_dict(),
+                api_key_id
+            )
+        finally:
+            # 正常结束、出错或所有订阅者离开（任务被取消）时都会关闭上游并释放租约
+            single_flight.forget(flight)
+            await close_upstream()
+
+    async def _respond_from_flight(
+        self,
+        subscription: FlightSubscription,
+        request_id: str,
+        model: str,
+        stream: bool,
+        include_usage: bool,
+        request_data: Dict[str, Any],
+        response_headers: Dict[str, str],
+        start_time: float,
+        timer: PhaseTimer,
+        api_key_id: Optional[int] = None,
+        follower: bool = False
+    ) -> Union[StreamingResponse, JSONResponse]:
+        """
+        按请求的格式输出共享生成的结果；每个订阅者独立读取，慢的客户端只影响自己。
+        领导者的调用由生产者记录；跟随者（follower）各自记录一条 coalesced 调用日志，计入自己的 API Key
+        """
+        flight = subscription.flight
+        try:
+            # 跟随者在上游打开前加入时，等待领导者的结果，打开失败则返回同样的错误
+            await asyncio.shield(flight.opened)
+            if follower:
+                timer.mark("flight")
+            if not stream:
+                content = "".join([delta async for delta in subscription])
+        except BaseException as e:
+            if follower and isinstance(e, asyncio.CancelledError):
+                self._log_follower_cancelled(subscription, model, start_time, timer, api_key_id)
+            await subscription.aclose()
+            raise
+        
+        if not stream:
+            await subscription.aclose()
+            if follower:
+                await self._log_follower(subscription, model, start_time, timer, api_key_id)
+            if flight.error is not None:
+                raise HTTPException(status_code=502, detail=f"读取上游响应错误: {str(flight.error)}")
+            return JSONResponse(
+                content=self._completion_body(
+                    request_id, model, int(time.time()), content, flight.finish_reason, flight.usage
+                ),
+                headers=response_headers
+            )
+
+        # 领导者的调用由生产者记录
+        logged = not follower
+
+        async def stream_generator() -> AsyncGenerator[bytes, None]:
+            nonlocal logged
+            encoder = ChatCompletionChunkEncoder(request_id, model)
+            deltas = subscription.__aiter__()
+            coalesce = self._coalesce_params(model, request_data)
+            if coalesce:
+                deltas = coalesce_deltas(deltas, *coalesce)
+            try:
+                error: Optional[BaseException] = None
+                try:
+                    async for delta_content in deltas:
+                        yield encoder.encode(delta_content)
+                except SubscriberTooSlow as e:
+                    # 读取过慢被断开，共享生成照常继续
+                    error = e
+                else:
+                    error = flight.error
+                if follower:
+                    logged = True
+                    await self._log_follower(subscription, model, start_time, timer, api_key_id, error)
+                if error is not None:
+                    yield encoder.encode(f"流式传输错误: {str(error)}", "stop")
+                else:
+                    yield encoder.encode("", flight.finish_reason)
+                    if include_usage:
+                        yield encoder.encode_usage(flight.usage)
+                yield DONE_CHUNK
+            finally:
+                await finish()
+
+        async def finish() -> None:
+            # 生成器结束时和后台任务中都会调用；跟随者在读完之前断开（包括还没开始读取）时记录 cancelled
+            nonlocal logged
+            if not logged:
+                logged = True
+                self._log_follower_cancelled(subscription, model, start_time, timer, api_key_id)
+            await subscription.aclose()
+
+        return StreamingResponse(
+            stream_generator(),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+                **response_headers,
+            },
+            # 客户端在开始读取前断开时由后台任务退订，最后一个订阅者离开会取消上游读取
+            background=BackgroundTask(finish)
+        )
+
+    async def _log_follower(
+        self,
+        subscription: FlightSubscription,
+        model: str,
+        start_time: float,
+        timer: PhaseTimer,
+        api_key_id: Optional[int],
+        error: Optional[BaseException] = None
+    ) -> None:
+        """
+        跟随者读完共享生成后记录自己的调用日志：Cookie 和 token 数与领导者相同，耗时和 API Key 是自己的。
+        error 为跟随者自己的失败（读取过慢被断开），默认取共享生成的错误
+        """
+        flight = subscription.flight
+        timer.mark("stream")
+        duration_ms = int((time.time() - start_time) * 1000)
+        error = error or flight.error
+        if error is None:
+            usage, status, error_message = flight.usage, "success", None
+        else:
+            usage = await self._usage(flight.prompt_tokens, subscription.received(), {})
+            status, error_message = "error", str(error)
+        self._log_api_call(
+            flight.cookie_id, model, usage["prompt_tokens"], usage["completion_tokens"], status, error_message,
+            duration_ms, timer.as_dict(), api_key_id, coalesced=True
+        )
+
+    def _log_follower_cancelled(
+        self,
+        subscription: FlightSubscription,
+        model: str,
+        start_time: float,
+        timer: PhaseTimer,
+        api_key_id: Optional[int]
+    ) -> None:
+        """跟随者在读完之前断开；上游还没打开（没有 Cookie）时不记录"""
+        flight = subscription.flight
+        if flight.cookie_id is not None:
+            self._log_cancelled(
+                flight.cookie_id, model, flight.prompt_tokens, subscription.received(), start_time, timer, api_key_id,
+                coalesced=True
+            )
+
+    def _replay_cached(
+        self,
+        cached: CachedCompletion,
+        request_id: str,
+        model: str,
+        stream: bool,
+        include_usage: bool
+    ) -> Union[JSONResponse, Response]:
+        """缓存命中：按请求的格式回放完整结果，流式请求一次写出全部 SSE 帧"""
+        headers = {"X-Cache": "HIT"}
+        if not stream:
+            return JSONResponse(
+                content=self._completion_body(
+                    request_id, model, int(time.time()), cached.content, cached.finish_reason, cached.usage
+                ),
+                headers=headers
+            )
+        encoder = ChatCompletionChunkEncoder(request_id, model)
+        chunks = [encoder.encode(cached.content), encoder.encode("", cached.finish_reason)]
+        if include_usage:
+            chunks.append(encoder.encode_usage(cached.usage))
+        chunks.append(DONE_CHUNK)
+        return Response(
+            content=b"".join(chunks),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", **headers}
+        )
+
+    @staticmethod
+    def _with_server_timing(response: Response, timer: PhaseTimer) -> Response:
+        if settings.SERVER_TIMING_ENABLED:
+            response.headers["Server-Timing"] = timer.server_timing()
+        return response
+
+    @staticmethod
+    def _completion_body(
+        request_id: str,
+        model: str,
+        created: int,
+        content: str,
+        finish_reason: str,
+        usage: Dict[str, int]
+    ) -> Dict[str, Any]:
+        return {
+            "id": request_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": finish_reason
+                }
+            ],
+            "usage": usage
+        }
+
+    async def _usage(self, prompt_tokens: int, parts: List[str], upstream_result: Dict[str, Any]) -> Dict[str, int]:
+        """OpenAI 格式的 usage：优先使用上游报告的用量，否则使用本地 token 计数"""
+        upstream_usage = upstream_result.get("usage")
+        if upstream_usage:
+            prompt_tokens, completion_tokens = upstream_usage
+        else:
+            completion_tokens = await usage_estimator.count_completion("".join(parts))
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+
+    async def _collect_completion(
+        self,
+        response: httpx.Response,
+        close_upstream,
+        request_id: str,
+        model: str,
+        prompt_tokens: int,
+        cookie_id: Optional[int],
+        start_time: float,
+        timer: PhaseTimer,
+        cache_key: Optional[str] = None,
+        response_headers: Optional[Dict[str, str]] = None,
+        api_key_id: Optional[int] = None
+    ) -> JSONResponse:
+        """非流式模式：把上游文本增量追加到列表，最后拼接成一个 OpenAI 格式的响应"""
+        parts: List[str] = []
+        upstream_result: Dict[str, Any] = {}
+        try:
+            async for delta_content in self._iter_text_deltas(response, upstream_result, model, start_time):
+                if not parts:
+                    timer.mark("first_token")
+                parts.append(delta_content)
+        except asyncio.CancelledError:
+            # 客户端断开：请求处理被取消，finally 中关闭上游并释放租约
+            self._log_cancelled(cookie_id, model, prompt_tokens, parts, start_time, timer, api_key_id)
+            raise
+        except Exception as e:
+            logger.error(f"读取上游响应错误: {e}", exc_info=True)
+            timer.mark("stream")
+            duration_ms = int((time.time() - start_time) * 1000)
+            self._log_api_call(cookie_id, model, prompt_tokens, 0, "error", str(e), duration_ms, timer.as_dict(), api_key_id)
+            raise HTTPException(status_code=502, detail=f"读取上游响应错误: {str(e)}")
+        finally:
+            await close_upstream()
+
+        content = "".join(parts)
+        usage = await self._usage(prompt_tokens, parts, upstream_result)
+        timer.mark("stream")
+        duration_ms = int((time.time() - start_time) * 1000)
+        self._log_api_call(
+            cookie_id, model, usage["prompt_tokens"], usage["completion_tokens"], "success", None, duration_ms, timer.as_dict(),
+            api_key_id
+        )
+
+        finish_reason = upstream_result.get("finish_reason", "stop")
+        if cache_key is not None:
+            await response_cache.put(cache_key, content, finish_reason, usage)
+
+        if response_headers is not None and settings.SERVER_TIMING_ENABLED:
+            # 非流式响应在读完上游后才发送，响应头包含完整的阶段
+            response_headers["Server-Timing"] = timer.server_timing()
+        return JSONResponse(
+            content=self._completion_body(request_id, model, int(start_time), content, finish_reason, usage),
+            headers=response_headers
+        )
+
+    def _log_cancelled(
+        self,
+        cookie_id: Optional[int],
+        model: str,
+        prompt_tokens: Union[int, Awaitable[int]],
+        parts: List[str],
+        start_time: float,
+        timer: PhaseTimer,
+        api_key_id: Optional[int] = None,
+        coalesced: bool = False
+    ) -> None:
+        """
+        记录客户端断开的调用（状态 cancelled），completion_tokens 为断开前已生成的部分。
+        当前任务正在被取消，其中的 await 会再次被取消，所以 token 计数和提交放在独立的任务中；
+        prompt_tokens 可以是还在计算的任务
+        """
+        timer.mark("stream")
+        duration_ms = int((time.time() - start_time) * 1000)
+        parts = list(parts)
+
+        async def log():
+            prompt = prompt_tokens if isinstance(prompt_tokens, int) else await prompt_tokens
+            usage = await self._usage(prompt, parts, {})
+            self._log_api_call(
+                cookie_id, model, prompt, usage["completion_tokens"], "cancelled", "客户端断开连接", duration_ms,
+                timer.as_dict(), api_key_id, coalesced
+            )
+
+        task = asyncio.create_task(log())
+        _cancelled_log_tasks.add(task)
+        task.add_done_callback(_cancelled_log_tasks.discard)
+
+    async def _open_upstream_stream(
+        self,
+        headers: Dict[str, str],
+        payload: Dict[str, Any],
+        timer: PhaseTimer
+    ) -> httpx.Response:
+        """
+        打开上游流式请求，仅读取状态码和响应头。
+        认证/权限错误在返回 StreamingResponse 之前映射为对应的 HTTP 错误。
+        连接、TLS 握手、发送请求和等待上游响应头的耗时由 httpx 的 trace 扩展计入 timer，
+        其余时间（主要是等待连接池中的空闲连接）计为 pool 阶段。
+        """
+        self._last_request = time.monotonic()
+        request = self.client.build_request("POST", settings.CHAT_API_URL, headers=headers, json=payload)
+        request.extensions["trace"] = timer.trace
+        try:
+            response = await self.client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            timer.mark("pool")
+            logger.error(f"HTTP请求错误: {e}")
+            upstream_responses_total.inc("network_error")
+            raise HTTPException(status_code=502, detail=f"网络错误: {str(e)}")
+
+        timer.mark("pool")
+        upstream_responses_total.inc(str(response.status_code))
+        if response.status_code < 400:
+            return response
+
+        # 错误响应体很小，读完后立即释放连接
+        try:
+            await response.aread()
+            error_text = response.text[:200]
+        except httpx.HTTPError:
+            error_text = str(response.status_code)
+        finally:
+            await response.aclose()
+
+        if response.status_code == 401:
+            logger.error("认证失败：Cookie可能已过期")
+            raise HTTPException(status_code=401, detail="认证失败，Cookie可能已过期")
+        elif response.status_code == 403:
+            logger.error("权限不足：Cookie可能缺少必要信息")
+            raise HTTPException(status_code=403, detail="权限不足，请复制完整的Cookie（包含PostHog）")
+        logger.error(f"上游API错误: {response.status_code} - {error_text}")
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"上游API错误: {error_text}"
+        )
+
+    def _prepare_headers(self, cookie: PooledCookie) -> Dict[str, str]:
+        """准备请求头，包含动态的用户ID和会话ID"""
+        # 请求头字符串和用户ID已在入池时解析好
+        cookie_str = cookie.header_cookie_string
+        logger.debug(f"使用Cookie（前100字符）: {cookie_str[:100]}...")
+        user_id = cookie.user_id
         
         # 如果无法获取用户ID，使用默认值
         if not user_id:
@@ -279,41 +1048,34 @@ class SmitheryProvider(BaseProvider):
             "systemPrompt": "You are a helpful assistant."
         }
     
-    def _log_api_call(self, cookie_id, model, prompt_tokens, completion_tokens, status, error_message, duration_ms):
-        """记录 API 调用日志到数据库"""
+    def _log_api_call(
+        self, cookie_id, model, prompt_tokens, completion_tokens, status, error_message, duration_ms, timings=None,
+        api_key_id=None, coalesced=False
+    ):
+        """
+        提交 API 调用日志，由后台写入器批量落库；timings 为各阶段耗时（毫秒），api_key_id 为客户端 API Key，
+        coalesced 表示单飞跟随者的调用
+        """
         if not cookie_id:
             return
         
-        try:
-            from app.db.database import SessionLocal
-            from app.db import crud
-            
-            db = SessionLocal()
-            try:
-                # 创建调用日志
-                crud.create_call_log(
-                    db=db,
-                    cookie_id=cookie_id,
-                    model=model,
-                    prompt_tokens=prompt_tokens,
-                    completion_tokens=completion_tokens,
-                    status=status,
-                    error_message=error_message,
-                    duration_ms=duration_ms
-                )
-                
-                # 更新 Cookie 使用计数
-                crud.increment_cookie_usage(db, cookie_id)
-                
-                logger.info(f"记录调用日志: Cookie#{cookie_id}, Model={model}, Status={status}")
-            finally:
-                db.close()
-        except Exception as e:
-            logger.error(f"记录调用日志失败: {e}")
+        call_log_writer.submit({
+            "cookie_id": cookie_id,
+            "api_key_id": api_key_id,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "status": status,
+            "error_message": error_message,
+            "duration_ms": duration_ms,
+            "timings": json.dumps(timings, separators=(",", ":")) if timings else None,
+            "coalesced": coalesced
+        })
+        logger.info(f"记录调用日志: Cookie#{cookie_id}, Model={model}, Status={status}")
 
     async def get_models(self) -> JSONResponse:
         # 检查是否有可用的 Cookie
-        if not settings.AUTH_COOKIES:
+        if not len(cookie_pool):
             raise HTTPException(
                 status_code=503,
                 detail="服务暂时不可用：未配置任何 Cookie。请通过管理页面 (http://localhost:8088/admin/) 添加 Cookie。"
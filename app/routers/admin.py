@@ -1,20 +1,31 @@
+import base64
 import json
 import logging
-from typing import Optional
-from fastapi import APIRouter, Depends, HTTPException, Body
-from fastapi.responses import JSONResponse
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Body, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 
 from app.core.config import settings
 from app.db.database import get_db
 from app.db import crud
+from app.services.api_keys import api_keys
+from app.services.call_log_archiver import call_log_archiver
+from app.services.call_log_writer import call_log_writer
+from app.services.cookie_pool import cookie_pool
+from app.services.profiler import profile_store
+from app.services.response_cache import response_cache
+from app.services.single_flight import single_flight
 from app.middleware.auth import create_session, verify_admin_session, invalidate_session
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/admin", tags=["admin"])
 
+# 访问数据库的端点定义为普通函数，由 FastAPI 放到线程池执行，避免同步 SQLite 调用阻塞事件循环
+
 # ==================== Pydantic 模型 ====================
 
 class LoginRequest(BaseModel):
@@ -33,6 +44,21 @@ class CookieUpdate(BaseModel):
     name: Optional[str] = None
     cookie_data: Optional[str] = None
 
+class APIKeyCreate(BaseModel):
+    name: str
+    rate_limit: Optional[float] = None
+    burst: Optional[int] = None
+    max_concurrency: Optional[int] = None
+    allowed_models: Optional[List[str]] = None
+
+class APIKeyUpdate(BaseModel):
+    # 只修改请求中给出的字段；限制字段传 null 表示不限制
+    name: Optional[str] = None
+    rate_limit: Optional[float] = None
+    burst: Optional[int] = None
+    max_concurrency: Optional[int] = None
+    allowed_models: Optional[List[str]] = None
+
 class CookieResponse(BaseModel):
     id: int
     name: str
@@ -47,7 +73,7 @@ class CookieResponse(BaseModel):
 # ==================== 认证端点 ====================
 
 @router.post("/auth/verify", response_model=LoginResponse)
-async def verify_password(request: LoginRequest):
+def verify_password(request: LoginRequest):
     """验证管理密码并返回会话 token"""
     if not settings.API_MASTER_KEY:
         raise HTTPException(status_code=500, detail="服务器未配置管理密钥")
@@ -65,7 +91,7 @@ async def verify_password(request: LoginRequest):
         raise HTTPException(status_code=401, detail="密码错误")
 
 @router.post("/auth/logout")
-async def logout(token: str = Depends(verify_admin_session)):
+def logout(token: str = Depends(verify_admin_session)):
     """注销当前会话"""
     invalidate_session(token)
     return {"success": True, "message": "已注销"}
@@ -73,7 +99,7 @@ async def logout(token: str = Depends(verify_admin_session)):
 # ==================== Cookie 管理端点 ====================
 
 @router.get("/cookies")
-async def get_cookies(
+def get_cookies(
     token: str = Depends(verify_admin_session),
     db: Session = Depends(get_db)
 ):
@@ -92,15 +118,17 @@ async def get_cookies(
                 "usage_count": c.usage_count,
                 "last_used_at": c.last_used_at.isoformat() if c.last_used_at else None,
                 "created_at": c.created_at.isoformat(),
-                "updated_at": c.updated_at.isoformat()
+                "updated_at": c.updated_at.isoformat(),
+                "health": cookie_pool.health(c.id)
             }
             for c in cookies
         ],
-        "stats": stats
+        "stats": stats,
+        "upstream": cookie_pool.upstream_health()
     }
 
 @router.post("/cookies")
-async def create_cookie(
+def create_cookie(
     cookie: CookieCreate,
     token: str = Depends(verify_admin_session),
     db: Session = Depends(get_db)
@@ -109,9 +137,8 @@ async def create_cookie(
     try:
         db_cookie = crud.create_cookie(db, cookie.name, cookie.cookie_data)
         
-        # 触发配置重新加载
-        from app.core.config import reload_cookies_from_db
-        reload_cookies_from_db()
+        # 增量更新内存 Cookie 池
+        cookie_pool.sync(db_cookie)
         
         return {
             "success": True,
@@ -132,7 +159,7 @@ async def create_cookie(
         raise HTTPException(status_code=500, detail=f"创建失败: {str(e)}")
 
 @router.put("/cookies/{cookie_id}")
-async def update_cookie(
+def update_cookie(
     cookie_id: int,
     cookie: CookieUpdate,
     token: str = Depends(verify_admin_session),
@@ -150,9 +177,8 @@ async def update_cookie(
         if not db_cookie:
             raise HTTPException(status_code=404, detail="Cookie 不存在")
         
-        # 触发配置重新加载
-        from app.core.config import reload_cookies_from_db
-        reload_cookies_from_db()
+        # 增量更新内存 Cookie 池
+        cookie_pool.sync(db_cookie)
         
         return {
             "success": True,
@@ -173,7 +199,7 @@ async def update_cookie(
         raise HTTPException(status_code=500, detail=f"更新失败: {str(e)}")
 
 @router.delete("/cookies/{cookie_id}")
-async def delete_cookie(
+def delete_cookie(
     cookie_id: int,
     token: str = Depends(verify_admin_session),
     db: Session = Depends(get_db)
@@ -184,9 +210,8 @@ async def delete_cookie(
     if not success:
         raise HTTPException(status_code=404, detail="Cookie 不存在")
     
-    # 触发配置重新加载
-    from app.core.config import reload_cookies_from_db
-    reload_cookies_from_db()
+    # 从内存 Cookie 池移除
+    cookie_pool.remove(cookie_id)
     
     return {
         "success": True,
@@ -194,7 +219,7 @@ async def delete_cookie(
     }
 
 @router.patch("/cookies/{cookie_id}/toggle")
-async def toggle_cookie(
+def toggle_cookie(
     cookie_id: int,
     token: str = Depends(verify_admin_session),
     db: Session = Depends(get_db)
@@ -205,9 +230,8 @@ async def toggle_cookie(
     if not db_cookie:
         raise HTTPException(status_code=404, detail="Cookie 不存在")
     
-    # 触发配置重新加载
-    from app.core.config import reload_cookies_from_db
-    reload_cookies_from_db()
+    # 增量更新内存 Cookie 池
+    cookie_pool.sync(db_cookie)
     
     status = "启用" if db_cookie.is_active else "禁用"
     return {
@@ -221,7 +245,7 @@ async def toggle_cookie(
     }
 
 @router.get("/stats")
-async def get_stats(
+def get_stats(
     token: str = Depends(verify_admin_session),
     db: Session = Depends(get_db)
 ):
@@ -242,17 +266,139 @@ async def get_api_key(
         "api_key": settings.API_MASTER_KEY or "未配置"
     }
 
+# ==================== 客户端 API Key 端点 ====================
+
+def _api_key_dict(db_key, usage=None) -> dict:
+    return {
+        "id": db_key.id,
+        "name": db_key.name,
+        "key_prefix": db_key.key_prefix,
+        "is_active": db_key.is_active,
+        "rate_limit": db_key.rate_limit,
+        "burst": db_key.burst,
+        "max_concurrency": db_key.max_concurrency,
+        "allowed_models": json.loads(db_key.allowed_models) if db_key.allowed_models else None,
+        "created_at": db_key.created_at.isoformat(),
+        "updated_at": db_key.updated_at.isoformat(),
+        **({"usage": usage} if usage is not None else {})
+    }
+
+@router.get("/api-keys")
+def get_api_keys(
+    token: str = Depends(verify_admin_session),
+    db: Session = Depends(get_db)
+):
+    """获取所有客户端 API Key 及其用量（来自调用日志）"""
+    usage = crud.get_api_key_usage(db)
+    empty = {"calls": 0, "error_calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    return {
+        "success": True,
+        "data": [_api_key_dict(k, usage.get(k.id, empty)) for k in crud.get_all_api_keys(db)]
+    }
+
+@router.post("/api-keys")
+def create_api_key(
+    api_key: APIKeyCreate,
+    token: str = Depends(verify_admin_session),
+    db: Session = Depends(get_db)
+):
+    """创建客户端 API Key，明文密钥只在此时返回一次"""
+    try:
+        db_key, key = crud.create_api_key(db, **api_key.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "success": True,
+        "message": "API Key 创建成功，请立即保存，之后无法再次查看",
+        "data": {**_api_key_dict(db_key), "key": key}
+    }
+
+@router.put("/api-keys/{key_id}")
+def update_api_key(
+    key_id: int,
+    api_key: APIKeyUpdate,
+    token: str = Depends(verify_admin_session),
+    db: Session = Depends(get_db)
+):
+    """更新客户端 API Key 的名称和限制"""
+    fields = api_key.model_dump(exclude_unset=True)
+    try:
+        db_key = crud.update_api_key(db, key_id, **fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not db_key:
+        raise HTTPException(status_code=404, detail="API Key 不存在")
+    api_keys.invalidate()
+    return {"success": True, "message": "API Key 更新成功", "data": _api_key_dict(db_key)}
+
+@router.patch("/api-keys/{key_id}/toggle")
+def toggle_api_key(
+    key_id: int,
+    token: str = Depends(verify_admin_session),
+    db: Session = Depends(get_db)
+):
+    """切换客户端 API Key 启用/禁用状态"""
+    db_key = crud.toggle_api_key_status(db, key_id)
+    if not db_key:
+        raise HTTPException(status_code=404, detail="API Key 不存在")
+    api_keys.invalidate()
+    status = "启用" if db_key.is_active else "禁用"
+    return {"success": True, "message": f"API Key 已{status}", "data": _api_key_dict(db_key)}
+
+@router.delete("/api-keys/{key_id}")
+def delete_api_key(
+    key_id: int,
+    token: str = Depends(verify_admin_session),
+    db: Session = Depends(get_db)
+):
+    """删除客户端 API Key（调用日志保留）"""
+    if not crud.delete_api_key(db, key_id):
+        raise HTTPException(status_code=404, detail="API Key 不存在")
+    api_keys.invalidate()
+    return {"success": True, "message": "API Key 删除成功"}
+
 # ==================== 调用日志端点 ====================
 
+def _encode_cursor(log) -> str:
+    return base64.urlsafe_b64encode(f"{log.created_at.isoformat()}|{log.id}".encode()).decode()
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        created_at, log_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(log_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+
+def _utc(value: Optional[datetime]) -> Optional[datetime]:
+    """数据库中的时间是不带时区的 UTC，带时区的查询参数先换算成 UTC"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
 @router.get("/call-logs")
-async def get_call_logs(
+def get_call_logs(
     token: str = Depends(verify_admin_session),
     db: Session = Depends(get_db),
-    limit: int = 100,
-    cookie_id: Optional[int] = None
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    cookie_id: Optional[int] = None,
+    api_key_id: Optional[int] = None,
+    model: Optional[str] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
 ):
-    """获取 API 调用日志"""
-    logs = crud.get_call_logs(db, limit=limit, cookie_id=cookie_id)
+    """
+    获取 API 调用日志，按时间倒序分页：响应中的 next_cursor 作为下一页的 cursor 参数，为空表示没有更多。
+    可按 Cookie、API Key、模型、状态和创建时间区间 [since, until)（ISO 8601，不带时区时为 UTC）筛选
+    """
+    logs = crud.get_call_logs(
+        db, limit=limit + 1, cookie_id=cookie_id, api_key_id=api_key_id, model=model, status=status,
+        since=_utc(since), until=_utc(until), before=_decode_cursor(cursor) if cursor else None
+    )
+    # 多读一条判断是否还有下一页
+    has_more = len(logs) > limit
+    logs = logs[:limit]
     call_stats = crud.get_call_stats(db)
     
     return {
@@ -261,17 +407,110 @@ async def get_call_logs(
             {
                 "id": log.id,
                 "cookie_id": log.cookie_id,
-                "cookie_name": log.cookie.name if log.cookie else "未知",
+                "cookie_name": log.cookie.name if log.cookie else f"已删除（#{log.cookie_id}）",
+                "api_key_id": log.api_key_id,
+                "api_key_name": log.api_key.name if log.api_key else None,
                 "model": log.model,
                 "prompt_tokens": log.prompt_tokens,
                 "completion_tokens": log.completion_tokens,
                 "status": log.status,
                 "error_message": log.error_message,
                 "duration_ms": log.duration_ms,
+                "timings": json.loads(log.timings) if log.timings else None,
+                "coalesced": bool(log.coalesced),
                 "created_at": log.created_at.isoformat()
             }
             for log in logs
         ],
+        "next_cursor": _encode_cursor(logs[-1]) if has_more else None,
         "stats": call_stats
     }
 
+
+@router.get("/call-logs/writer")
+async def get_call_log_writer_stats(
+    token: str = Depends(verify_admin_session)
+):
+    """获取调用日志写入器状态（队列深度、丢弃数等）"""
+    return {
+        "success": True,
+        "data": call_log_writer.stats()
+    }
+
+@router.get("/call-logs/archive")
+async def get_call_log_archive_stats(
+    token: str = Depends(verify_admin_session)
+):
+    """获取调用日志归档状态（保留天数、已归档条数、归还的空闲页数等，为当前 worker 的数据）"""
+    return {
+        "success": True,
+        "data": call_log_archiver.stats()
+    }
+
+@router.post("/call-logs/archive")
+def run_call_log_archive(
+    token: str = Depends(verify_admin_session)
+):
+    """立即归档超过保留期的调用日志"""
+    if settings.CALL_LOG_RETENTION_DAYS <= 0:
+        raise HTTPException(status_code=400, detail="未启用调用日志归档（CALL_LOG_RETENTION_DAYS=0）")
+    result = call_log_archiver.run_once()
+    if result is None:
+        raise HTTPException(status_code=409, detail="归档正在进行中，或由其他 worker 负责执行")
+    return {
+        "success": True,
+        "data": result
+    }
+
+# ==================== 补全缓存端点 ====================
+
+@router.get("/cache")
+def get_cache_stats(
+    token: str = Depends(verify_admin_session)
+):
+    """获取补全缓存状态（命中率、条目数、占用字节数等，内存层为当前 worker 的数据）"""
+    return {
+        "success": True,
+        "data": response_cache.stats()
+    }
+
+@router.delete("/cache")
+def clear_cache(
+    token: str = Depends(verify_admin_session)
+):
+    """清空补全缓存（当前 worker 的内存层和共享的磁盘层）"""
+    response_cache.clear()
+    return {"success": True, "message": "缓存已清空"}
+
+@router.get("/single-flight")
+async def get_single_flight_stats(
+    token: str = Depends(verify_admin_session)
+):
+    """获取单飞合并状态（当前 worker 进行中的共享请求数、订阅者数和累计合并次数）"""
+    return {
+        "success": True,
+        "data": single_flight.stats()
+    }
+
+# ==================== 请求剖析端点 ====================
+
+@router.get("/profiles")
+def list_profiles(
+    token: str = Depends(verify_admin_session)
+):
+    """列出当前 worker 保存的请求剖析结果（请求头 X-Profile 开启，最新的在前）"""
+    return {
+        "success": True,
+        "data": profile_store.list()
+    }
+
+@router.get("/profiles/{profile_id}", response_class=PlainTextResponse)
+def get_profile(
+    profile_id: str,
+    token: str = Depends(verify_admin_session)
+):
+    """下载折叠栈格式的剖析结果，可用 flamegraph.pl 或 speedscope 生成火焰图"""
+    folded = profile_store.read(profile_id)
+    if folded is None:
+        raise HTTPException(status_code=404, detail="剖析结果不存在")
+    return PlainTextResponse(folded)
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from fastapi import HTTPException
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionPermit:
+    """一个已获准开始的请求占用的名额，请求（含流式输出）结束时调用 release()，可重复调用"""
+
+    __slots__ = ("_controller", "model", "granted_at", "waited", "_released")
+
+    def __init__(self, controller: "AdmissionController", model: Optional[str], waited: float):
+        self._controller = controller
+        self.model = model
+        self.granted_at = time.monotonic()
+        self.waited = waited
+        self._released = False
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._controller._release(self)
+
+
+class _Waiter:
+    __slots__ = ("model", "future", "enqueued_at")
+
+    def __init__(self, model: Optional[str], future: "asyncio.Future[AdmissionPermit]"):
+        self.model = model
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class AdmissionController:
+    """
+    补全请求的准入控制（每个 worker 独立计数）：全局并发上限 ADMISSION_MAX_CONCURRENCY、
+    按模型的并发上限 ADMISSION_MODEL_LIMITS，名额不足时进入容量为 ADMISSION_QUEUE_SIZE 的等待队列。
+    队列按到达顺序放行，但跳过所属模型已满的请求，某个模型排满不会挡住其他模型。
+    队列已满时立即返回 429；在截止时间内没有等到名额时返回 503，两者都带根据平均占用时长估算的 Retry-After。
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.active_by_model: Dict[str, int] = {}
+        self._queue: Deque[_Waiter] = deque()
+        # 名额平均占用时长（指数滑动平均），用于估算 Retry-After
+        self._hold_seconds = 1.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def _model_key(self, model: str) -> Optional[str]:
+        # 只为配置了上限的模型单独计数，请求中任意的模型名不会让计数表无限增长
+        return model if model in settings.ADMISSION_MODEL_LIMITS else None
+
+    def _has_capacity(self, model: Optional[str]) -> bool:
+        limit = settings.ADMISSION_MAX_CONCURRENCY
+        if limit and self.active >= limit:
+            return False
+        if model is not None and self.active_by_model.get(model, 0) >= settings.ADMISSION_MODEL_LIMITS[model]:
+            return False
+        return True
+
+    def _grant(self, model: Optional[str], waited: float) -> AdmissionPermit:
+        self.active += 1
+        if model is not None:
+            self.active_by_model[model] = self.active_by_model.get(model, 0) + 1
+        return AdmissionPermit(self, model, waited)
+
+    def _release(self, permit: AdmissionPermit) -> None:
+        self.active -= 1
+        if permit.model is not None:
+            self.active_by_model[permit.model] -= 1
+        held = time.monotonic() - permit.granted_at
+        self._hold_seconds += 0.1 * (held - self._hold_seconds)
+        self._wake()
+
+    def _wake(self) -> None:
+        """按到达顺序放行有名额的等待者，跳过已取消或已超时的"""
+        if not self._queue:
+            return
+        now = time.monotonic()
+        remaining: Deque[_Waiter] = deque()
+        while self._queue and self._has_capacity(None):
+            waiter = self._queue.popleft()
+            if waiter.future.done():
+                continue
+            if self._has_capacity(waiter.model):
+                waiter.future.set_result(self._grant(waiter.model, now - waiter.enqueued_at))
+            else:
+                remaining.append(waiter)
+        # 全局名额用完后，剩下的等待者保持原有顺序
+        remaining.extend(self._queue)
+        self._queue = remaining
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        waiter.future.cancel()
+        try:
+            self._queue.remove(waiter)
+        except ValueError:
+            pass
+
+    def active_counts(self) -> Dict[str, int]:
+        """按模型的占用名额数，未单独限制的模型合计为 other"""
+        counts = dict(self.active_by_model)
+        counts["other"] = self.active - sum(counts.values())
+        return counts
+
+    def retry_after(self) -> int:
+        """预计多少秒后有名额：排在前面的请求数 / 并发上限 × 平均占用时长"""
+        limit = settings.ADMISSION_MAX_CONCURRENCY or max(self.active, 1)
+        seconds = self._hold_seconds * (len(self._queue) + 1) / limit
+        return min(max(math.ceil(seconds), 1), 60)
+
+    def _reject(self, status_code: int, detail: str, model: str, reason: str) -> HTTPException:
+        from app.services.metrics import admission_rejected_total, model_label
+
+        admission_rejected_total.inc(model_label(model), reason)
+        return HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(self.retry_after())}
+        )
+
+    def deadline(self, header_value: Optional[str]) -> float:
+        """
+        排队最长等待时间（秒）：请求头 X-Queue-Timeout-Ms 给出时使用它（不超过 ADMISSION_MAX_QUEUE_TIMEOUT），
+        否则使用 ADMISSION_QUEUE_TIMEOUT；0 表示没有空闲名额时立即拒绝
+        """
+        if header_value:
+            try:
+                return min(max(float(header_value) / 1000, 0.0), settings.ADMISSION_MAX_QUEUE_TIMEOUT)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="X-Queue-Timeout-Ms 必须是毫秒数")
+        return settings.ADMISSION_QUEUE_TIMEOUT
+
+    async def acquire(self, model: str, timeout: float) -> AdmissionPermit:
+        """获取一个名额；无法在 timeout 秒内开始时抛出带 Retry-After 的 429/503"""
+        from app.services.metrics import admission_wait_seconds, model_label
+
+        key = self._model_key(model)
+        # 名额在放行时就已计入，排队者被唤醒前空出的名额不会被新请求抢走
+        if self._has_capacity(key):
+            admission_wait_seconds.observe(0.0, model_label(model))
+            return self._grant(key, 0.0)
+        if timeout <= 0:
+            raise self._reject(429, "服务繁忙：并发已达上限，请稍后重试。", model, "busy")
+        if len(self._queue) >= settings.ADMISSION_QUEUE_SIZE:
+            raise self._reject(429, "服务繁忙：等待队列已满，请稍后重试。", model, "queue_full")
+
+        future: "asyncio.Future[AdmissionPermit]" = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(key, future)
+        self._queue.append(waiter)
+        try:
+            permit = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # 超时的同时刚好被放行
+                permit = future.result()
+            else:
+                self._abandon(waiter)
+                waited = time.monotonic() - waiter.enqueued_at
+                admission_wait_seconds.observe(waited, model_label(model))
+                logger.warning(f"请求排队 {waited:.1f} 秒仍未获得名额（模型 {model}，队列 {len(self._queue)}）")
+                raise self._reject(503, "服务繁忙：排队超时，请稍后重试。", model, "timeout")
+        except asyncio.CancelledError:
+            # 客户端在排队时断开：已放行则归还名额，否则放弃排队
+            if future.done() and not future.cancelled():
+                future.result().release()
+            else:
+                self._abandon(waiter)
+            raise
+        admission_wait_seconds.observe(permit.waited, model_label(model))
+        return permit
+
+
+admission = AdmissionController()
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from typing import Any, Dict, FrozenSet, Optional, Tuple
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from app.core.config import settings
+from app.services.shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+# 共享状态中的版本号：管理接口修改 API Key 后递增，其他 worker 据此清空缓存
+VERSION_NAME = "api_keys"
+
+
+class APIKeyStream:
+    """一个客户端 API Key 正在进行的请求，结束时调用 release()，可重复调用；有并发限制时归还共享状态中的名额"""
+
+    __slots__ = ("_slot", "_released")
+
+    def __init__(self, slot: Optional[str]):
+        self._slot = slot
+        self._released = False
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        if self._slot is not None:
+            shared_state.call_soon(shared_state.release_slot, self._slot)
+
+
+class APIKeyEntry:
+    """
+    内存中的客户端 API Key 的限制参数（来自数据库，缓存），缓存刷新时原地更新。
+    令牌桶和进行中请求数保存在共享状态中（名称为 slot_name），所有 worker 合计按一个限制计算。
+    """
+
+    __slots__ = ("id", "name", "rate_limit", "burst", "max_concurrency", "allowed_models", "slot_name")
+
+    def __init__(self, key_id: int):
+        self.id = key_id
+        self.name = ""
+        self.rate_limit: Optional[float] = None
+        self.burst = 1
+        self.max_concurrency: Optional[int] = None
+        self.allowed_models: Optional[FrozenSet[str]] = None
+        self.slot_name = f"api_key:{key_id}"
+
+    def update(self, row: Dict[str, Any]) -> None:
+        self.name = row["name"]
+        self.rate_limit = row["rate_limit"]
+        self.burst = row["burst"] or max(math.ceil(self.rate_limit or 1), 1)
+        self.max_concurrency = row["max_concurrency"]
+        self.allowed_models = frozenset(json.loads(row["allowed_models"])) if row["allowed_models"] else None
+
+    def admit(self) -> Tuple[Optional[str], float]:
+        """
+        在共享状态中占用一个并发名额并取一个令牌（会阻塞的后端在线程池中调用）。
+        返回 (拒绝原因 concurrency/rate 或 None, 还需等待的秒数)；速率超限时归还刚占用的名额
+        """
+        if self.max_concurrency and not shared_state.acquire_slot(self.slot_name, self.max_concurrency):
+            return "concurrency", 0.0
+        wait = shared_state.take_token(self.slot_name, self.rate_limit, self.burst) if self.rate_limit else 0.0
+        if wait:
+            if self.max_concurrency:
+                shared_state.release_slot(self.slot_name)
+            return "rate", wait
+        return None, 0.0
+
+    def undo_admit(self, result: Tuple[Optional[str], float]) -> None:
+        """请求在等待 admit 时被取消（客户端断开），归还随后占用的名额"""
+        if result[0] is None and self.max_concurrency:
+            shared_state.release_slot(self.slot_name)
+
+
+class APIKeyRegistry:
+    """
+    客户端 API Key 的查找和限流。密钥按 SHA-256 查找，结果（包括不存在的密钥）缓存 API_KEY_CACHE_TTL 秒，
+    热路径上不访问数据库；管理接口修改后立即清空本 worker 的缓存，并通过共享状态的版本号通知其他 worker。
+    """
+
+    def __init__(self):
+        # 密钥哈希 -> (API Key ID 或 None, 过期时间)
+        self._cache: Dict[str, Tuple[Optional[int], float]] = {}
+        self._entries: Dict[int, APIKeyEntry] = {}
+        self._version = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def lookup(self, key: str) -> Optional[APIKeyEntry]:
+        """按明文密钥查找启用的 API Key，不存在或已禁用时返回 None"""
+        from app.db.crud import hash_api_key
+
+        key_hash = hash_api_key(key)
+        cached = self._cache.get(key_hash)
+        now = time.monotonic()
+        if cached is not None and cached[1] > now:
+            return self._entries.get(cached[0]) if cached[0] is not None else None
+
+        row = await run_in_threadpool(self._load, key_hash)
+        if len(self._cache) >= settings.API_KEY_CACHE_SIZE:
+            # 大量无效密钥（例如被扫描）时整体清空，避免缓存无限增长
+            self._cache.clear()
+        if row is None:
+            self._cache[key_hash] = (None, now + settings.API_KEY_CACHE_TTL)
+            return None
+        entry = self._entries.get(row["id"])
+        if entry is None:
+            entry = self._entries[row["id"]] = APIKeyEntry(row["id"])
+        entry.update(row)
+        self._cache[key_hash] = (entry.id, now + settings.API_KEY_CACHE_TTL)
+        return entry
+
+    @staticmethod
+    def _load(key_hash: str) -> Optional[Dict[str, Any]]:
+        from app.db.database import SessionLocal
+        from app.db import crud
+
+        db = SessionLocal()
+        try:
+            db_key = crud.get_api_key_by_hash(db, key_hash)
+            if db_key is None or not db_key.is_active:
+                return None
+            return {
+                "id": db_key.id,
+                "name": db_key.name,
+                "rate_limit": db_key.rate_limit,
+                "burst": db_key.burst,
+                "max_concurrency": db_key.max_concurrency,
+                "allowed_models": db_key.allowed_models,
+            }
+        finally:
+            db.close()
+
+    async def authorize(self, entry: APIKeyEntry, model: str) -> APIKeyStream:
+        """检查模型权限、速率和并发限制（所有 worker 合计），通过时返回占用的请求名额"""
+        from app.services.metrics import api_key_rejected_total
+
+        if entry.allowed_models is not None and model not in entry.allowed_models:
+            api_key_rejected_total.inc(entry.name, "model")
+            raise HTTPException(status_code=403, detail=f"此 API Key 无权使用模型 {model}")
+        if not entry.max_concurrency and not entry.rate_limit:
+            return APIKeyStream(None)
+        rejected, wait = await shared_state.call(entry.admit, undo=entry.undo_admit)
+        if rejected == "concurrency":
+            api_key_rejected_total.inc(entry.name, "concurrency")
+            raise HTTPException(
+                status_code=429,
+                detail=f"此 API Key 的并发请求数已达上限（{entry.max_concurrency}），请稍后重试。",
+                headers={"Retry-After": "1"}
+            )
+        if rejected == "rate":
+            api_key_rejected_total.inc(entry.name, "rate")
+            raise HTTPException(
+                status_code=429,
+                detail=f"此 API Key 的请求速率已达上限（{entry.rate_limit:g} 次/秒），请稍后重试。",
+                headers={"Retry-After": str(max(math.ceil(wait), 1))}
+            )
+        return APIKeyStream(entry.slot_name if entry.max_concurrency else None)
+
+    def invalidate(self) -> None:
+        """清空缓存（管理接口修改后调用），并通知其他 worker"""
+        self._cache.clear()
+        version = shared_state.bump_version(VERSION_NAME)
+        if version == self._version + 1:
+            self._version = version
+
+    def start(self) -> None:
+        if self._task is None:
+            self._version = shared_state.version(VERSION_NAME)
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self) -> None:
+        """其他 worker 修改了 API Key 时清空本地缓存（共享状态中的令牌桶和名额保留）"""
+        while True:
+            await asyncio.sleep(settings.STATE_SYNC_INTERVAL)
+            try:
+                version = await asyncio.to_thread(shared_state.version, VERSION_NAME)
+                if version != self._version:
+                    self._version = version
+                    self._cache.clear()
+            except Exception as e:
+                logger.warning(f"检查 API Key 变更失败: {e}")
+
+
+api_keys = APIKeyRegistry()
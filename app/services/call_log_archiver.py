@@ -0,0 +1,172 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+from app.services.shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAME = "call_log_archiver"
+
+
+class CallLogArchiver:
+    """
+    调用日志的保留策略：数据库只保留最近 CALL_LOG_RETENTION_DAYS 天的日志，
+    更早的日志按创建日期（UTC）追加到 CALL_LOG_ARCHIVE_DIR/YYYY/MM/api_call_logs-YYYY-MM-DD.jsonl.gz，
+    每批先写入并落盘再从数据库删除；删除后用 incremental_vacuum 分步把空闲页归还给文件系统。
+    进程在写入和删除之间退出时，下次运行会再次归档同一批日志，读取归档时按 id 去重即可。
+    多个 worker 时只有持有共享锁的一个执行。
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        # 后台任务和管理接口手动触发可能同时运行
+        self._lock = threading.Lock()
+        self.archived = 0
+        self.vacuumed_pages = 0
+        self.runs = 0
+        self.last_run_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    @staticmethod
+    def archive_dir() -> str:
+        if settings.CALL_LOG_ARCHIVE_DIR:
+            return settings.CALL_LOG_ARCHIVE_DIR
+        from app.db.database import DATABASE_DIR
+        return os.path.join(DATABASE_DIR, "call_log_archive")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "retention_days": settings.CALL_LOG_RETENTION_DAYS,
+            "archive_dir": self.archive_dir(),
+            "interval": settings.CALL_LOG_ARCHIVE_INTERVAL,
+            "running": self._lock.locked(),
+            "runs": self.runs,
+            "archived": self.archived,
+            "vacuumed_pages": self.vacuumed_pages,
+            "last_run_at": self.last_run_at,
+            "last_error": self.last_error,
+        }
+
+    def start(self) -> None:
+        if self._task is None and settings.CALL_LOG_RETENTION_DAYS > 0:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"调用日志归档任务已启动（保留 {settings.CALL_LOG_RETENTION_DAYS} 天）")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as e:
+                logger.error(f"调用日志归档失败: {e}", exc_info=True)
+            await asyncio.sleep(settings.CALL_LOG_ARCHIVE_INTERVAL)
+
+    def run_once(self) -> Optional[Dict[str, int]]:
+        """
+        归档一次（在线程中调用），返回本次归档的日志数和归还的页数；
+        本 worker 已有归档在进行或共享锁由其他 worker 持有时返回 None
+        """
+        if settings.CALL_LOG_RETENTION_DAYS <= 0 or not self._lock.acquire(blocking=False):
+            return None
+        if not shared_state.try_lock(LOCK_NAME, settings.CALL_LOG_ARCHIVE_INTERVAL * 3):
+            self._lock.release()
+            return None
+        try:
+            cutoff = datetime.utcnow() - timedelta(days=settings.CALL_LOG_RETENTION_DAYS)
+            try:
+                archived = self._archive_before(cutoff)
+                pages = self._vacuum() if archived else 0
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                raise
+            self.runs += 1
+            self.last_run_at = time.time()
+            if archived:
+                logger.info(f"已归档 {archived} 条 {cutoff:%Y-%m-%d %H:%M} 之前的调用日志，归还 {pages} 个空闲页")
+            return {"archived": archived, "vacuumed_pages": pages}
+        finally:
+            self._lock.release()
+
+    def _archive_before(self, cutoff: datetime) -> int:
+        from app.db.database import SessionLocal
+        from app.db import crud
+        from app.services.metrics import call_logs_archived_total
+
+        total = 0
+        while True:
+            db = SessionLocal()
+            try:
+                logs = crud.get_call_logs_before(db, cutoff, settings.CALL_LOG_ARCHIVE_BATCH_SIZE)
+                if not logs:
+                    return total
+                by_date: Dict[str, List[str]] = defaultdict(list)
+                for log in logs:
+                    by_date[log.created_at.strftime("%Y-%m-%d")].append(self._serialize(log))
+                for day, lines in by_date.items():
+                    self._append(day, lines)
+                crud.delete_call_logs(db, [log.id for log in logs])
+            finally:
+                db.close()
+            total += len(logs)
+            self.archived += len(logs)
+            call_logs_archived_total.inc(amount=len(logs))
+
+    @staticmethod
+    def _serialize(log) -> str:
+        row = {column.name: getattr(log, column.name) for column in log.__table__.columns}
+        row["created_at"] = log.created_at.isoformat()
+        return json.dumps(row, ensure_ascii=False, separators=(",", ":"))
+
+    def _append(self, day: str, lines: List[str]) -> None:
+        """以新的 gzip 成员追加到当天的归档文件（多成员 gzip 可以被 zcat 和 gzip 模块直接读取），并落盘"""
+        directory = os.path.join(self.archive_dir(), day[:4], day[5:7])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"api_call_logs-{day}.jsonl.gz"), "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as archive:
+                archive.write(("\n".join(lines) + "\n").encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+
+    def _vacuum(self) -> int:
+        """分步执行 incremental_vacuum，每步单独提交，期间日志写入器只需短暂等待写锁"""
+        from app.db.database import engine
+
+        pages = 0
+        with engine.connect() as conn:
+            if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+                logger.info("数据库未启用增量 auto_vacuum，删除日志空出的页留给新数据复用（运行 migrate_db.py 可以转换）")
+                return 0
+            free = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+            while free:
+                conn.exec_driver_sql(f"PRAGMA incremental_vacuum({settings.DB_INCREMENTAL_VACUUM_PAGES})")
+                conn.commit()
+                remaining = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+                if remaining >= free:
+                    break
+                pages += free - remaining
+                free = remaining
+            self.vacuumed_pages += pages
+            conn.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+        return pages
+
+
+call_log_archiver = CallLogArchiver()
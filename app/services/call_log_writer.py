@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CallLogWriter:
+    """
+    调用日志的后台批量写入器。
+    热路径只把日志放进队列；后台任务按批次写入数据库，
+    同一批内每个 Cookie 的使用计数合并为一条 UPDATE，关闭时写完剩余日志。
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=settings.LOG_WRITER_QUEUE_SIZE)
+        self._batch: List[Dict[str, Any]] = []
+        self._task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+
+    def submit(self, entry: Dict[str, Any]) -> None:
+        """提交一条日志，不阻塞；队列已满时丢弃并计数"""
+        entry.setdefault("created_at", datetime.utcnow())
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"调用日志队列已满，丢弃日志（累计丢弃 {self.dropped} 条）")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_size": self._queue.maxsize,
+            "dropped": self.dropped,
+            "written": self.written,
+            "batches": self.batches,
+            "batch_size": settings.LOG_WRITER_BATCH_SIZE,
+            "flush_interval": settings.LOG_WRITER_FLUSH_INTERVAL,
+        }
+
+    def start(self) -> None:
+        if self._task is None:
+            # 队列会绑定到首次等待它的事件循环，启动时换成新队列并带上启动前提交的日志
+            pending = self._queue
+            self._queue = asyncio.Queue(maxsize=settings.LOG_WRITER_QUEUE_SIZE)
+            while not pending.empty():
+                self._queue.put_nowait(pending.get_nowait())
+            self._task = asyncio.create_task(self._run())
+            logger.info("调用日志写入器已启动")
+
+    async def stop(self) -> None:
+        """停止后台任务并写完队列中剩余的日志"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info(f"调用日志写入器已停止，共写入 {self.written} 条，丢弃 {self.dropped} 条")
+
+    async def _run(self) -> None:
+        try:
+            while True:
+                await self._collect()
+                await self._flush()
+        except asyncio.CancelledError:
+            self._drain_nowait()
+            await self._flush()
+            raise
+
+    async def _collect(self) -> None:
+        """等待第一条日志，然后在刷新间隔内凑满一批"""
+        self._batch.append(await self._queue.get())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.LOG_WRITER_FLUSH_INTERVAL
+        batch_size = settings.LOG_WRITER_BATCH_SIZE
+        while len(self._batch) < batch_size:
+            self._drain_nowait(batch_size)
+            if len(self._batch) >= batch_size:
+                break
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                self._batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    def _drain_nowait(self, limit: Optional[int] = None) -> None:
+        while limit is None or len(self._batch) < limit:
+            try:
+                self._batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+    async def _flush(self) -> None:
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.dropped += len(batch)
+            logger.error(f"批量写入调用日志失败（{len(batch)} 条）: {e}")
+
+    @staticmethod
+    def _write_batch(batch: List[Dict[str, Any]]) -> None:
+        from app.db.database import SessionLocal
+        from app.db import crud
+
+        usage: Dict[int, Tuple[int, datetime]] = {}
+        for entry in batch:
+            if entry.get("coalesced"):
+                continue
+            count, last_used_at = usage.get(entry["cookie_id"], (0, entry["created_at"]))
+            usage[entry["cookie_id"]] = (count + 1, max(last_used_at, entry["created_at"]))
+
+        db = SessionLocal()
+        try:
+            crud.write_call_log_batch(db, batch, usage)
+        finally:
+            db.close()
+
+
+call_log_writer = CallLogWriter()
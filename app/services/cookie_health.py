@@ -0,0 +1,140 @@
+import time
+from typing import Any, Dict, Optional
+
+from app.core.config import settings
+
+# 熔断器状态
+CLOSED = "closed"  # 正常轮换
+OPEN = "open"  # 隔离中，退避结束前不参与选取
+HALF_OPEN = "half_open"  # 退避结束，只放行一个探测请求
+
+# 这些上游状态说明账号本身有问题，立即熔断，不等待连续失败次数
+AUTH_FAILURE_STATUSES = (401, 403)
+# 只有这些状态计入单个 Cookie 的熔断器；5xx 和网络错误是上游整体的故障，由 UpstreamBackoff 处理
+COOKIE_FAILURE_STATUSES = AUTH_FAILURE_STATUSES + (429,)
+
+
+def is_retriable_status(status_code: int) -> bool:
+    """该状态的失败是否应换下一个 Cookie 重试（认证、限流、上游/网络错误）"""
+    return status_code in COOKIE_FAILURE_STATUSES or status_code >= 500
+
+
+def is_cookie_failure(status_code: int) -> bool:
+    """该状态的失败是否归咎于 Cookie 本身（计入该 Cookie 的熔断器）"""
+    return status_code in COOKIE_FAILURE_STATUSES
+
+
+class CookieHealth:
+    """
+    单个 Cookie 的熔断状态机：closed -> open（指数退避）-> half_open（单个探测）。
+    探测成功回到 closed，失败则以翻倍的退避时间重新 open。
+    """
+    __slots__ = ("state", "failures", "open_until", "probe_in_flight", "last_status", "last_error")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.probe_in_flight = False
+        self.last_status: Optional[int] = None
+        self.last_error: Optional[str] = None
+
+    def available(self, now: float) -> bool:
+        """是否可以被选取；退避结束时转入 half_open"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if now < self.open_until:
+                return False
+            self.state = HALF_OPEN
+        return not self.probe_in_flight
+
+    def on_acquire(self) -> bool:
+        """选中后调用，返回本次请求是否为半开探测"""
+        if self.state == HALF_OPEN:
+            self.probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.probe_in_flight = False
+
+    def record_failure(self, status_code: int, error: str, now: float) -> None:
+        self.failures += 1
+        self.probe_in_flight = False
+        self.last_status = status_code
+        self.last_error = error
+        if (
+            self.state == HALF_OPEN
+            or status_code in AUTH_FAILURE_STATUSES
+            or self.failures >= settings.BREAKER_FAILURE_THRESHOLD
+        ):
+            backoff = min(
+                settings.BREAKER_BASE_BACKOFF * (2 ** max(self.failures - 1, 0)),
+                settings.BREAKER_MAX_BACKOFF
+            )
+            self.state = OPEN
+            self.open_until = now + backoff
+
+    def snapshot(self, now: Optional[float] = None) -> Dict[str, Any]:
+        now = time.monotonic() if now is None else now
+        retry_in = max(self.open_until - now, 0.0) if self.state == OPEN else 0.0
+        return {
+            "state": self.state,
+            "quarantined": self.state != CLOSED,
+            "consecutive_failures": self.failures,
+            "retry_in_seconds": round(retry_in, 1),
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+        }
+
+
+class UpstreamBackoff:
+    """
+    整个上游（所有 Cookie 共用）的退避。
+    5xx 和网络错误说明上游本身故障，换哪个 Cookie 都一样，因此不计入单个 Cookie 的熔断器，
+    否则上游整体故障期间故障转移会把所有 Cookie 依次隔离，上游恢复后仍要等各自的退避结束。
+    连续失败 UPSTREAM_BACKOFF_THRESHOLD 次后在退避期间直接拒绝新请求；退避结束后放行请求，
+    再次失败则退避时间翻倍，任意一次成功即恢复。
+    """
+    __slots__ = ("failures", "open_until", "last_status", "last_error")
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.last_status: Optional[int] = None
+        self.last_error: Optional[str] = None
+
+    def retry_in(self, now: float) -> float:
+        """距离退避结束的秒数，未在退避中时为 0"""
+        return max(self.open_until - now, 0.0)
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self, status_code: int, error: str, now: float) -> None:
+        self.failures += 1
+        self.last_status = status_code
+        self.last_error = error
+        threshold = max(settings.UPSTREAM_BACKOFF_THRESHOLD, 1)
+        if self.failures >= threshold:
+            backoff = min(
+                settings.UPSTREAM_BACKOFF_BASE * (2 ** (self.failures - threshold)),
+                settings.UPSTREAM_BACKOFF_MAX
+            )
+            self.open_until = max(self.open_until, now + backoff)
+
+    def snapshot(self, now: Optional[float] = None) -> Dict[str, Any]:
+        now = time.monotonic() if now is None else now
+        retry_in = self.retry_in(now)
+        return {
+            "backing_off": retry_in > 0,
+            "consecutive_failures": self.failures,
+            "retry_in_seconds": round(retry_in, 1),
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+        }
@@ -0,0 +1,321 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from app.core.config import settings, AuthCookie
+from app.services.cookie_health import CLOSED, CookieHealth, UpstreamBackoff
+from app.services.shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+# Cookie 池在共享状态中的版本号名称
+VERSION_NAME = "cookie_pool"
+
+
+class PooledCookie:
+    """
+    Cookie 池中的一项，保存热路径需要的全部数据。
+    请求头字符串和用户 ID 在入池时一次性解析，选取时无需再解码。
+    """
+    __slots__ = ("id", "name", "key", "header_cookie_string", "user_id", "expires_at", "refresh_token", "cookie_data")
+
+    def __init__(self, cookie_id: Optional[int], name: str, auth_cookie: AuthCookie, cookie_data: Optional[str] = None):
+        self.id = cookie_id
+        self.name = name
+        # 并发计数的键：数据库 Cookie 用 ID（改名、更新内容后计数不丢失），环境变量 Cookie 用名称；
+        # 统一为字符串，在所有 worker 的共享状态中一致
+        self.key = str(cookie_id) if cookie_id is not None else name
+        self.header_cookie_string = auth_cookie.header_cookie_string
+        self.user_id = auth_cookie.user_id
+        # 会话过期时间（Unix 秒）和 refresh_token，供后台续期使用
+        self.expires_at = auth_cookie.expires_at
+        self.refresh_token = auth_cookie.refresh_token
+        self.cookie_data = cookie_data
+
+    @classmethod
+    def from_db(cls, db_cookie) -> "PooledCookie":
+        return cls(db_cookie.id, db_cookie.name, AuthCookie(db_cookie.cookie_data), db_cookie.cookie_data)
+
+    def __repr__(self):
+        return f"<PooledCookie id={self.id} name='{self.name}' user_id={self.user_id}>"
+
+
+class CookieLease:
+    """
+    单个请求对 Cookie 的租约。
+    在整个流式响应期间持有，完成、出错或客户端断开时释放；release 可重复调用。
+    上游返回首字节前通过 succeed/fail/upstream_fail 向熔断器和上游退避报告结果。
+    """
+    __slots__ = ("cookie", "probe", "_pool", "_released")
+
+    def __init__(self, pool: "CookiePool", cookie: PooledCookie, probe: bool = False):
+        self.cookie = cookie
+        self.probe = probe  # 是否为半开状态下的探测请求
+        self._pool = pool
+        self._released = False
+
+    def succeed(self) -> None:
+        """上游已正常响应，关闭熔断器并结束上游退避（租约继续持有到流结束）"""
+        self._pool._health_for(self.cookie.key).record_success()
+        self._pool._upstream.record_success()
+        self.probe = False
+
+    def fail(self, status_code: int, error: str) -> None:
+        """上游在首字节前因 Cookie 本身的问题失败（401/403/429），记录到熔断器并释放租约"""
+        self._pool._health_for(self.cookie.key).record_failure(status_code, error, time.monotonic())
+        self.probe = False
+        logger.warning(f"Cookie {self.cookie.name} 上游失败（{status_code}），熔断状态: {self._pool.health(self.cookie)['state']}")
+        self.release()
+
+    def upstream_fail(self, status_code: int, error: str) -> None:
+        """上游在首字节前因自身故障失败（5xx/网络错误），记录到上游退避并释放租约，不影响该 Cookie 的熔断器"""
+        upstream = self._pool._upstream
+        upstream.record_failure(status_code, error, time.monotonic())
+        retry_in = upstream.retry_in(time.monotonic())
+        if retry_in > 0:
+            logger.warning(f"上游连续失败 {upstream.failures} 次（{status_code}），所有请求退避 {retry_in:.1f} 秒")
+        self.release()
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._pool._release(self.cookie.key, self.probe)
+
+    def __repr__(self):
+        return f"<CookieLease cookie={self.cookie!r} released={self._released}>"
+
+
+class CookiePool:
+    """
+    每个 worker 进程内的 Cookie 池。
+    启动时从数据库全量加载一次，之后只由管理端的增删改操作做增量更新；
+    数据库中没有启用的 Cookie 时回退到环境变量配置的 Cookie。
+    轮询位置和进行中的租约数保存在共享状态中，多个 worker 合起来按一个池调度；
+    某个 worker 变更池内容后递增共享版本号，其他 worker 轮询到后重新加载。
+    熔断状态和上游退避仍由每个 worker 各自维护。
+    """
+
+    def __init__(self):
+        self._cookies: Dict[int, PooledCookie] = {}
+        self._env_cookies: Tuple[PooledCookie, ...] = ()
+        # 轮询用的只读快照，每次变更时整体替换
+        self._snapshot: Tuple[PooledCookie, ...] = ()
+        # 管理端点在线程池中执行，变更池内容时加锁；热路径只读取快照，不加锁
+        self._lock = threading.Lock()
+        # 每个 Cookie 的熔断状态
+        self._health: Dict[str, CookieHealth] = {}
+        # 上游整体故障（5xx/网络错误）的退避，所有 Cookie 共用
+        self._upstream = UpstreamBackoff()
+        # 本 worker 已加载的共享版本号
+        self._version = 0
+        self._watch_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._snapshot)
+
+    def _rebuild_snapshot(self):
+        self._snapshot = tuple(self._cookies.values()) or self._env_cookies
+
+    def load(self):
+        """从数据库全量加载启用的 Cookie（启动时，以及其他 worker 变更了池内容后调用）"""
+        from app.db.database import SessionLocal
+        from app.db import crud
+
+        # 先读版本号，加载期间发生的变更会在下一轮重新加载
+        version = shared_state.version(VERSION_NAME)
+        cookies: Dict[int, PooledCookie] = {}
+        db = SessionLocal()
+        try:
+            for db_cookie in crud.get_active_cookies(db):
+                try:
+                    cookies[db_cookie.id] = PooledCookie.from_db(db_cookie)
+                except ValueError as e:
+                    logger.warning(f"无法解析数据库中的 Cookie {db_cookie.name}: {e}")
+        finally:
+            db.close()
+
+        # 环境变量 Cookie 始终保留一份，数据库 Cookie 全部被删除或禁用时回退使用
+        env_cookies = tuple(
+            PooledCookie(None, f"SMITHERY_COOKIE_{i}", auth_cookie)
+            for i, auth_cookie in enumerate(settings._load_cookies_from_env(), start=1)
+        )
+        with self._lock:
+            # 内容有变化的 Cookie 重置熔断状态，与 sync 一致
+            for cookie_id, pooled in cookies.items():
+                old = self._cookies.get(cookie_id)
+                if old is not None and old.cookie_data != pooled.cookie_data:
+                    self._health.pop(pooled.key, None)
+            self._cookies = cookies
+            self._env_cookies = env_cookies
+            self._version = version
+            self._rebuild_snapshot()
+        logger.info(f"Cookie 池加载完成，当前有 {len(self)} 个可用")
+
+    def sync(self, db_cookie) -> None:
+        """
+        根据数据库中 Cookie 的最新状态增量更新池（创建、更新、启用/禁用后调用）。
+        新条目整体替换旧条目，进行中的请求继续使用它们已拿到的旧条目。
+        """
+        if not db_cookie.is_active:
+            self.remove(db_cookie.id)
+            return
+        try:
+            pooled = PooledCookie.from_db(db_cookie)
+        except ValueError as e:
+            logger.warning(f"无法解析 Cookie {db_cookie.name}: {e}")
+            self.remove(db_cookie.id)
+            return
+        with self._lock:
+            self._cookies[db_cookie.id] = pooled
+            # 内容可能已更新（例如换了新的 Cookie 或续期了会话），重置熔断状态
+            self._health.pop(pooled.key, None)
+            self._rebuild_snapshot()
+        self._publish()
+        logger.info(f"Cookie 池已更新: {db_cookie.name} (ID: {db_cookie.id})，当前有 {len(self)} 个可用")
+
+    def remove(self, cookie_id: int) -> None:
+        """从池中移除 Cookie（删除或禁用后调用）"""
+        with self._lock:
+            removed = self._cookies.pop(cookie_id, None) is not None
+            self._health.pop(str(cookie_id), None)
+            if removed:
+                self._rebuild_snapshot()
+        if removed:
+            self._publish()
+            logger.info(f"Cookie 池已移除 ID: {cookie_id}，当前有 {len(self)} 个可用")
+
+    def _publish(self) -> None:
+        """通知其他 worker 重新加载；中间没有别的 worker 变更时本 worker 无需重新加载"""
+        version = shared_state.bump_version(VERSION_NAME)
+        with self._lock:
+            if version == self._version + 1:
+                self._version = version
+
+    def start(self) -> None:
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        if self._watch_task is None:
+            return
+        self._watch_task.cancel()
+        try:
+            await self._watch_task
+        except asyncio.CancelledError:
+            pass
+        self._watch_task = None
+        await asyncio.to_thread(shared_state.close)
+
+    async def _watch(self) -> None:
+        """定期发送心跳，并在其他 worker 变更池内容后重新加载"""
+        while True:
+            await asyncio.sleep(settings.STATE_SYNC_INTERVAL)
+            try:
+                await asyncio.to_thread(shared_state.heartbeat)
+                if await asyncio.to_thread(shared_state.version, VERSION_NAME) != self._version:
+                    logger.info("其他 worker 变更了 Cookie 池，重新加载")
+                    await asyncio.to_thread(self.load)
+            except Exception as e:
+                logger.error(f"同步共享状态失败: {e}", exc_info=True)
+
+    def get(self, cookie_id: int) -> Optional[PooledCookie]:
+        return self._cookies.get(cookie_id)
+
+    def all(self) -> List[PooledCookie]:
+        return list(self._snapshot)
+
+    def in_flight_counts(self) -> Dict[str, int]:
+        """所有 worker 合计的每个 Cookie 进行中的流数量"""
+        return shared_state.in_flight_counts()
+
+    def _health_for(self, key: str) -> CookieHealth:
+        health = self._health.get(key)
+        if health is None:
+            health = self._health[key] = CookieHealth()
+        return health
+
+    def health(self, cookie: Union[PooledCookie, int, str]) -> Dict[str, Any]:
+        """Cookie 的熔断状态（供管理端展示）"""
+        key = cookie.key if isinstance(cookie, PooledCookie) else str(cookie)
+        health = self._health.get(key)
+        return (health or CookieHealth()).snapshot()
+
+    def all_quarantined(self) -> bool:
+        """池中所有 Cookie 是否都处于熔断隔离（open 或正在半开探测）"""
+        snapshot = self._snapshot
+        health = self._health
+        return bool(snapshot) and all(
+            cookie.key in health and health[cookie.key].state != CLOSED for cookie in snapshot
+        )
+
+    def next_retry_in(self) -> float:
+        """距离最早一个被隔离的 Cookie 结束退避的秒数"""
+        now = time.monotonic()
+        waits = [h.open_until - now for h in self._health.values() if h.open_until > now]
+        return max(min(waits), 0.0) if waits else 0.0
+
+    def upstream_retry_in(self) -> float:
+        """距离上游退避结束的秒数，未在退避中时为 0"""
+        return self._upstream.retry_in(time.monotonic())
+
+    def upstream_health(self) -> Dict[str, Any]:
+        """上游退避状态（供管理端展示）"""
+        return self._upstream.snapshot()
+
+    async def acquire(self, exclude: Iterable[str] = ()) -> Optional[CookieLease]:
+        """
+        选取所有 worker 合计进行中请求最少的 Cookie 并返回租约，不访问主数据库也不做解码。
+        并列时从共享的轮询位置开始选取，使空闲账号之间依然均匀分布；
+        跳过 exclude 中的 Cookie（本次请求已失败过的）和熔断隔离中的 Cookie，
+        上游退避中、没有可用 Cookie 或都达到 COOKIE_MAX_CONCURRENCY 时返回 None。
+        """
+        health = self._health
+        if self._upstream.retry_in(time.monotonic()) > 0:
+            return None
+        exclude = set(exclude)
+        while True:
+            now = time.monotonic()
+            candidates: Dict[str, PooledCookie] = {}
+            for cookie in self._snapshot:
+                if cookie.key in exclude:
+                    continue
+                cookie_health = health.get(cookie.key)
+                if cookie_health is not None and not cookie_health.available(now):
+                    continue
+                candidates[cookie.key] = cookie
+            if not candidates:
+                return None
+
+            key = await shared_state.call(
+                shared_state.acquire, list(candidates), settings.COOKIE_MAX_CONCURRENCY, undo=self._undo_acquire
+            )
+            if key is None:
+                return None
+            best_health = health.get(key)
+            if best_health is not None and not best_health.available(time.monotonic()):
+                # 等待租约期间另一个请求已经占用了这个半开 Cookie 的探测名额（或探测失败重新隔离），
+                # 归还租约换其他 Cookie，不能把它当作普通请求发给仍可疑的 Cookie
+                shared_state.call_soon(shared_state.release, key)
+                exclude.add(key)
+                continue
+            probe = best_health.on_acquire() if best_health is not None else False
+            return CookieLease(self, candidates[key], probe)
+
+    @staticmethod
+    def _undo_acquire(key: Optional[str]) -> None:
+        """请求在等待租约时被取消（客户端断开），归还线程中随后占用的租约"""
+        if key is not None:
+            shared_state.release(key)
+
+    def _release(self, key: str, probe: bool = False) -> None:
+        if probe:
+            # 探测请求未得出结论（例如客户端提前断开），允许下一个请求继续探测
+            health = self._health.get(key)
+            if health is not None:
+                health.probe_in_flight = False
+        shared_state.call_soon(shared_state.release, key)
+
+
+cookie_pool = CookiePool()
@@ -0,0 +1,408 @@
+import asyncio
+import json
+import logging
+import threading
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+Labels = Tuple[str, ...]
+
+# Prometheus 文本格式 0.0.4
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Counter:
+    """
+    按标签值分组的计数器。只在事件循环线程中递增，不加锁：
+    一次递增是一次字典查找加一次整数加法。
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+    def snapshot(self) -> List[list]:
+        return [[list(labels), value] for labels, value in list(self._values.items())]
+
+
+class Histogram:
+    """
+    固定分桶的直方图：每组标签保存各桶的（非累计）计数和总和，导出时再累加。
+    thread_safe 为 True 时用锁保护，供线程池中的数据库调用使用；事件循环里的观测不加锁。
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Iterable[float],
+        labelnames: Tuple[str, ...] = (),
+        thread_safe: bool = False
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签：[各桶计数..., +Inf 桶计数, 总和]
+        self._series: Dict[Labels, List[float]] = {}
+        self._lock = threading.Lock() if thread_safe else None
+
+    def observe(self, value: float, *labels: str) -> None:
+        if self._lock is not None:
+            with self._lock:
+                self._observe(value, labels)
+        else:
+            self._observe(value, labels)
+
+    def _observe(self, value: float, labels: Labels) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def snapshot(self) -> List[list]:
+        return [[list(labels), list(series)] for labels, series in list(self._series.items())]
+
+
+class Gauge:
+    """抓取时由回调计算的瞬时值，回调返回 {标签值元组: 数值}"""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        shared: bool = False
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        # shared 为 True 表示数值本身已是所有 worker 的合计（来自共享状态），汇总时不再相加
+        self.shared = shared
+        self._callbacks: List[Callable[[], Dict[Labels, float]]] = []
+
+    def set_function(self, callback: Callable[[], Dict[Labels, float]]) -> None:
+        self._callbacks.append(callback)
+
+    def snapshot(self) -> List[list]:
+        values: Dict[Labels, float] = {}
+        for callback in self._callbacks:
+            try:
+                for labels, value in callback().items():
+                    values[labels] = values.get(labels, 0) + value
+            except Exception as e:
+                logger.debug(f"读取指标 {self.name} 失败: {e}")
+        return [[list(labels), value] for labels, value in values.items()]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表，/metrics 以 Prometheus 文本格式导出。
+    多 worker 时每个 worker 定期把自己的快照（JSON）发布到共享状态，
+    抓取时由处理请求的 worker 合并所有存活 worker 的快照：计数器和直方图相加，
+    worker 退出后它的计数从合计中消失，Prometheus 会把这当作一次计数器重置。
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._publish_task: Optional[asyncio.Task] = None
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, buckets: Iterable[float], labelnames: Tuple[str, ...] = (), thread_safe: bool = False) -> Histogram:
+        return self.register(Histogram(name, documentation, buckets, labelnames, thread_safe))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), shared: bool = False) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, shared))
+
+    def snapshot(self) -> Dict[str, List[list]]:
+        """本 worker 的指标快照；shared 的 gauge 只在抓取时读取，不随快照发布"""
+        return {
+            name: metric.snapshot()
+            for name, metric in self._metrics.items()
+            if not (metric.kind == "gauge" and metric.shared)
+        }
+
+    # ---------- 多 worker 汇总 ----------
+
+    @staticmethod
+    def _publishing() -> bool:
+        return settings.STATE_BACKEND.lower() != "memory"
+
+    def start(self):
+        """在后台定期发布本 worker 的快照（单进程的 memory 后端无需发布）"""
+        if self._publish_task is None and self._publishing():
+            self._publish_task = asyncio.create_task(self._publish_loop())
+
+    async def stop(self):
+        if self._publish_task is not None:
+            self._publish_task.cancel()
+            try:
+                await self._publish_task
+            except asyncio.CancelledError:
+                pass
+            self._publish_task = None
+
+    async def _publish_loop(self):
+        from app.services.shared_state import shared_state
+
+        while True:
+            try:
+                await asyncio.to_thread(shared_state.put_metrics, json.dumps(self.snapshot()))
+            except Exception as e:
+                logger.error(f"发布监控指标快照失败: {e}")
+            await asyncio.sleep(settings.METRICS_PUBLISH_INTERVAL)
+
+    async def collect(self) -> Dict[str, List[list]]:
+        """本 worker 的最新快照与其他存活 worker 最近发布的快照合并后的结果"""
+        merged = self.snapshot()
+        workers = 1
+        if self._publishing():
+            from app.services.shared_state import shared_state
+
+            try:
+                others = await asyncio.to_thread(shared_state.worker_metrics)
+            except Exception as e:
+                logger.error(f"读取其他 worker 的监控指标失败: {e}")
+                others = {}
+            for worker, payload in others.items():
+                if worker == shared_state.worker_id:
+                    continue
+                try:
+                    self._merge(merged, json.loads(payload))
+                except (ValueError, TypeError) as e:
+                    logger.warning(f"worker {worker} 的监控指标快照无法解析: {e}")
+                    continue
+                workers += 1
+        for name, metric in self._metrics.items():
+            if metric.kind == "gauge" and metric.shared:
+                merged[name] = metric.snapshot()
+        merged["smithery_workers"] = [[[], workers]]
+        return merged
+
+    @staticmethod
+    def _merge(into: Dict[str, List[list]], other: Dict[str, List[list]]) -> None:
+        for name, samples in other.items():
+            series = {tuple(labels): value for labels, value in into.get(name, [])}
+            for labels, value in samples:
+                key = tuple(labels)
+                current = series.get(key)
+                if current is None:
+                    series[key] = value
+                elif isinstance(value, list):
+                    series[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    series[key] = current + value
+            into[name] = [[list(labels), value] for labels, value in series.items()]
+
+    async def render(self) -> str:
+        """Prometheus 文本格式"""
+        collected = await self.collect()
+        lines: List[str] = [
+            "# HELP smithery_workers Number of worker processes included in these metrics.",
+            "# TYPE smithery_workers gauge",
+            f"smithery_workers {collected.pop('smithery_workers')[0][1]}",
+        ]
+        for name, metric in self._metrics.items():
+            samples = collected.get(name, [])
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for labels, value in sorted(samples, key=lambda sample: sample[0]):
+                if metric.kind != "histogram":
+                    lines.append(f"{name}{_format_labels(metric.labelnames, labels)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float("inf"),), value):
+                    cumulative += count
+                    le = f'le="{_format_value(bound)}"'
+                    lines.append(f"{name}_bucket{_format_labels(metric.labelnames, labels, le)} {_format_value(cumulative)}")
+                label_text = _format_labels(metric.labelnames, labels)
+                lines.append(f"{name}_sum{label_text} {_format_value(value[-1])}")
+                lines.append(f"{name}_count{label_text} {_format_value(cumulative)}")
+        return "\n".join(lines) + "\n"
+
+
+def model_label(model: str) -> str:
+    """模型标签只取已知模型，其余归为 other，避免客户端随意填写的模型名撑大指标基数"""
+    return model if model in settings.KNOWN_MODELS else "other"
+
+
+def statement_label(statement: str) -> str:
+    """数据库语句的类型（SELECT / INSERT / UPDATE / DELETE / other）"""
+    verb = statement.lstrip()[:6].upper()
+    return verb if verb in ("SELECT", "INSERT", "UPDATE", "DELETE") else "other"
+
+
+metrics = MetricsRegistry()
+
+requests_total = metrics.counter(
+    "smithery_requests_total",
+    "Chat completion requests by model and HTTP status.",
+    ("model", "status")
+)
+upstream_responses_total = metrics.counter(
+    "smithery_upstream_responses_total",
+    "Upstream chat responses by HTTP status (network_error when no response was received).",
+    ("status",)
+)
+ttfb_seconds = metrics.histogram(
+    "smithery_ttfb_seconds",
+    "Time from request start to the first upstream text delta.",
+    (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30),
+    ("model",)
+)
+inter_token_seconds = metrics.histogram(
+    "smithery_inter_token_seconds",
+    "Gap between consecutive upstream text deltas.",
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+    ("model",)
+)
+stream_duration_seconds = metrics.histogram(
+    "smithery_stream_duration_seconds",
+    "Duration of upstream streams by outcome (completed, error, cancelled).",
+    (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+    ("model", "outcome")
+)
+db_seconds = metrics.histogram(
+    "smithery_db_seconds",
+    "Database statement latency by statement type.",
+    (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+    ("operation",),
+    thread_safe=True
+)
+in_flight_streams = metrics.gauge(
+    "smithery_in_flight_streams",
+    "Streams currently holding a lease on each cookie, across all workers.",
+    ("cookie",),
+    shared=True
+)
+http_pool_connections = metrics.gauge(
+    "smithery_http_pool_connections",
+    "Upstream HTTP client pool connections by state (active, idle).",
+    ("state",)
+)
+http_pool_pending_requests = metrics.gauge(
+    "smithery_http_pool_pending_requests",
+    "Requests waiting for an upstream HTTP client pool connection."
+)
+
+admission_active = metrics.gauge(
+    "smithery_admission_active_requests",
+    "Admitted chat completion requests by model limit group (other for models without a limit).",
+    ("model",)
+)
+admission_queue_depth = metrics.gauge(
+    "smithery_admission_queue_depth",
+    "Requests waiting in the admission queue."
+)
+admission_wait_seconds = metrics.histogram(
+    "smithery_admission_wait_seconds",
+    "Time requests spent waiting for admission (including requests that timed out).",
+    (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    ("model",)
+)
+admission_rejected_total = metrics.counter(
+    "smithery_admission_rejected_total",
+    "Requests rejected by admission control by reason (busy, queue_full, timeout).",
+    ("model", "reason")
+)
+call_logs_archived_total = metrics.counter(
+    "smithery_call_logs_archived_total",
+    "Call log rows moved from the database to archive files."
+)
+api_key_rejected_total = metrics.counter(
+    "smithery_api_key_rejected_total",
+    "Requests rejected by per-key limits by key name and reason (model, rate, concurrency).",
+    ("key", "reason")
+)
+
+
+def _cookie_in_flight() -> Dict[Labels, float]:
+    from app.services.cookie_pool import cookie_pool
+
+    return {(str(key),): count for key, count in cookie_pool.in_flight_counts().items()}
+
+
+in_flight_streams.set_function(_cookie_in_flight)
+
+
+def _admission_active() -> Dict[Labels, float]:
+    from app.services.admission import admission
+
+    return {(model,): count for model, count in admission.active_counts().items()}
+
+
+def _admission_queue_depth() -> Dict[Labels, float]:
+    from app.services.admission import admission
+
+    return {(): admission.queue_depth}
+
+
+admission_active.set_function(_admission_active)
+admission_queue_depth.set_function(_admission_queue_depth)
+
+
+def register_http_client(client) -> None:
+    """导出 httpx.AsyncClient 连接池的使用情况（读取 httpcore 连接池的内部状态，取不到时不导出）"""
+
+    def _pool():
+        return getattr(getattr(client, "_transport", None), "_pool", None)
+
+    def _connections() -> Dict[Labels, float]:
+        pool = _pool()
+        if pool is None:
+            return {}
+        connections = list(getattr(pool, "connections", []))
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return {("active",): len(connections) - idle, ("idle",): idle}
+
+    def _pending() -> Dict[Labels, float]:
+        pool = _pool()
+        if pool is None:
+            return {}
+        requests = getattr(pool, "_requests", [])
+        return {(): sum(1 for request in requests if request.is_queued())}
+
+    http_pool_connections.set_function(_connections)
+    http_pool_pending_requests.set_function(_pending)
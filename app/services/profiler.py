@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    对事件循环线程做定时栈采样（sys._current_frames），不需要 C 扩展或外部工具。
+    结果是折叠栈格式（每行“根;...;叶 次数”），可直接交给 flamegraph.pl、speedscope 或 inferno 生成火焰图。
+    采样的是整个事件循环线程，期间同一 worker 上并发的其他请求也会出现在结果里；
+    事件循环空闲时的样本落在 select/epoll 上，表示在等待 I/O。
+    """
+
+    def __init__(self, interval: float, max_seconds: float):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.samples: Counter = Counter()
+        self.started_at = 0.0
+        self.duration = 0.0
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        start = time.perf_counter()
+        deadline = start + self.max_seconds
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+            if time.perf_counter() >= deadline:
+                logger.warning(f"请求剖析超过 {self.max_seconds} 秒，自动停止采样")
+                break
+        self.duration = time.perf_counter() - start
+
+    def stop(self) -> None:
+        """停止采样并等待采样线程退出（最多一个采样间隔），可重复调用"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class ProfileStore:
+    """
+    按请求保存的剖析结果：PROFILE_DIR 下每个请求一个 .folded 文件，
+    超过 PROFILE_MAX_FILES 个时删除最旧的。
+    """
+
+    SUFFIX = ".folded"
+
+    @property
+    def directory(self) -> str:
+        if settings.PROFILE_DIR:
+            return settings.PROFILE_DIR
+        from app.db.database import DATABASE_DIR
+
+        return os.path.join(DATABASE_DIR, "profiles")
+
+    def start(self) -> SamplingProfiler:
+        profiler = SamplingProfiler(settings.PROFILE_INTERVAL_MS / 1000, settings.PROFILE_MAX_SECONDS)
+        profiler.start()
+        return profiler
+
+    async def finish(self, profile_id: str, profiler: SamplingProfiler) -> None:
+        """停止采样并在线程池中写入文件"""
+        try:
+            await asyncio.to_thread(self._finish, profile_id, profiler)
+        except OSError as e:
+            logger.error(f"保存请求剖析结果 {profile_id} 失败: {e}")
+
+    def _finish(self, profile_id: str, profiler: SamplingProfiler) -> None:
+        profiler.stop()
+        directory = self.directory
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, profile_id + self.SUFFIX)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(profiler.folded())
+        logger.info(
+            f"请求剖析 {profile_id}: {sum(profiler.samples.values())} 个样本，{profiler.duration * 1000:.0f} ms，已保存到 {path}"
+        )
+        self._prune(directory)
+
+    def _prune(self, directory: str) -> None:
+        files = self._files(directory)
+        for name, _, _ in files[settings.PROFILE_MAX_FILES:]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+    def _files(self, directory: str) -> List[tuple]:
+        """(文件名, 修改时间, 大小)，最新的在前"""
+        try:
+            names = [name for name in os.listdir(directory) if name.endswith(self.SUFFIX)]
+        except FileNotFoundError:
+            return []
+        files = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            files.append((name, stat.st_mtime, stat.st_size))
+        return sorted(files, key=lambda item: item[1], reverse=True)
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [
+            {"id": name[:-len(self.SUFFIX)], "created_at": mtime, "bytes": size}
+            for name, mtime, size in self._files(self.directory)
+        ]
+
+    def read(self, profile_id: str) -> Optional[str]:
+        # ID 不能包含路径，避免读取目录外的文件
+        if os.path.basename(profile_id) != profile_id:
+            return None
+        path = os.path.join(self.directory, profile_id + self.SUFFIX)
+        try:
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+profile_store = ProfileStore()
@@ -0,0 +1,280 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# 参与缓存键计算的请求参数；目前上游不接收这些参数，但它们不同的请求不应共用一个结果
+CACHE_KEY_PARAMS = (
+    "temperature", "top_p", "max_tokens", "max_completion_tokens", "stop", "seed",
+    "n", "presence_penalty", "frequency_penalty", "response_format", "tools", "tool_choice",
+)
+
+# 请求级缓存指令
+DIRECTIVE_DEFAULT = "default"
+DIRECTIVE_BYPASS = "bypass"  # 不读也不写缓存
+DIRECTIVE_REFRESH = "refresh"  # 不读缓存，用新结果覆盖
+
+_TRUE_VALUES = ("1", "true", "yes", "on")
+
+# 每个条目除文本外的固定开销估算（字节）
+ENTRY_OVERHEAD = 200
+
+
+class CachedCompletion(NamedTuple):
+    content: str
+    finish_reason: str
+    usage: Dict[str, int]
+    expires_at: float
+    size: int
+
+
+def request_key(
+    model: str,
+    messages: List[Tuple[str, str]],
+    system_prompt: str,
+    request_data: Dict[str, Any]
+) -> str:
+    """
+    请求的规范哈希：模型、系统提示词、实际发给上游的 (role, text) 消息列表和相关参数的规范 JSON 的 SHA-256。
+    补全缓存和单飞合并共用这个键。
+    """
+    params = {name: request_data[name] for name in CACHE_KEY_PARAMS if request_data.get(name) is not None}
+    canonical = json.dumps(
+        {"model": model, "system": system_prompt, "messages": messages, "params": params},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def cache_directive(headers: Optional[Mapping[str, str]]) -> str:
+    """
+    从请求头解析缓存指令：X-Cache-Bypass / Cache-Control: no-store 跳过缓存，
+    X-Cache-Refresh / Cache-Control: no-cache 忽略已有结果并重新生成
+    """
+    if not headers:
+        return DIRECTIVE_DEFAULT
+    cache_control = (headers.get("cache-control") or "").lower()
+    if (headers.get("x-cache-bypass") or "").lower() in _TRUE_VALUES or "no-store" in cache_control:
+        return DIRECTIVE_BYPASS
+    if (headers.get("x-cache-refresh") or "").lower() in _TRUE_VALUES or "no-cache" in cache_control:
+        return DIRECTIVE_REFRESH
+    return DIRECTIVE_DEFAULT
+
+
+class DiskCacheTier:
+    """
+    磁盘缓存层：单个 SQLite 文件（WAL），同一主机上的 worker 共用。
+    按最近访问时间淘汰，总大小不超过 max_bytes；过期条目在读取和写入时清理。
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, body TEXT NOT NULL, size INTEGER NOT NULL,
+            expires_at REAL NOT NULL, accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_responses_accessed_at ON responses (accessed_at);
+        CREATE INDEX IF NOT EXISTS ix_responses_expires_at ON responses (expires_at);
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path,
+            timeout=settings.DB_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.executescript(self._SCHEMA)
+        logger.info(f"响应缓存磁盘层: {path}（上限 {max_bytes} 字节）")
+
+    def get(self, key: str, now: float) -> Optional[CachedCompletion]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body, size, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            body, size, expires_at = row
+            if expires_at <= now:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        data = json.loads(body)
+        return CachedCompletion(data["content"], data["finish_reason"], data["usage"], expires_at, size)
+
+    def put(self, key: str, entry: CachedCompletion, now: float) -> int:
+        """写入条目并按预算淘汰，返回淘汰的条目数"""
+        body = json.dumps(
+            {"content": entry.content, "finish_reason": entry.finish_reason, "usage": entry.usage},
+            ensure_ascii=False
+        )
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, body, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, body, entry.size, entry.expires_at, now)
+                )
+                evicted = self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,)).rowcount
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_bytes:
+                    # 按最近访问时间从旧到新删除，直到回到预算以内
+                    freed = 0
+                    victims = []
+                    for victim, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+                        if total - freed <= self.max_bytes:
+                            break
+                        victims.append((victim,))
+                        freed += size
+                    self._conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+                    evicted += len(victims)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        return evicted
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"path": self.path, "entries": entries, "bytes": total, "max_bytes": self.max_bytes}
+
+
+class ResponseCache:
+    """
+    确定性请求的补全结果缓存（RESPONSE_CACHE_MODE 开启），键为 request_key()。
+    内存层是按条目数和总字节数限制的 LRU，条目带 TTL；可选的磁盘层在内存未命中时查询并回填。
+    内存层每个 worker 一份，磁盘层在同一主机的 worker 之间共享。
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[str, CachedCompletion]" = OrderedDict()
+        self._bytes = 0
+        self._disk: Optional[DiskCacheTier] = None
+        self._counters = {
+            "hits": 0, "disk_hits": 0, "misses": 0, "stores": 0,
+            "evictions": 0, "bypass": 0, "refresh": 0, "uncacheable": 0,
+        }
+        if settings.RESPONSE_CACHE_MODE != "off" and settings.RESPONSE_CACHE_DISK_PATH:
+            try:
+                self._disk = DiskCacheTier(settings.RESPONSE_CACHE_DISK_PATH, settings.RESPONSE_CACHE_DISK_MAX_BYTES)
+            except sqlite3.Error as e:
+                logger.error(f"无法打开响应缓存磁盘层 {settings.RESPONSE_CACHE_DISK_PATH}: {e}，仅使用内存缓存")
+
+    @property
+    def enabled(self) -> bool:
+        return settings.RESPONSE_CACHE_MODE != "off"
+
+    def accepts(self, request_data: Dict[str, Any]) -> bool:
+        """缓存是否开启且请求可缓存（deterministic 模式下 temperature 必须为 0）"""
+        mode = settings.RESPONSE_CACHE_MODE
+        if mode == "off":
+            return False
+        if mode == "deterministic" and request_data.get("temperature") != 0:
+            self._counters["uncacheable"] += 1
+            return False
+        return True
+
+    def note_directive(self, directive: str) -> None:
+        if directive in (DIRECTIVE_BYPASS, DIRECTIVE_REFRESH):
+            self._counters[directive] += 1
+
+    async def get(self, key: str) -> Optional[CachedCompletion]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires_at > now:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return entry
+            self._remove(key)
+        if self._disk is not None:
+            try:
+                entry = await asyncio.to_thread(self._disk.get, key, now)
+            except sqlite3.Error as e:
+                logger.warning(f"读取响应缓存磁盘层失败: {e}")
+                entry = None
+            if entry is not None:
+                self._store(key, entry, now)
+                self._counters["disk_hits"] += 1
+                return entry
+        self._counters["misses"] += 1
+        return None
+
+    async def put(self, key: str, content: str, finish_reason: str, usage: Dict[str, int]) -> None:
+        now = time.time()
+        size = len(content.encode("utf-8")) + ENTRY_OVERHEAD
+        if size > settings.RESPONSE_CACHE_MAX_BYTES:
+            return
+        entry = CachedCompletion(content, finish_reason, dict(usage), now + settings.RESPONSE_CACHE_TTL, size)
+        self._store(key, entry, now)
+        self._counters["stores"] += 1
+        if self._disk is not None:
+            try:
+                self._counters["evictions"] += await asyncio.to_thread(self._disk.put, key, entry, now)
+            except sqlite3.Error as e:
+                logger.warning(f"写入响应缓存磁盘层失败: {e}")
+
+    def _store(self, key: str, entry: CachedCompletion, now: float) -> None:
+        self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        # 从最久未使用的一端淘汰：超出条目数或字节预算，或者已经过期
+        while self._entries:
+            oldest_key, oldest = next(iter(self._entries.items()))
+            if (
+                len(self._entries) <= settings.RESPONSE_CACHE_MAX_ENTRIES
+                and self._bytes <= settings.RESPONSE_CACHE_MAX_BYTES
+                and oldest.expires_at > now
+            ):
+                break
+            self._remove(oldest_key)
+            self._counters["evictions"] += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+        if self._disk is not None:
+            self._disk.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        counters = self._counters
+        hits = counters["hits"] + counters["disk_hits"]
+        lookups = hits + counters["misses"]
+        return {
+            "mode": settings.RESPONSE_CACHE_MODE,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": settings.RESPONSE_CACHE_MAX_ENTRIES,
+            "max_bytes": settings.RESPONSE_CACHE_MAX_BYTES,
+            "ttl": settings.RESPONSE_CACHE_TTL,
+            **counters,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "disk": self._disk.stats() if self._disk is not None else None,
+        }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,669 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from app.core.config import settings
+
+try:
+    import redis
+except ImportError:  # Redis 后端是可选的
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# 当前进程在共享状态中的标识；PID 可能被复用，附加随机后缀
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def _pick(keys: Sequence[str], rotation: int, count_of: Callable[[str], int], limit: int) -> Optional[str]:
+    """从轮询位置开始选取进行中请求最少的 key，跳过达到 limit 的（0 表示不限制）"""
+    size = len(keys)
+    start = rotation % size
+    best = None
+    best_count = 0
+    for offset in range(size):
+        key = keys[(start + offset) % size]
+        count = count_of(key)
+        if limit and count >= limit:
+            continue
+        if best is None or count < best_count:
+            best = key
+            best_count = count
+            if count == 0:
+                break
+    return best
+
+
+def _take_token(tokens: float, elapsed: float, rate: float, burst: int) -> Tuple[float, float]:
+    """令牌桶补充 elapsed 秒后取一个令牌，返回 (剩余令牌数, 还需等待的秒数)，等待为 0 表示取到"""
+    tokens = min(float(burst), tokens + max(elapsed, 0.0) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class SharedState:
+    """
+    worker 进程之间共享的状态：Cookie 轮询位置和进行中的租约数、客户端 API Key 的并发名额和令牌桶、管理员会话、
+    版本号（用于通知其他 worker 重新加载 Cookie 池）以及后台任务的主节点锁。
+    本类是单进程的内存实现（STATE_BACKEND=memory），同时定义了各后端的接口；
+    所有方法都是同步且线程安全的。SQLite 和 Redis 后端的调用会等待写锁或网络（blocking），
+    事件循环中的热路径通过 call/call_soon 把它们交给线程池，不阻塞整个 worker。
+    内存实现的会话可以保存到 session_file，重启后恢复。
+    """
+    backend = "memory"
+    # 调用是否可能阻塞（等待文件锁或网络）
+    blocking = False
+
+    def __init__(self, session_file: Optional[str] = None):
+        self.worker_id = WORKER_ID
+        self._lock = threading.Lock()
+        self._rotation = 0
+        self._in_flight: Dict[str, int] = {}
+        self._slots: Dict[str, int] = {}
+        # 令牌桶：名称 -> (令牌数, 补充时间)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._sessions: Dict[str, float] = {}
+        # 按过期时间排列的最小堆 (expires_at, token)；删除或覆盖会话时不修改堆，
+        # 清理时跳过与 _sessions 不一致的条目
+        self._session_heap: List[Tuple[float, str]] = []
+        self._versions: Dict[str, int] = {}
+        self._metrics: Dict[str, str] = {}
+        self._session_file = session_file
+        if session_file:
+            self._load_sessions()
+
+    # ---------- Cookie 租约 ----------
+
+    def acquire(self, keys: Sequence[str], limit: int) -> Optional[str]:
+        """
+        在候选 Cookie 中选取所有 worker 合计进行中请求最少的一个并占用，
+        并列时从共享的轮询位置开始选取；都达到 limit 时返回 None
+        """
+        with self._lock:
+            key = _pick(keys, self._rotation, lambda k: self._in_flight.get(k, 0), limit)
+            if key is not None:
+                self._rotation += 1
+                self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            return key
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            count = self._in_flight.get(key, 0) - 1
+            if count > 0:
+                self._in_flight[key] = count
+            else:
+                self._in_flight.pop(key, None)
+
+    def in_flight_counts(self) -> Dict[str, int]:
+        return dict(self._in_flight)
+
+    # ---------- 命名的并发名额和令牌桶（客户端 API Key 的限制） ----------
+
+    def acquire_slot(self, name: str, limit: int) -> bool:
+        """所有 worker 合计占用的名额小于 limit 时占用一个并返回 True（0 表示不限制）"""
+        with self._lock:
+            count = self._slots.get(name, 0)
+            if limit and count >= limit:
+                return False
+            self._slots[name] = count + 1
+            return True
+
+    def release_slot(self, name: str) -> None:
+        with self._lock:
+            count = self._slots.get(name, 0) - 1
+            if count > 0:
+                self._slots[name] = count
+            else:
+                self._slots.pop(name, None)
+
+    def take_token(self, name: str, rate: float, burst: int) -> float:
+        """从所有 worker 共用的令牌桶取一个令牌（每秒补充 rate 个，容量 burst），成功返回 0，否则返回还需等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            tokens, refilled_at = self._buckets.get(name, (float(burst), now))
+            tokens, wait = _take_token(tokens, now - refilled_at, rate, burst)
+            self._buckets[name] = (tokens, now)
+            return wait
+
+    # ---------- 在事件循环中调用 ----------
+
+    async def call(self, method: Callable, *args, undo: Optional[Callable] = None):
+        """
+        在事件循环中调用访问共享状态的函数：会阻塞的后端在线程池中执行。
+        等待期间被取消时线程中的调用仍会完成，undo 对它的结果做补偿（例如归还刚占用的租约）
+        """
+        if not self.blocking:
+            return method(*args)
+        future = asyncio.ensure_future(asyncio.to_thread(method, *args))
+        if undo is None:
+            return await future
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(
+                lambda done: done.cancelled() or done.exception() is not None or self.call_soon(undo, done.result())
+            )
+            raise
+
+    def call_soon(self, method: Callable, *args) -> None:
+        """在事件循环中调用访问共享状态的函数且不等待结果（释放租约和名额）：会阻塞的后端交给线程池执行"""
+        if not self.blocking:
+            method(*args)
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._call_logged(method, *args)
+            return
+        loop.run_in_executor(None, self._call_logged, method, *args)
+
+    @staticmethod
+    def _call_logged(method: Callable, *args) -> None:
+        try:
+            method(*args)
+        except Exception as e:
+            # 未释放的租约和名额在本 worker 退出或心跳超时后由其他 worker 回收
+            logger.error(f"共享状态 {method.__name__}{args} 失败: {e}")
+
+    # ---------- 管理员会话 ----------
+
+    def put_session(self, token: str, expires_at: float) -> None:
+        with self._lock:
+            self._sessions[token] = expires_at
+            heapq.heappush(self._session_heap, (expires_at, token))
+            self._compact_sessions()
+
+    def session_expires_at(self, token: str) -> Optional[float]:
+        """会话的过期时间（Unix 秒），不存在时返回 None"""
+        return self._sessions.get(token)
+
+    def delete_session(self, token: str) -> bool:
+        with self._lock:
+            removed = self._sessions.pop(token, None) is not None
+            self._compact_sessions()
+        return removed
+
+    def purge_sessions(self, now: float) -> int:
+        """删除已过期的会话，返回删除数量；只弹出堆顶已过期的条目，每个会话摊还 O(log n)"""
+        purged = 0
+        with self._lock:
+            heap = self._session_heap
+            sessions = self._sessions
+            while heap and heap[0][0] < now:
+                expires_at, token = heapq.heappop(heap)
+                if sessions.get(token) == expires_at:
+                    del sessions[token]
+                    purged += 1
+        return purged
+
+    def _compact_sessions(self) -> None:
+        """堆中失效条目多于有效条目时重建，保证堆的大小与会话数同阶"""
+        if len(self._session_heap) > 2 * len(self._sessions) + 64:
+            self._session_heap = [(expires_at, token) for token, expires_at in self._sessions.items()]
+            heapq.heapify(self._session_heap)
+
+    def _load_sessions(self) -> None:
+        try:
+            with open(self._session_file, encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"无法读取会话文件 {self._session_file}: {e}")
+            return
+        now = time.time()
+        for token, expires_at in saved.items():
+            if expires_at >= now:
+                self.put_session(token, expires_at)
+        logger.info(f"从 {self._session_file} 恢复了 {len(self._sessions)} 个管理会话")
+
+    def _save_sessions(self) -> None:
+        temp_file = f"{self._session_file}.tmp"
+        with self._lock:
+            sessions = dict(self._sessions)
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(sessions, f)
+        os.replace(temp_file, self._session_file)
+
+    # ---------- 版本号与主节点锁 ----------
+
+    def bump_version(self, name: str) -> int:
+        """递增并返回版本号，其他 worker 轮询到变化后重新加载对应数据"""
+        with self._lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+            return self._versions[name]
+
+    def version(self, name: str) -> int:
+        return self._versions.get(name, 0)
+
+    def try_lock(self, name: str, ttl: float) -> bool:
+        """获取或续期一个 ttl 秒后自动过期的锁，保证后台任务只在一个 worker 中运行"""
+        return True
+
+    # ---------- 监控指标 ----------
+
+    def put_metrics(self, snapshot: str) -> None:
+        """发布本 worker 的指标快照（JSON），/metrics 汇总所有存活 worker 的快照"""
+        self._metrics[self.worker_id] = snapshot
+
+    def worker_metrics(self) -> Dict[str, str]:
+        """所有存活 worker 最近发布的指标快照：worker -> JSON"""
+        return dict(self._metrics)
+
+    # ---------- worker 存活 ----------
+
+    def heartbeat(self) -> None:
+        """定期调用：登记本 worker 存活，并回收已退出的 worker 残留的租约和指标"""
+
+    def close(self) -> None:
+        """进程退出时调用，释放本 worker 持有的租约和锁"""
+        if self._session_file:
+            self._save_sessions()
+
+
+class SQLiteSharedState(SharedState):
+    """
+    基于独立 SQLite 文件（WAL）的共享状态，同一主机上的多个 worker 共用，无需额外服务。
+    每次租约操作是一个很短的 IMMEDIATE 写事务；租约按 worker 分行记录，
+    worker 异常退出后由其他 worker 根据心跳超时回收。
+    """
+    backend = "sqlite"
+    blocking = True
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS leases (
+            worker TEXT NOT NULL, cookie_key TEXT NOT NULL, count INTEGER NOT NULL,
+            PRIMARY KEY (worker, cookie_key)
+        );
+        CREATE TABLE IF NOT EXISTS slots (
+            worker TEXT NOT NULL, name TEXT NOT NULL, count INTEGER NOT NULL,
+            PRIMARY KEY (worker, name)
+        );
+        CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, refilled_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, seen_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS sessions (token TEXT PRIMARY KEY, expires_at REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS ix_sessions_expires_at ON sessions (expires_at);
+        CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS metrics (worker TEXT PRIMARY KEY, snapshot TEXT NOT NULL);
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        # 手动管理事务；连接在事件循环和线程池之间共用，由 self._lock 串行化
+        self._conn = sqlite3.connect(
+            path,
+            timeout=settings.DB_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._conn.executescript(self._SCHEMA)
+        self.heartbeat()
+        logger.info(f"共享状态使用 SQLite: {path}（worker {self.worker_id}）")
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _read(self, sql: str, params=()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def acquire(self, keys: Sequence[str], limit: int) -> Optional[str]:
+        with self._transaction() as db:
+            row = db.execute("SELECT value FROM counters WHERE name = 'rotation'").fetchone()
+            counts = dict(db.execute("SELECT cookie_key, SUM(count) FROM leases GROUP BY cookie_key"))
+            key = _pick(keys, row[0] if row else 0, lambda k: counts.get(k, 0), limit)
+            if key is not None:
+                db.execute(
+                    "INSERT INTO leases (worker, cookie_key, count) VALUES (?, ?, 1) "
+                    "ON CONFLICT (worker, cookie_key) DO UPDATE SET count = count + 1",
+                    (self.worker_id, key)
+                )
+                db.execute(
+                    "INSERT INTO counters (name, value) VALUES ('rotation', 1) "
+                    "ON CONFLICT (name) DO UPDATE SET value = value + 1"
+                )
+            return key
+
+    def release(self, key: str) -> None:
+        with self._transaction() as db:
+            db.execute("UPDATE leases SET count = count - 1 WHERE worker = ? AND cookie_key = ?", (self.worker_id, key))
+            db.execute("DELETE FROM leases WHERE worker = ? AND cookie_key = ? AND count <= 0", (self.worker_id, key))
+
+    def in_flight_counts(self) -> Dict[str, int]:
+        return dict(self._read("SELECT cookie_key, SUM(count) FROM leases GROUP BY cookie_key"))
+
+    def acquire_slot(self, name: str, limit: int) -> bool:
+        with self._transaction() as db:
+            count = db.execute("SELECT COALESCE(SUM(count), 0) FROM slots WHERE name = ?", (name,)).fetchone()[0]
+            if limit and count >= limit:
+                return False
+            db.execute(
+                "INSERT INTO slots (worker, name, count) VALUES (?, ?, 1) "
+                "ON CONFLICT (worker, name) DO UPDATE SET count = count + 1",
+                (self.worker_id, name)
+            )
+            return True
+
+    def release_slot(self, name: str) -> None:
+        with self._transaction() as db:
+            db.execute("UPDATE slots SET count = count - 1 WHERE worker = ? AND name = ?", (self.worker_id, name))
+            db.execute("DELETE FROM slots WHERE worker = ? AND name = ? AND count <= 0", (self.worker_id, name))
+
+    def take_token(self, name: str, rate: float, burst: int) -> float:
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT tokens, refilled_at FROM buckets WHERE name = ?", (name,)).fetchone()
+            tokens, refilled_at = row or (float(burst), now)
+            tokens, wait = _take_token(tokens, now - refilled_at, rate, burst)
+            db.execute("INSERT OR REPLACE INTO buckets (name, tokens, refilled_at) VALUES (?, ?, ?)", (name, tokens, now))
+            return wait
+
+    def put_session(self, token: str, expires_at: float) -> None:
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO sessions (token, expires_at) VALUES (?, ?)", (token, expires_at))
+
+    def session_expires_at(self, token: str) -> Optional[float]:
+        rows = self._read("SELECT expires_at FROM sessions WHERE token = ?", (token,))
+        return rows[0][0] if rows else None
+
+    def delete_session(self, token: str) -> bool:
+        with self._transaction() as db:
+            return db.execute("DELETE FROM sessions WHERE token = ?", (token,)).rowcount > 0
+
+    def purge_sessions(self, now: float) -> int:
+        with self._transaction() as db:
+            return db.execute("DELETE FROM sessions WHERE expires_at < ?", (now,)).rowcount
+
+    def bump_version(self, name: str) -> int:
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET value = value + 1",
+                (f"version:{name}",)
+            )
+            return db.execute("SELECT value FROM counters WHERE name = ?", (f"version:{name}",)).fetchone()[0]
+
+    def version(self, name: str) -> int:
+        rows = self._read("SELECT value FROM counters WHERE name = ?", (f"version:{name}",))
+        return rows[0][0] if rows else 0
+
+    def try_lock(self, name: str, ttl: float) -> bool:
+        now = time.time()
+        with self._transaction() as db:
+            return db.execute(
+                "INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE locks.owner = excluded.owner OR locks.expires_at < ?",
+                (name, self.worker_id, now + ttl, now)
+            ).rowcount > 0
+
+    def put_metrics(self, snapshot: str) -> None:
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO metrics (worker, snapshot) VALUES (?, ?)", (self.worker_id, snapshot))
+
+    def worker_metrics(self) -> Dict[str, str]:
+        return dict(self._read("SELECT worker, snapshot FROM metrics"))
+
+    def heartbeat(self) -> None:
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO workers (worker, seen_at) VALUES (?, ?) "
+                "ON CONFLICT (worker) DO UPDATE SET seen_at = excluded.seen_at",
+                (self.worker_id, now)
+            )
+            stale = [row[0] for row in db.execute(
+                "SELECT worker FROM workers WHERE seen_at < ?", (now - settings.STATE_WORKER_TTL,)
+            )]
+            for worker in stale:
+                db.execute("DELETE FROM leases WHERE worker = ?", (worker,))
+                db.execute("DELETE FROM slots WHERE worker = ?", (worker,))
+                db.execute("DELETE FROM metrics WHERE worker = ?", (worker,))
+                db.execute("DELETE FROM workers WHERE worker = ?", (worker,))
+        if stale:
+            logger.warning(f"回收了 {len(stale)} 个已退出 worker 的租约: {', '.join(stale)}")
+
+    def close(self) -> None:
+        with self._transaction() as db:
+            db.execute("DELETE FROM leases WHERE worker = ?", (self.worker_id,))
+            db.execute("DELETE FROM slots WHERE worker = ?", (self.worker_id,))
+            db.execute("DELETE FROM metrics WHERE worker = ?", (self.worker_id,))
+            db.execute("DELETE FROM workers WHERE worker = ?", (self.worker_id,))
+            db.execute("DELETE FROM locks WHERE owner = ?", (self.worker_id,))
+        self._conn.close()
+
+
+# 原子地选取并占用 Cookie，逻辑与 _pick 相同
+# KEYS: 全局计数 hash、本 worker 计数 hash、轮询计数；ARGV: limit、候选 key...
+_ACQUIRE_LUA = """
+local limit = tonumber(ARGV[1])
+local size = #ARGV - 1
+local start = tonumber(redis.call('GET', KEYS[3]) or '0') % size
+local best, best_count = nil, 0
+for offset = 0, size - 1 do
+    local key = ARGV[2 + (start + offset) % size]
+    local count = tonumber(redis.call('HGET', KEYS[1], key) or '0')
+    if (limit == 0 or count < limit) and (best == nil or count < best_count) then
+        best, best_count = key, count
+        if count == 0 then break end
+    end
+end
+if best == nil then return false end
+redis.call('INCR', KEYS[3])
+redis.call('HINCRBY', KEYS[1], best, 1)
+redis.call('HINCRBY', KEYS[2], best, 1)
+return best
+"""
+
+# KEYS: 全局计数 hash、本 worker 计数 hash；ARGV: key
+_RELEASE_LUA = """
+if tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0') <= 0 then return 0 end
+if redis.call('HINCRBY', KEYS[2], ARGV[1], -1) <= 0 then redis.call('HDEL', KEYS[2], ARGV[1]) end
+if redis.call('HINCRBY', KEYS[1], ARGV[1], -1) <= 0 then redis.call('HDEL', KEYS[1], ARGV[1]) end
+return 1
+"""
+
+# 把某个 worker 的租约从全局计数中扣除并删除；KEYS: 全局计数 hash、该 worker 计数 hash
+_REAP_LUA = """
+local counts = redis.call('HGETALL', KEYS[2])
+for i = 1, #counts, 2 do
+    if redis.call('HINCRBY', KEYS[1], counts[i], -tonumber(counts[i + 1])) <= 0 then
+        redis.call('HDEL', KEYS[1], counts[i])
+    end
+end
+redis.call('DEL', KEYS[2])
+return #counts / 2
+"""
+
+# KEYS: 全局名额 hash、本 worker 名额 hash；ARGV: 名称、limit
+_SLOT_LUA = """
+local limit = tonumber(ARGV[2])
+if limit > 0 and tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0') >= limit then return 0 end
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+return 1
+"""
+
+# 令牌桶，逻辑与 _take_token 相同；使用 Redis 服务器的时间，不受各主机时钟偏差影响，空闲到桶满后键自动过期
+# KEYS: 令牌桶 hash；ARGV: rate、burst；返回还需等待的秒数（字符串）
+_BUCKET_LUA = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'refilled_at')
+local tokens = tonumber(state[1]) or burst
+local refilled_at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - refilled_at, 0) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'refilled_at', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+# KEYS: 锁；ARGV: owner、过期毫秒数
+_LOCK_LUA = """
+local owner = redis.call('GET', KEYS[1])
+if owner == false or owner == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# 只删除自己持有的锁；KEYS: 锁；ARGV: owner
+_UNLOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+
+class RedisSharedState(SharedState):
+    """
+    基于 Redis 的共享状态，适用于跨主机部署。
+    租约的选取和占用、名额和令牌桶在 Lua 脚本中原子完成；会话使用 Redis 的键过期，无需清理。
+    """
+    backend = "redis"
+    blocking = True
+
+    def __init__(self, url: str):
+        super().__init__()
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        prefix = settings.STATE_REDIS_PREFIX
+        self._prefix = prefix
+        self._in_flight_key = f"{prefix}in_flight"
+        self._rotation_key = f"{prefix}rotation"
+        self._workers_key = f"{prefix}workers"
+        self._metrics_key = f"{prefix}metrics"
+        self._slots_key = f"{prefix}slots"
+        self._acquire_script = self._redis.register_script(_ACQUIRE_LUA)
+        self._release_script = self._redis.register_script(_RELEASE_LUA)
+        self._reap_script = self._redis.register_script(_REAP_LUA)
+        self._lock_script = self._redis.register_script(_LOCK_LUA)
+        self._unlock_script = self._redis.register_script(_UNLOCK_LUA)
+        # 本 worker 获取过的锁，退出时释放仍由自己持有的那些
+        self._lock_names: Set[str] = set()
+        self._slot_script = self._redis.register_script(_SLOT_LUA)
+        self._bucket_script = self._redis.register_script(_BUCKET_LUA)
+        self.heartbeat()
+        logger.info(f"共享状态使用 Redis: {url}（worker {self.worker_id}）")
+
+    def _worker_key(self, worker: str) -> str:
+        return f"{self._prefix}in_flight:{worker}"
+
+    def _worker_slots_key(self, worker: str) -> str:
+        return f"{self._prefix}slots:{worker}"
+
+    def acquire(self, keys: Sequence[str], limit: int) -> Optional[str]:
+        return self._acquire_script(
+            keys=[self._in_flight_key, self._worker_key(self.worker_id), self._rotation_key],
+            args=[limit, *keys]
+        )
+
+    def release(self, key: str) -> None:
+        self._release_script(keys=[self._in_flight_key, self._worker_key(self.worker_id)], args=[key])
+
+    def in_flight_counts(self) -> Dict[str, int]:
+        return {key: int(count) for key, count in self._redis.hgetall(self._in_flight_key).items()}
+
+    def acquire_slot(self, name: str, limit: int) -> bool:
+        return bool(self._slot_script(keys=[self._slots_key, self._worker_slots_key(self.worker_id)], args=[name, limit]))
+
+    def release_slot(self, name: str) -> None:
+        self._release_script(keys=[self._slots_key, self._worker_slots_key(self.worker_id)], args=[name])
+
+    def take_token(self, name: str, rate: float, burst: int) -> float:
+        return float(self._bucket_script(keys=[f"{self._prefix}bucket:{name}"], args=[rate, burst]))
+
+    def put_session(self, token: str, expires_at: float) -> None:
+        self._redis.set(f"{self._prefix}session:{token}", expires_at, exat=int(expires_at) + 1)
+
+    def session_expires_at(self, token: str) -> Optional[float]:
+        value = self._redis.get(f"{self._prefix}session:{token}")
+        return float(value) if value is not None else None
+
+    def delete_session(self, token: str) -> bool:
+        return self._redis.delete(f"{self._prefix}session:{token}") > 0
+
+    def purge_sessions(self, now: float) -> int:
+        return 0
+
+    def bump_version(self, name: str) -> int:
+        return self._redis.incr(f"{self._prefix}version:{name}")
+
+    def version(self, name: str) -> int:
+        return int(self._redis.get(f"{self._prefix}version:{name}") or 0)
+
+    def try_lock(self, name: str, ttl: float) -> bool:
+        locked = bool(self._lock_script(keys=[f"{self._prefix}lock:{name}"], args=[self.worker_id, int(ttl * 1000)]))
+        if locked:
+            self._lock_names.add(name)
+        return locked
+
+    def put_metrics(self, snapshot: str) -> None:
+        self._redis.hset(self._metrics_key, self.worker_id, snapshot)
+
+    def worker_metrics(self) -> Dict[str, str]:
+        return self._redis.hgetall(self._metrics_key)
+
+    def heartbeat(self) -> None:
+        now = time.time()
+        self._redis.zadd(self._workers_key, {self.worker_id: now})
+        stale = self._redis.zrangebyscore(self._workers_key, "-inf", now - settings.STATE_WORKER_TTL)
+        for worker in stale:
+            self._reap_script(keys=[self._in_flight_key, self._worker_key(worker)])
+            self._reap_script(keys=[self._slots_key, self._worker_slots_key(worker)])
+            self._redis.hdel(self._metrics_key, worker)
+            self._redis.zrem(self._workers_key, worker)
+        if stale:
+            logger.warning(f"回收了 {len(stale)} 个已退出 worker 的租约: {', '.join(stale)}")
+
+    def close(self) -> None:
+        self._reap_script(keys=[self._in_flight_key, self._worker_key(self.worker_id)])
+        self._reap_script(keys=[self._slots_key, self._worker_slots_key(self.worker_id)])
+        self._redis.hdel(self._metrics_key, self.worker_id)
+        self._redis.zrem(self._workers_key, self.worker_id)
+        # 其他 worker 不必等到 TTL 过期才能接手续期、归档等后台任务
+        for name in self._lock_names:
+            self._unlock_script(keys=[f"{self._prefix}lock:{name}"], args=[self.worker_id])
+        self._redis.close()
+
+
+def create_shared_state() -> SharedState:
+    """按 STATE_BACKEND 创建共享状态后端"""
+    backend = settings.STATE_BACKEND.lower()
+    if backend == "redis":
+        if redis is not None:
+            return RedisSharedState(settings.STATE_REDIS_URL)
+        logger.error("STATE_BACKEND=redis 但未安装 redis 包（pip install redis），改用本地 SQLite 共享状态")
+        backend = "sqlite"
+    if backend == "sqlite":
+        from app.db.database import DATABASE_DIR
+        return SQLiteSharedState(settings.STATE_SQLITE_PATH or os.path.join(DATABASE_DIR, "shared_state.db"))
+    if backend != "memory":
+        logger.warning(f"未知的 STATE_BACKEND: {settings.STATE_BACKEND}，使用进程内状态")
+    return SharedState(settings.STATE_SESSION_FILE)
+
+
+shared_state = create_shared_state()
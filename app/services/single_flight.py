@@ -0,0 +1,196 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Coroutine, Dict, List, Optional, Set
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriberTooSlow(Exception):
+    """订阅者读取落后于共享生成超过 SINGLE_FLIGHT_MAX_LAG_CHARS，已被断开"""
+
+
+class Flight:
+    """
+    一次共享的上游生成。生产者任务把增量追加到 parts，订阅者各自维护读取位置：
+    后加入的订阅者先一次性拿到已产生的全部文本，再跟随后续增量。
+    生产者从不等待订阅者，慢的订阅者只是落后于缓冲区，不会拖慢上游或其他订阅者；
+    落后超过 SINGLE_FLIGHT_MAX_LAG_CHARS 的订阅者被断开，继续读取时得到 SubscriberTooSlow。
+    最后一个订阅者离开时取消生产者，由生产者关闭上游连接并释放 Cookie 租约。
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.parts: List[str] = []
+        self.size = 0  # parts 的总字符数
+        self.done = False
+        self.finish_reason = "stop"
+        self.usage: Optional[Dict[str, int]] = None
+        self.error: Optional[BaseException] = None
+        # 领导者租用的 Cookie 和 prompt token 数，跟随者记录自己的调用日志时使用
+        self.cookie_id: Optional[int] = None
+        self.prompt_tokens = 0
+        # 上游连接建立（或失败）时完成，订阅者在此之前加入也会等待同一个结果
+        self.opened: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self._subscriptions: Set["FlightSubscription"] = set()
+        self.detached = 0  # 因读取过慢被断开的订阅者数
+        self._changed = asyncio.Event()
+        self._producer: Optional[asyncio.Task] = None
+
+    def _notify(self) -> None:
+        # 每次变化换一个新的 Event，等待中的订阅者都被唤醒，之后的等待不受影响
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscriptions)
+
+    def append(self, delta: str) -> None:
+        self.parts.append(delta)
+        self.size += len(delta)
+        limit = settings.SINGLE_FLIGHT_MAX_LAG_CHARS
+        if limit > 0:
+            slow = [s for s in self._subscriptions if self.size - s._caught_up > limit]
+            for subscription in slow:
+                subscription._detach()
+        self._notify()
+
+    def start(self, producer: Coroutine[Any, Any, None], cookie_id: Optional[int], prompt_tokens: int) -> None:
+        """上游已打开，开始在独立任务中读取，之后领导者的客户端断开也不影响其他订阅者"""
+        self.cookie_id = cookie_id
+        self.prompt_tokens = prompt_tokens
+        if not self.opened.done():
+            self.opened.set_result(None)
+        # 调用方在此之前已为领导者订阅，生产者第一次运行前不会因没有订阅者被取消
+        self._producer = asyncio.create_task(producer)
+
+    def finish(self, finish_reason: str, usage: Dict[str, int]) -> None:
+        self.finish_reason = finish_reason
+        self.usage = usage
+        self.done = True
+        self._notify()
+
+    def fail(self, error: BaseException) -> None:
+        self.error = error
+        self.done = True
+        if not self.opened.done():
+            self.opened.set_exception(error)
+            # 没有跟随者时也不要留下未取出的异常
+            self.opened.exception()
+        self._notify()
+
+    def subscribe(self) -> "FlightSubscription":
+        return FlightSubscription(self)
+
+    def _unsubscribe(self, subscription: "FlightSubscription") -> None:
+        self._subscriptions.discard(subscription)
+        if not self._subscriptions and not self.done and self._producer is not None:
+            logger.info(f"共享请求 {self.key[:12]} 的所有订阅者均已断开，取消上游读取")
+            self._producer.cancel()
+
+
+class FlightSubscription:
+    """一个客户端对共享生成的订阅，迭代得到增量文本；结束后必须调用 aclose()"""
+
+    def __init__(self, flight: Flight):
+        self.flight = flight
+        self._index = 0
+        # 最近一次读取时（或加入时）共享生成的字符数，落后量从这里算起；后加入时的回放不算落后
+        self._caught_up = flight.size
+        self._closed = False
+        self._detached = False
+        flight._subscriptions.add(self)
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self._iterate()
+
+    def received(self) -> List[str]:
+        """本订阅者已经读到的增量"""
+        return self.flight.parts[:self._index]
+
+    async def _iterate(self) -> AsyncIterator[str]:
+        flight = self.flight
+        await asyncio.shield(flight.opened)
+        while True:
+            if self._detached:
+                raise SubscriberTooSlow("客户端读取过慢，已与共享生成断开")
+            parts = flight.parts
+            if self._index < len(parts):
+                # 落后时把积压的增量合成一段，回放已产生的文本只需一帧
+                end = len(parts)
+                delta = parts[self._index] if end - self._index == 1 else "".join(parts[self._index:end])
+                self._index = end
+                self._caught_up = flight.size
+                yield delta
+                continue
+            if flight.done:
+                return
+            await flight._changed.wait()
+
+    def _detach(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._detached = True
+            self.flight.detached += 1
+            logger.warning(f"共享请求 {self.flight.key[:12]} 的一个订阅者读取过慢，已断开")
+            self.flight._unsubscribe(self)
+
+    async def aclose(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self.flight._unsubscribe(self)
+
+
+class SingleFlight:
+    """
+    相同请求的单飞合并（SINGLE_FLIGHT_MODE 开启）：同一时刻规范请求哈希相同的请求只打开一个上游流，
+    其余请求作为跟随者订阅它的输出。只在当前 worker 内合并。
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._counters = {"leaders": 0, "followers": 0, "detached": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return settings.SINGLE_FLIGHT_MODE != "off"
+
+    def accepts(self, request_data: Dict[str, Any]) -> bool:
+        """deterministic 模式下只合并 temperature 为 0 的请求，其余请求各自生成才符合预期"""
+        mode = settings.SINGLE_FLIGHT_MODE
+        if mode == "off":
+            return False
+        return mode == "all" or request_data.get("temperature") == 0
+
+    def join(self, key: str) -> Optional[FlightSubscription]:
+        """有相同请求正在进行时作为跟随者加入，否则返回 None"""
+        flight = self._flights.get(key)
+        if flight is None or flight.done:
+            return None
+        self._counters["followers"] += 1
+        return flight.subscribe()
+
+    def lead(self, key: str) -> Flight:
+        flight = Flight(key)
+        self._flights[key] = flight
+        self._counters["leaders"] += 1
+        return flight
+
+    def forget(self, flight: Flight) -> None:
+        """生成结束后移除，之后的相同请求重新生成（或命中补全缓存）"""
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+            self._counters["detached"] += flight.detached
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": settings.SINGLE_FLIGHT_MODE,
+            "in_flight": len(self._flights),
+            "subscribers": sum(flight.subscribers for flight in self._flights.values()),
+            **self._counters,
+        }
+
+
+single_flight = SingleFlight()
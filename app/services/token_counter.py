@@ -0,0 +1,237 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+from typing import Any, Dict, List
+
+from cachetools import LRUCache
+
+from app.core.config import settings
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken 是可选的，没有时用纯 Python 的 BPE 实现
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# cl100k 的预分词规则；Python re 不支持 \p{L}/\p{N}，分别用 [^\W\d_] 和 \d 近似
+_CL100K_PATTERN = (
+    r"""'(?i:[sdmt]|ll|ve|re)|(?:[^\r\n\w]|_)?[^\W\d_]+|\d{1,3}| ?(?:[^\s\w]|_)+[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
+)
+# tiktoken 使用的原始规则（支持 Unicode 属性）
+_CL100K_PAT_STR = (
+    r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s"""
+)
+_PIECE_RE = re.compile(_CL100K_PATTERN)
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]")
+
+# OpenAI 计算对话 token 时每条消息和回复引导的固定开销
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_REPLY_PRIMING = 3
+
+
+class TokenCounter:
+    """
+    文本 token 计数器的接口，同时也是不需要词表的估算实现（TOKENIZER=heuristic）：
+    按 cl100k 的规则预分词，再按片段类型估算——英文单词约每 7 个字母 1 个、
+    中日韩字符每字约 1.1 个、数字每 3 位 1 个、连续标点约每 4 个字符 1 个。
+    """
+    name = "heuristic"
+
+    def __init__(self):
+        # 预分词片段 -> token 数；对话中的单词高度重复，缓存后大部分片段只需查表
+        self._pieces: LRUCache = LRUCache(maxsize=65536)
+        # 长文本会在线程池中计数，LRUCache 本身不是线程安全的
+        self._lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        pieces = self._pieces
+        total = 0
+        with self._lock:
+            for piece in _PIECE_RE.findall(text):
+                tokens = pieces.get(piece)
+                if tokens is None:
+                    tokens = pieces[piece] = self._count_piece(piece)
+                total += tokens
+        return total
+
+    def _count_piece(self, piece: str) -> int:
+        word = piece.lstrip()
+        if not word or word.isdigit():
+            return 1
+        if word.isascii():
+            if word.isalpha():
+                return max(round(len(word) / 7), 1)
+            return max((len(piece) + 1) // 4, 1)
+        cjk = len(_CJK_RE.findall(word))
+        return max(math.ceil(cjk * 1.1 + (len(word) - cjk) / 3), 1)
+
+
+class BPETokenCounter(TokenCounter):
+    """
+    基于本地 BPE 词表（tiktoken 格式，每行 “base64 token + 空格 + rank”）的精确计数，不访问网络。
+    安装了 tiktoken 时用它编码；否则使用纯 Python 的合并算法，按预分词片段缓存结果。
+    """
+    name = "bpe"
+
+    def __init__(self, bpe_file: str):
+        super().__init__()
+        with open(bpe_file, "rb") as f:
+            self._ranks: Dict[bytes, int] = {
+                base64.b64decode(token): int(rank)
+                for token, rank in (line.split() for line in f if line.strip())
+            }
+        self._encoding = None
+        if tiktoken is not None:
+            self._encoding = tiktoken.Encoding(
+                name=os.path.basename(bpe_file),
+                pat_str=_CL100K_PAT_STR,
+                mergeable_ranks=self._ranks,
+                special_tokens={}
+            )
+            self.name = "bpe-tiktoken"
+        logger.info(f"已加载 BPE 词表 {bpe_file}（{len(self._ranks)} 个 token，{self.name}）")
+
+    def count(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode_ordinary(text)) if text else 0
+        return super().count(text)
+
+    def _count_piece(self, piece: str) -> int:
+        """按 rank 从小到大合并相邻字节串，返回合并结束后的片段数"""
+        ranks = self._ranks
+        data = piece.encode("utf-8")
+        if data in ranks:
+            return 1
+        parts = [data[i:i + 1] for i in range(len(data))]
+        while len(parts) > 1:
+            best_rank = None
+            best_index = -1
+            for i in range(len(parts) - 1):
+                rank = ranks.get(parts[i] + parts[i + 1])
+                if rank is not None and (best_rank is None or rank < best_rank):
+                    best_rank = rank
+                    best_index = i
+            if best_index < 0:
+                break
+            parts[best_index:best_index + 2] = [parts[best_index] + parts[best_index + 1]]
+        return len(parts)
+
+
+def _message_text(message: Dict[str, Any]) -> str:
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        # 多段内容只计算文本段，其余段按 JSON 计入
+        return "".join(
+            part.get("text", "") if isinstance(part, dict) and part.get("type") == "text"
+            else json.dumps(part, ensure_ascii=False, sort_keys=True)
+            for part in content
+        )
+    return "" if content is None else json.dumps(content, ensure_ascii=False, sort_keys=True)
+
+
+class UsageEstimator:
+    """
+    计算 OpenAI 格式的 prompt/completion token 数。
+    每条消息的 token 数按内容哈希缓存在 LRU 中，长对话每轮只需计算新增的消息；
+    未缓存的文本较长时放到线程池中计算，避免阻塞事件循环。
+    """
+
+    # 未缓存的字符数超过该值时在线程池中计算
+    OFFLOAD_CHARS = 4096
+
+    def __init__(self, counter: TokenCounter):
+        self.counter = counter
+        self._messages: LRUCache = LRUCache(maxsize=settings.TOKEN_COUNT_CACHE_SIZE)
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tokenizer": self.counter.name,
+            "cached_messages": len(self._messages),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    @staticmethod
+    def _message_key(message: Dict[str, Any]) -> bytes:
+        text = f"{message.get('role', '')}\0{message.get('name') or ''}\0{_message_text(message)}"
+        return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def _count_message(self, message: Dict[str, Any]) -> int:
+        tokens = TOKENS_PER_MESSAGE + self.counter.count(_message_text(message)) + self.counter.count(message.get("role") or "")
+        if message.get("name"):
+            tokens += TOKENS_PER_NAME + self.counter.count(message["name"])
+        return tokens
+
+    def _count_uncached(self, pending: Dict[bytes, Dict[str, Any]]) -> Dict[bytes, int]:
+        return {key: self._count_message(message) for key, message in pending.items()}
+
+    async def count_prompt(self, messages: List[Dict[str, Any]]) -> int:
+        """对话的 prompt token 数"""
+        total = TOKENS_REPLY_PRIMING
+        pending: Dict[bytes, Dict[str, Any]] = {}
+        keys = []
+        for message in messages:
+            if not isinstance(message, dict):
+                continue
+            key = self._message_key(message)
+            keys.append(key)
+            if key not in self._messages and key not in pending:
+                pending[key] = message
+        self.misses += len(pending)
+        self.hits += len(keys) - len(pending)
+
+        if pending:
+            if sum(len(_message_text(m)) for m in pending.values()) > self.OFFLOAD_CHARS:
+                counted = await asyncio.to_thread(self._count_uncached, pending)
+            else:
+                counted = self._count_uncached(pending)
+            self._messages.update(counted)
+        else:
+            counted = {}
+        for key in keys:
+            tokens = counted.get(key)
+            total += tokens if tokens is not None else self._messages.get(key, 0)
+        return total
+
+    async def count_completion(self, text: str) -> int:
+        """补全文本的 token 数，流结束后对完整文本计算一次，避免增量边界把一个 token 拆成两个"""
+        if len(text) > self.OFFLOAD_CHARS:
+            return await asyncio.to_thread(self.counter.count, text)
+        return self.counter.count(text)
+
+
+def bpe_file_path() -> str:
+    from app.db.database import DATABASE_DIR
+    return settings.TOKENIZER_BPE_FILE or os.path.join(DATABASE_DIR, "cl100k_base.tiktoken")
+
+
+def create_token_counter() -> TokenCounter:
+    """按 TOKENIZER 创建计数器：auto 时有本地 BPE 词表就用它，否则使用估算"""
+    tokenizer = settings.TOKENIZER.lower()
+    if tokenizer in ("auto", "bpe"):
+        bpe_file = bpe_file_path()
+        if os.path.exists(bpe_file):
+            try:
+                return BPETokenCounter(bpe_file)
+            except (OSError, ValueError) as e:
+                logger.error(f"无法加载 BPE 词表 {bpe_file}: {e}，改用估算")
+        elif tokenizer == "bpe":
+            logger.error(f"BPE 词表不存在: {bpe_file}，改用估算")
+    return TokenCounter()
+
+
+usage_estimator = UsageEstimator(create_token_counter())
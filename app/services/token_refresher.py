@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set
+
+import httpx
+
+from app.core.config import settings, decode_session, encode_session
+from app.services.cookie_pool import cookie_pool, PooledCookie
+from app.services.shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+
+class TokenRefresher:
+    """
+    Supabase 会话的后台续期任务。
+    定期检查池中每个数据库 Cookie 的 expires_at，在过期前 TOKEN_REFRESH_MARGIN 秒
+    用 refresh_token 换取新会话，写回 smithery_cookies.cookie_data 并原子替换池中的条目，
+    热路径因此不会遇到过期 Cookie 导致的 401 和重试。
+    环境变量配置的 Cookie 无法写回，不参与续期。
+    多个 worker 时只有持有共享锁的一个 worker 执行续期，避免同一个 refresh_token 被重复使用。
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._refreshing: Set[int] = set()
+        # 续期失败的 Cookie 在此时间（Unix 秒）之前不再重试
+        self._retry_after: Dict[int, float] = {}
+        self.refreshed = 0
+        self.failed = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": settings.TOKEN_REFRESH_ENABLED,
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "refreshing": len(self._refreshing),
+        }
+
+    def start(self) -> None:
+        if self._task is None and settings.TOKEN_REFRESH_ENABLED:
+            self._client = httpx.AsyncClient(timeout=httpx.Timeout(15.0, connect=5.0))
+            self._task = asyncio.create_task(self._run())
+            logger.info("会话自动续期任务已启动")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._client.aclose()
+        self._client = None
+        logger.info("会话自动续期任务已停止")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh_due()
+            except Exception as e:
+                logger.error(f"会话续期检查失败: {e}", exc_info=True)
+            await asyncio.sleep(settings.TOKEN_REFRESH_INTERVAL)
+
+    def _due_cookies(self, now: float) -> List[PooledCookie]:
+        due = []
+        for cookie in cookie_pool.all():
+            if cookie.id is None or not cookie.refresh_token or not cookie.expires_at:
+                continue
+            if cookie.id in self._refreshing or self._retry_after.get(cookie.id, 0) > now:
+                continue
+            if cookie.expires_at - now <= settings.TOKEN_REFRESH_MARGIN:
+                due.append(cookie)
+        return due
+
+    async def refresh_due(self) -> int:
+        """续期所有即将过期的 Cookie，并发数受 TOKEN_REFRESH_CONCURRENCY 限制，返回成功数量"""
+        # 锁的有效期覆盖几个检查间隔，持有者退出后由其他 worker 接替
+        if not await asyncio.to_thread(shared_state.try_lock, "token_refresher", settings.TOKEN_REFRESH_INTERVAL * 3):
+            return 0
+        due = self._due_cookies(time.time())
+        if not due:
+            return 0
+        semaphore = asyncio.Semaphore(max(settings.TOKEN_REFRESH_CONCURRENCY, 1))
+
+        async def guarded(cookie: PooledCookie) -> bool:
+            async with semaphore:
+                return await self.refresh(cookie)
+
+        results = await asyncio.gather(*(guarded(cookie) for cookie in due))
+        return sum(results)
+
+    async def refresh(self, cookie: PooledCookie) -> bool:
+        """用 refresh_token 换取新会话并写回，成功返回 True"""
+        self._refreshing.add(cookie.id)
+        try:
+            response = await self._client.post(
+                settings.TOKEN_REFRESH_URL,
+                headers={
+                    "apikey": settings.SUPABASE_API_KEY,
+                    "Authorization": f"Bearer {settings.SUPABASE_API_KEY}",
+                    "Content-Type": "application/json"
+                },
+                json={"refresh_token": cookie.refresh_token}
+            )
+            if response.status_code != 200:
+                raise ValueError(f"HTTP {response.status_code}: {response.text[:200]}")
+            session = response.json()
+            if not session.get("access_token") or not session.get("refresh_token"):
+                raise ValueError("响应中缺少 access_token 或 refresh_token")
+            if not session.get("expires_at") and session.get("expires_in"):
+                session["expires_at"] = int(time.time()) + int(session["expires_in"])
+
+            # 保留原会话中的其他字段（例如 user），用新令牌覆盖
+            merged = {**(decode_session(cookie.cookie_data) or {}), **session}
+            new_cookie_data = encode_session(merged, like=cookie.cookie_data)
+            db_cookie = await asyncio.to_thread(self._write_back, cookie.id, cookie.cookie_data, new_cookie_data)
+            if db_cookie is None:
+                logger.info(f"Cookie {cookie.name} 在续期期间已被修改或删除，放弃写回")
+                return False
+
+            # sync 会递增共享状态中的版本号，不能在事件循环上执行
+            await asyncio.to_thread(cookie_pool.sync, db_cookie)
+            self._retry_after.pop(cookie.id, None)
+            self.refreshed += 1
+            logger.info(f"Cookie {cookie.name} 会话已续期，新的过期时间: {merged.get('expires_at')}")
+            return True
+        except Exception as e:
+            self.failed += 1
+            self._retry_after[cookie.id] = time.time() + settings.TOKEN_REFRESH_RETRY_DELAY
+            logger.warning(f"Cookie {cookie.name} 会话续期失败: {e}")
+            return False
+        finally:
+            self._refreshing.discard(cookie.id)
+
+    @staticmethod
+    def _write_back(cookie_id: int, old_cookie_data: str, new_cookie_data: str):
+        """仅当数据库中的内容仍是续期前的值时写回，避免覆盖管理员的并发修改"""
+        from app.db.database import SessionLocal
+        from app.db import crud
+
+        db = SessionLocal()
+        try:
+            db_cookie = crud.get_cookie_by_id(db, cookie_id)
+            if db_cookie is None or db_cookie.cookie_data != old_cookie_data:
+                return None
+            return crud.update_cookie(db, cookie_id, cookie_data=new_cookie_data)
+        finally:
+            db.close()
+
+
+token_refresher = TokenRefresher()
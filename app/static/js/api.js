@@ -108,13 +108,16 @@ async function getApiKey() {
 }
 
 /**
- * 获取调用日志
+ * 获取调用日志（cursor 为上一页响应中的 next_cursor）
  */
-async function getCallLogs(limit = 100, cookieId = null) {
+async function getCallLogs(limit = 100, cookieId = null, cursor = null) {
     let url = `${API_BASE}/call-logs?limit=${limit}`;
     if (cookieId) {
         url += `&cookie_id=${cookieId}`;
     }
+    if (cursor) {
+        url += `&cursor=${encodeURIComponent(cursor)}`;
+    }
     return await apiRequest(url);
 }
 
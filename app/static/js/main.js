@@ -2,6 +2,7 @@
 
 let currentApiKey = '';
 let currentTab = 'cookie';
+let logCursor = null;
 
 // 页面加载时检查登录状态
 document.addEventListener('DOMContentLoaded', () => {
@@ -124,6 +125,9 @@ function renderCookieCards(cookies) {
                         ? '<span class="badge badge-success gap-2"><svg xmlns="http://www.w3.org/2000/svg" class="h-4 w-4" fill="none" viewBox="0 0 24 24" stroke="currentColor"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M9 12l2 2 4-4m6 2a9 9 0 11-18 0 9 9 0 0118 0z" /></svg>启用</span>' 
                         : '<span class="badge badge-warning gap-2"><svg xmlns="http://www.w3.org/2000/svg" class="h-4 w-4" fill="none" viewBox="0 0 24 24" stroke="currentColor"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M10 9v6m4-6v6m7-3a9 9 0 11-18 0 9 9 0 0118 0z" /></svg>禁用</span>'}
                 </div>
+                ${cookie.health && cookie.health.quarantined
+                    ? `<div class="badge badge-error mt-1" title="${escapeHtml(cookie.health.last_error || '')}">熔断隔离中（HTTP ${cookie.health.last_status}，${cookie.health.retry_in_seconds}s 后重试）</div>`
+                    : ''}
                 
                 <div class="divider my-2"></div>
                 
@@ -249,12 +253,37 @@ async function loadLogs() {
         
         if (response.success) {
             renderLogTable(response.data);
+            updateLogCursor(response.next_cursor);
         }
     } catch (error) {
         showNotification('加载日志失败: ' + error.message, 'error');
     }
 }
 
+/**
+ * 加载下一页日志，追加到表格末尾
+ */
+async function loadMoreLogs() {
+    if (!logCursor) {
+        return;
+    }
+    try {
+        const response = await getCallLogs(100, null, logCursor);
+        
+        if (response.success) {
+            renderLogTable(response.data, true);
+            updateLogCursor(response.next_cursor);
+        }
+    } catch (error) {
+        showNotification('加载日志失败: ' + error.message, 'error');
+    }
+}
+
+function updateLogCursor(cursor) {
+    logCursor = cursor;
+    document.getElementById('loadMoreLogs').classList.toggle('hidden', !cursor);
+}
+
 /**
  * 刷新日志
  */
@@ -265,10 +294,10 @@ function refreshLogs() {
 /**
  * 渲染日志表格
  */
-function renderLogTable(logs) {
+function renderLogTable(logs, append = false) {
     const tbody = document.getElementById('logTableBody');
     
-    if (logs.length === 0) {
+    if (logs.length === 0 && !append) {
         tbody.innerHTML = `
             <tr>
                 <td colspan="6" class="text-center text-base-content/60 py-8">
@@ -282,7 +311,7 @@ function renderLogTable(logs) {
         return;
     }
     
-    tbody.innerHTML = logs.map(log => `
+    const rows = logs.map(log => `
         <tr>
             <td class="whitespace-nowrap">${formatDateShort(log.created_at)}</td>
             <td><span class="badge badge-outline">${escapeHtml(log.cookie_name)}</span></td>
@@ -290,12 +319,20 @@ function renderLogTable(logs) {
             <td>
                 ${log.status === 'success' 
                     ? '<span class="badge badge-success gap-1"><svg xmlns="http://www.w3.org/2000/svg" class="h-3 w-3" fill="none" viewBox="0 0 24 24" stroke="currentColor"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M5 13l4 4L19 7" /></svg>成功</span>' 
+                    : log.status === 'cancelled'
+                    ? '<span class="badge badge-warning gap-1" title="客户端断开连接">已取消</span>'
                     : '<span class="badge badge-error gap-1"><svg xmlns="http://www.w3.org/2000/svg" class="h-3 w-3" fill="none" viewBox="0 0 24 24" stroke="currentColor"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M6 18L18 6M6 6l12 12" /></svg>失败</span>'}
             </td>
             <td>${log.duration_ms ? log.duration_ms + 'ms' : '-'}</td>
             <td class="text-sm">${log.prompt_tokens || 0} / ${log.completion_tokens || 0}</td>
         </tr>
     `).join('');
+    
+    if (append) {
+        tbody.insertAdjacentHTML('beforeend', rows);
+    } else {
+        tbody.innerHTML = rows;
+    }
 }
 
 /**
@@ -0,0 +1,63 @@
+import asyncio
+from typing import AsyncGenerator, AsyncIterator, Optional
+
+
+async def coalesce_deltas(
+    deltas: AsyncIterator[str],
+    window: float,
+    max_chars: int
+) -> AsyncGenerator[str, None]:
+    """
+    合并细碎的文本增量，减少 SSE 帧数。
+    第一个增量立即产出（不影响首字延迟）；之后的增量先缓存，
+    缓存达到 max_chars 个字符或距离缓存开始超过 window 秒时合并产出。
+    上游停顿时由计时器按时刷新，缓存不会等到下一个增量才发出。
+    """
+    iterator = deltas.__aiter__()
+    loop = asyncio.get_running_loop()
+
+    # 首个增量直接透传
+    async for first in iterator:
+        yield first
+        break
+    else:
+        return
+
+    buffer = []
+    buffered = 0
+    deadline = 0.0
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            if buffer:
+                # 有缓存时最多等到窗口结束；超时不取消读取，只先把缓存发出去
+                done, _ = await asyncio.wait((pending,), timeout=max(deadline - loop.time(), 0))
+                if not done:
+                    yield "".join(buffer)
+                    buffer.clear()
+                    buffered = 0
+                    continue
+            try:
+                delta = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                if pending.done():
+                    pending = None
+
+            if not buffer:
+                deadline = loop.time() + window
+            buffer.append(delta)
+            buffered += len(delta)
+            if buffered >= max_chars or loop.time() >= deadline:
+                yield "".join(buffer)
+                buffer.clear()
+                buffered = 0
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
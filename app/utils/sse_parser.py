@@ -0,0 +1,93 @@
+import json
+import re
+from typing import Any, AsyncIterator, AsyncGenerator, List, Optional
+
+# 事件类型字段；上游（AI SDK）事件的第一个键就是顶层的 type，先按开头匹配，
+# 不在开头时再全文查找。字符串值中的引号会被转义成 \"，不会误匹配
+_LEADING_EVENT_TYPE_RE = re.compile(rb'\{\s*"type"\s*:\s*"([^"\\]*)"')
+_EVENT_TYPE_RE = re.compile(rb'"type"\s*:\s*"([^"\\]*)"')
+
+_json_raw_decode = json.JSONDecoder().raw_decode
+
+
+def decode_json(data: bytes) -> Any:
+    """解码事件数据中的 JSON；省去 json.loads 对 bytes 的编码探测和首尾空白检查"""
+    return _json_raw_decode(data.decode("utf-8"))[0]
+
+
+def sse_event_type(data: bytes) -> Optional[bytes]:
+    """
+    不解码 JSON，直接从事件数据中取出 type 的值（bytes），找不到时返回 None。
+    只用于决定是否需要完整解码；解码后仍应以 JSON 中的 type 为准。
+    """
+    match = _LEADING_EVENT_TYPE_RE.match(data) or _EVENT_TYPE_RE.search(data)
+    return match.group(1) if match else None
+
+
+class SSEDecoder:
+    """
+    增量的字节级 SSE 解析器。
+    按收到的字节块调用 feed()，返回其中已完整的事件的 data 字段（bytes）；
+    事件可以跨任意字节块边界，多行 data: 按规范以 \\n 拼接。
+    支持 \\n 和 \\r\\n 换行；event/id/retry 字段和注释行被忽略。
+    """
+    __slots__ = ("_pending",)
+
+    def __init__(self):
+        # 尚未以空行结束的不完整事件，可能由多个字节块组成
+        self._pending: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        if b"\n" not in chunk:
+            if chunk:
+                self._pending.append(chunk)
+            return []
+        if self._pending:
+            self._pending.append(chunk)
+            chunk = b"".join(self._pending)
+            self._pending.clear()
+        if b"\r" in chunk:
+            # 跨块的 \r\n 会在下次拼接后再替换
+            chunk = chunk.replace(b"\r\n", b"\n")
+
+        blocks = chunk.split(b"\n\n")
+        tail = blocks.pop()
+        if tail:
+            self._pending.append(tail)
+
+        events = []
+        for block in blocks:
+            if block.startswith(b"data: ") and b"\n" not in block:
+                # 常见情况：事件只有一行 data
+                events.append(block[6:])
+            elif block:
+                data = self._parse_fields(block)
+                if data is not None:
+                    events.append(data)
+        return events
+
+    def flush(self) -> List[bytes]:
+        """流结束时调用，分发最后一个没有以空行结尾的事件"""
+        return self.feed(b"\n\n") if self._pending else []
+
+    @staticmethod
+    def _parse_fields(block: bytes) -> Optional[bytes]:
+        """逐行解析一个事件，返回拼接后的 data；没有 data 字段时返回 None"""
+        data = []
+        for line in block.split(b"\n"):
+            if line.startswith(b"data:"):
+                value = line[5:]
+                data.append(value[1:] if value.startswith(b" ") else value)
+            elif line == b"data":
+                data.append(b"")
+        return b"\n".join(data) if data else None
+
+
+async def iter_sse_data(chunks: AsyncIterator[bytes]) -> AsyncGenerator[bytes, None]:
+    """逐个产出字节流中每个 SSE 事件的 data（bytes）"""
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        for data in decoder.feed(chunk):
+            yield data
+    for data in decoder.flush():
+        yield data
@@ -1,5 +1,6 @@
 import json
 import time
+from json.encoder import encode_basestring_ascii
 from typing import Dict, Any, Optional
 
 DONE_CHUNK = b"data: [DONE]\n\n"
@@ -11,12 +12,13 @@ def create_chat_completion_chunk(
     request_id: str,
     model: str,
     content: str,
-    finish_reason: Optional[str] = None
+    finish_reason: Optional[str] = None,
+    created: Optional[int] = None
 ) -> Dict[str, Any]:
     return {
         "id": request_id,
         "object": "chat.completion.chunk",
-        "created": int(time.time()),
+        "created": int(time.time()) if created is None else created,
         "model": model,
         "choices": [
             {
@@ -26,3 +28,74 @@ def create_chat_completion_chunk(
             }
         ]
     }
+
+
+class ChatCompletionChunkEncoder:
+    """
+    按模板编码 chat.completion.chunk SSE 帧，每个流创建一次。
+    id、model、created 等不变部分预先渲染成前缀/后缀字节，每个增量只需 JSON 转义 content；
+    输出与 create_sse_data(create_chat_completion_chunk(...)) 逐字节一致。
+    """
+    __slots__ = ("created", "_prefix", "_suffix", "_usage_prefix")
+
+    def __init__(self, request_id: str, model: str, created: Optional[int] = None):
+        self.created = int(time.time()) if created is None else created
+        self._prefix = (
+            f'data: {{"id": {json.dumps(request_id)}, "object": "chat.completion.chunk", '
+            f'"created": {self.created}, "model": {json.dumps(model)}, '
+            f'"choices": [{{"index": 0, "delta": {{"content": '
+        ).encode('utf-8')
+        self._suffix = b'}, "finish_reason": null}]}\n\n'
+        self._usage_prefix = (
+            f'data: {{"id": {json.dumps(request_id)}, "object": "chat.completion.chunk", '
+            f'"created": {self.created}, "model": {json.dumps(model)}, "choices": [], "usage": '
+        ).encode('utf-8')
+
+    def encode(self, content: str, finish_reason: Optional[str] = None) -> bytes:
+        # encode_basestring_ascii 与 json.dumps 默认的 ensure_ascii 转义完全一致，输出必为 ASCII
+        escaped = encode_basestring_ascii(content).encode('ascii')
+        if finish_reason is None:
+            return self._prefix + escaped + self._suffix
+        return self._prefix + escaped + f'}}, "finish_reason": {json.dumps(finish_reason)}}}]}}\n\n'.encode('utf-8')
+
+    def encode_usage(self, usage: Dict[str, int]) -> bytes:
+        """stream_options.include_usage 时在结束分块之后发送的用量分块，choices 为空"""
+        return self._usage_prefix + json.dumps(usage).encode('utf-8') + b'}\n\n'
+
+
+def _benchmark(iterations: int = 200000) -> None:
+    """
+    微基准：验证模板编码器与 dict + json.dumps 的输出逐字节一致，并比较每个分块的 CPU 耗时。
+    运行：python -m app.utils.sse_utils
+    """
+    request_id = "chatcmpl-6f1c2b7e-3a4d-4b8e-9c1f-0a2b3c4d5e6f"
+    model = "claude-sonnet-4.5"
+    samples = ["Hello", " world", "，你好", "\n\n```python\n", 'say "hi"\t\\', "emoji 😀", "\x00\x7f", ""]
+    encoder = ChatCompletionChunkEncoder(request_id, model)
+
+    for content in samples:
+        for finish_reason in (None, "stop", "length"):
+            expected = create_sse_data(create_chat_completion_chunk(request_id, model, content, finish_reason, encoder.created))
+            actual = encoder.encode(content, finish_reason)
+            assert actual == expected, f"输出不一致: {actual!r} != {expected!r}"
+    print(f"逐字节一致性校验通过（{len(samples) * 3} 个样本）")
+
+    deltas = [samples[i % 4] for i in range(iterations)]
+
+    start = time.perf_counter()
+    for content in deltas:
+        create_sse_data(create_chat_completion_chunk(request_id, model, content))
+    baseline = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for content in deltas:
+        encoder.encode(content)
+    templated = time.perf_counter() - start
+
+    print(f"dict + json.dumps: {baseline / iterations * 1e9:8.0f} ns/分块")
+    print(f"模板编码器:        {templated / iterations * 1e9:8.0f} ns/分块")
+    print(f"加速比:            {baseline / templated:8.1f}x")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,73 @@
+import time
+from typing import Any, Dict, Mapping, Optional
+
+# httpx/httpcore 跟踪事件（去掉 .started/.complete 和协议前缀）到阶段名的映射
+TRACE_PHASES = {
+    "connect_tcp": "connect",
+    "connect_unix_socket": "connect",
+    "start_tls": "tls",
+    "send_request_headers": "send",
+    "send_request_body": "send",
+    "receive_response_headers": "upstream_wait",
+}
+
+
+class PhaseTimer:
+    """
+    单个请求的分阶段计时。mark(name) 把距上一次标记的时间计入该阶段，
+    同名阶段（例如换 Cookie 重试）累加；add() 直接累加一段已测得的时间。
+    httpx 跟踪事件计入的时间会从下一次 mark 中扣除，各阶段互不重叠。
+    结果以 Server-Timing 响应头和调用日志的 timings 字段输出，单位毫秒。
+    """
+
+    __slots__ = ("start", "_last", "_traced", "phases", "_trace_started")
+
+    def __init__(self):
+        self.start = self._last = time.perf_counter()
+        self._traced = 0.0
+        self.phases: Dict[str, float] = {}
+        self._trace_started: Dict[str, float] = {}
+
+    def mark(self, name: str) -> None:
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0.0) + (now - self._last - self._traced)
+        self._last = now
+        self._traced = 0.0
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    async def trace(self, event_name: str, info: Mapping[str, Any]) -> None:
+        """
+        httpx 的 trace 扩展回调：把连接、TLS 握手、发送请求和等待上游响应头分别计入各自的阶段。
+        事件名形如 connection.connect_tcp.started / http2.receive_response_headers.complete。
+        """
+        _, _, event = event_name.partition(".")
+        step, _, state = event.rpartition(".")
+        phase = TRACE_PHASES.get(step)
+        if phase is None:
+            return
+        if state == "started":
+            self._trace_started[step] = time.perf_counter()
+        elif state in ("complete", "failed"):
+            started = self._trace_started.pop(step, None)
+            if started is not None:
+                duration = time.perf_counter() - started
+                self.add(phase, duration)
+                self._traced += duration
+
+    def as_dict(self, total: bool = True) -> Dict[str, float]:
+        timings = {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()}
+        if total:
+            timings["total"] = round(self.elapsed() * 1000, 1)
+        return timings
+
+    def server_timing(self, extra: Optional[Dict[str, float]] = None) -> str:
+        """Server-Timing 响应头的值，例如 cookie;dur=0.1, upstream_wait;dur=412.3, total;dur=415.0"""
+        timings = self.as_dict()
+        if extra:
+            timings.update(extra)
+        return ", ".join(f"{name};dur={duration}" for name, duration in timings.items())
@@ -0,0 +1,13 @@
+"""
+性能基准脚本。
+
+所有基准默认使用临时 SQLite 数据库和共享状态文件，避免污染 data/ 目录；
+可以通过预先设置 DATABASE_URL / STATE_SQLITE_PATH 环境变量覆盖。
+"""
+
+import os
+import tempfile
+
+_bench_dir = tempfile.mkdtemp(prefix='smithery-bench-')
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_bench_dir, 'bench.db')}")
+os.environ.setdefault("STATE_SQLITE_PATH", os.path.join(_bench_dir, "shared_state.db"))
@@ -0,0 +1,82 @@
+"""
+管理会话存储基准：在大量会话下测量每次管理请求的会话验证开销
+
+    python -m benchmarks.bench_admin_sessions --sessions 1000,10000,100000
+
+对比旧实现（每次验证前遍历全部会话清理过期项）与共享状态中的会话存储
+（memory 后端的过期时间堆、sqlite 后端的 expires_at 索引）。
+为体现最坏情况，这里每次验证前都执行清理（auth 中实际每 60 秒最多一次），
+且会话的过期时间均匀分布在测量期间，清理时确实有会话过期。
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from typing import Dict
+
+from app.services.shared_state import SharedState, SQLiteSharedState
+
+
+class LegacySessions:
+    """旧的实现：dict 存储，每次验证前遍历全部会话"""
+
+    def __init__(self):
+        self._sessions: Dict[str, dict] = {}
+
+    def put_session(self, token: str, expires_at: float) -> None:
+        self._sessions[token] = {"expires_at": datetime.utcfromtimestamp(expires_at)}
+
+    def purge_sessions(self, now: float) -> int:
+        now = datetime.utcfromtimestamp(now)
+        expired = [token for token, session in self._sessions.items() if now > session["expires_at"]]
+        for token in expired:
+            del self._sessions[token]
+        return len(expired)
+
+    def session_expires_at(self, token: str):
+        session = self._sessions.get(token)
+        return session["expires_at"].timestamp() if session else None
+
+
+def _measure(store, sessions: int, requests: int) -> dict:
+    now = time.time()
+    # 一半会话在测量期间陆续过期，另一半仍然有效
+    tokens = [str(uuid.uuid4()) for _ in range(sessions)]
+    for i, token in enumerate(tokens):
+        expires_at = now + 3600 if i % 2 else now + i / sessions
+        store.put_session(token, expires_at)
+    valid_token = tokens[1]
+
+    start = time.perf_counter()
+    purged = 0
+    for i in range(requests):
+        purged += store.purge_sessions(now + i / requests)
+        assert store.session_expires_at(valid_token) is not None
+    elapsed = time.perf_counter() - start
+    return {"per_request_us": elapsed / requests * 1e6, "purged": purged}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", default="1000,10000,100000", help="逗号分隔的会话数")
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    state_dir = tempfile.mkdtemp(prefix="smithery-sessions-")
+    print(f"{'会话数':>8} {'每请求过期数':>12} {'旧实现 µs/请求':>16} {'memory 堆 µs/请求':>18} {'sqlite 索引 µs/请求':>20}")
+    for sessions in [int(n) for n in args.sessions.split(",")]:
+        legacy_requests = max(min(args.requests, 2_000_000 // sessions), 20)
+        legacy = _measure(LegacySessions(), sessions, legacy_requests)
+        memory = _measure(SharedState(), sessions, args.requests)
+        sqlite = _measure(SQLiteSharedState(os.path.join(state_dir, f"{sessions}.db")), sessions, args.requests)
+        print(
+            f"{sessions:>8} {memory['purged'] / args.requests:>12.1f} {legacy['per_request_us']:>16.1f} {memory['per_request_us']:>18.2f} "
+            f"{sqlite['per_request_us']:>20.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
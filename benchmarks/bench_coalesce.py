@@ -0,0 +1,96 @@
+"""
+增量合并基准：比较开启/关闭合并时每个响应的 SSE 帧数和 CPU 耗时
+
+    python -m benchmarks.bench_coalesce --responses 20 --tokens 400 --window-ms 20
+
+模拟上游以很小的间隔输出 1~3 个字符的增量，代理在同一进程中并发处理多个响应。
+CPU 只统计代理所在的主线程（time.thread_time），不包含模拟上游线程。
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import statistics
+import time
+
+from app.core.config import settings
+from app.db.database import init_db
+from app.providers.smithery_provider import SmitheryProvider
+from app.services.cookie_pool import cookie_pool
+from benchmarks.mock_upstream import MockUpstreamServer, config as mock_config
+
+
+def _fake_cookie() -> str:
+    payload = {"access_token": "bench", "user": {"id": "00000000-0000-0000-0000-00000000bench"}}
+    return "base64-" + base64.b64encode(json.dumps(payload).encode()).decode()
+
+
+async def _run(responses: int, stream_options: dict) -> dict:
+    provider = SmitheryProvider()
+    await provider.start()
+    request_data = {
+        "model": "claude-haiku-4.5",
+        "messages": [{"role": "user", "content": "hi"}],
+        "stream": True,
+        "stream_options": stream_options,
+    }
+
+    async def one() -> int:
+        response = await provider.chat_completion(request_data)
+        frames = 0
+        async for _chunk in response.body_iterator:
+            frames += 1
+        await response.background()
+        return frames
+
+    try:
+        cpu_start = time.thread_time()
+        wall_start = time.perf_counter()
+        frames = await asyncio.gather(*(one() for _ in range(responses)))
+        cpu = time.thread_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+    finally:
+        await provider.close()
+    return {"frames": frames, "cpu": cpu, "wall": wall}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--responses", type=int, default=20)
+    parser.add_argument("--tokens", type=int, default=400)
+    parser.add_argument("--token-interval-ms", type=float, default=2.0)
+    parser.add_argument("--window-ms", type=float, default=20.0)
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    mock_config.ttfb_ms = 10
+    mock_config.tokens = args.tokens
+    mock_config.token_interval_ms = args.token_interval_ms
+    mock_config.token_text = "ab"
+
+    os.environ.setdefault("SMITHERY_COOKIE_1", _fake_cookie())
+    init_db()
+    cookie_pool.load()
+
+    with MockUpstreamServer(port=args.port) as server:
+        settings.CHAT_API_URL = server.chat_url
+        results = {
+            "关闭合并": asyncio.run(_run(args.responses, {"coalesce_ms": 0})),
+            f"合并 {args.window_ms:g}ms": asyncio.run(_run(args.responses, {"coalesce_ms": args.window_ms})),
+        }
+
+    print(f"响应数 {args.responses}，每个响应 {args.tokens} 个上游增量，间隔 {args.token_interval_ms:g}ms")
+    for name, result in results.items():
+        print(
+            f"{name:<12} 帧/响应 {statistics.mean(result['frames']):7.1f}   "
+            f"CPU/响应 {result['cpu'] / args.responses * 1000:7.2f} ms   "
+            f"总耗时 {result['wall']:.2f} s"
+        )
+
+
+if __name__ == "__main__":
+    main()
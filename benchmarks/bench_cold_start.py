@@ -0,0 +1,145 @@
+"""
+冷启动基准：代理进程启动后第一个请求的首字延迟，以及随后的请求是否复用上游连接
+
+    python -m benchmarks.bench_cold_start --trials 5
+    python -m benchmarks.bench_cold_start --trials 5 --proxy-env UPSTREAM_WARMUP_CONNECTIONS=0
+
+模拟上游以 HTTPS 运行（用 openssl 生成临时的自签名证书，代理通过 SSL_CERT_FILE 信任它），
+每轮重新启动代理，立即发送 --requests 个顺序的流式请求，按 Server-Timing 中的 connect / tls 阶段
+判断该请求是否新建了上游连接。分别在开启和关闭预热（UPSTREAM_WARMUP_CONNECTIONS=0）时运行即可对比。
+本机回环上的握手只有几毫秒，到真实上游的首个请求还要加上 DNS 查询和网络往返。
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.load_test import _percentile, _start
+
+API_KEY = "cold-start-key"
+REQUEST = {"model": "claude-haiku-4.5", "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+
+
+def _make_certificate(directory: str) -> tuple:
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-keyout", keyfile, "-out", certfile, "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=DNS:localhost"],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return certfile, keyfile
+
+
+def _server_timing(header: str) -> Dict[str, float]:
+    timings = {}
+    for item in header.split(","):
+        name, _, duration = item.strip().partition(";dur=")
+        if duration:
+            timings[name] = float(duration)
+    return timings
+
+
+def _request(client: httpx.Client, base_url: str) -> dict:
+    start = time.perf_counter()
+    ttfb = None
+    with client.stream("POST", f"{base_url}/v1/chat/completions", json=REQUEST,
+                       headers={"Authorization": f"Bearer {API_KEY}"}) as response:
+        response.raise_for_status()
+        timings = _server_timing(response.headers.get("server-timing", ""))
+        for chunk in response.iter_bytes():
+            if ttfb is None and b'"content"' in chunk:
+                ttfb = (time.perf_counter() - start) * 1000
+    return {
+        "ttfb_ms": ttfb,
+        "handshake_ms": timings.get("connect", 0.0) + timings.get("tls", 0.0),
+        "new_connection": "connect" in timings,
+    }
+
+
+def _trial(args, env: dict, base_url: str) -> List[dict]:
+    proxy = _start(
+        ["-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning", "--no-access-log"],
+        env, f"{base_url}/"
+    )
+    try:
+        with httpx.Client(timeout=60) as client:
+            results = []
+            for _ in range(args.requests):
+                results.append(_request(client, base_url))
+                time.sleep(args.interval)
+            return results
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="冷启动基准")
+    parser.add_argument("--trials", type=int, default=5, help="重新启动代理的次数")
+    parser.add_argument("--requests", type=int, default=5, help="每次启动后顺序发送的请求数")
+    parser.add_argument("--interval", type=float, default=0.2, help="请求之间的间隔（秒）")
+    parser.add_argument("--port", type=int, default=9160)
+    parser.add_argument("--upstream-port", type=int, default=9161)
+    parser.add_argument("--ttfb-ms", type=float, default=100.0)
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="NAME=VALUE")
+    parser.add_argument("--json", help="把每个请求的结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="smithery-cold-start-") as workdir:
+        certfile, keyfile = _make_certificate(workdir)
+        # 本进程检查模拟上游是否就绪时也要信任这个证书
+        os.environ["SSL_CERT_FILE"] = certfile
+        upstream_url = f"https://localhost:{args.upstream_port}"
+        env = {
+            **os.environ,
+            "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'smithery.db')}",
+            "STATE_BACKEND": "sqlite",
+            "STATE_SQLITE_PATH": os.path.join(workdir, "shared_state.db"),
+            "CHAT_API_URL": f"{upstream_url}/api/chat",
+            "API_MASTER_KEY": API_KEY,
+            "TOKEN_REFRESH_ENABLED": "false",
+        }
+        for item in args.proxy_env:
+            name, _, value = item.partition("=")
+            env[name] = value
+        seed = "from benchmarks.bench_multi_worker import _seed_cookies; _seed_cookies(1)"
+        subprocess.run([sys.executable, "-c", seed], env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        upstream = _start(
+            ["-m", "benchmarks.mock_upstream", "--port", str(args.upstream_port), "--host", "localhost",
+             "--ttfb-ms", str(args.ttfb_ms), "--ssl-certfile", certfile, "--ssl-keyfile", keyfile],
+            env, f"{upstream_url}/stats"
+        )
+        base_url = f"http://127.0.0.1:{args.port}"
+        try:
+            trials = [_trial(args, env, base_url) for _ in range(args.trials)]
+        finally:
+            upstream.terminate()
+            upstream.wait()
+
+    print(f"上游 {upstream_url}（TLS），首字前延迟 {args.ttfb_ms:.0f} ms，"
+          f"{args.trials} 次启动 × {args.requests} 个请求，代理环境: {' '.join(args.proxy_env) or '默认'}")
+    for index in range(args.requests):
+        results = [trial[index] for trial in trials]
+        ttfbs = [r["ttfb_ms"] for r in results if r["ttfb_ms"] is not None]
+        handshakes = [r["handshake_ms"] for r in results]
+        new = sum(r["new_connection"] for r in results)
+        print(f"  第 {index + 1} 个请求: TTFB p50 {_percentile(ttfbs, 50):7.1f} ms  max {max(ttfbs):7.1f} ms  "
+              f"建连+TLS p50 {_percentile(handshakes, 50):5.1f} ms  新建连接 {new}/{len(results)}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"proxy_env": args.proxy_env, "trials": trials}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+客户端断开基准：客户端中途断开后，代理多快取消上游请求并释放连接和 Cookie
+
+    python -m benchmarks.bench_disconnect --requests 20
+    python -m benchmarks.bench_disconnect --requests 20 --proxy-env SINGLE_FLIGHT_MODE=off
+
+模拟上游以较慢的速度输出（默认 200 个 token，间隔 20 ms），客户端分别以流式和非流式发起 --requests 个
+并发请求，--disconnect-after 秒后全部断开。之后轮询模拟上游的 /stats，直到正在输出的响应数（active）归零，
+记录从断开到上游连接被关闭的时间；再检查代理的 /metrics（上游连接池、准入名额）和调用日志（cancelled 状态
+及断开前已生成的 completion_tokens），最后发送一个完整请求确认 Cookie 已归还。
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.load_test import _percentile, _start
+
+API_KEY = "disconnect-key"
+
+
+def _metric(text: str, name: str) -> float:
+    """/metrics 中某个指标所有序列的合计"""
+    total = 0.0
+    for line in text.splitlines():
+        if line.startswith(name + "{") or line.startswith(name + " "):
+            total += float(line.rsplit(" ", 1)[1])
+    return total
+
+
+async def _disconnecting_request(client: httpx.AsyncClient, base_url: str, stream: bool, index: int, after: float) -> None:
+    body = {
+        "model": "claude-haiku-4.5",
+        "stream": stream,
+        # 每个请求内容不同，避免被单飞合并或补全缓存合并成一个上游请求
+        "messages": [{"role": "user", "content": f"disconnect {stream} {index}"}],
+    }
+
+    async def send():
+        async with client.stream("POST", f"{base_url}/v1/chat/completions", json=body,
+                                 headers={"Authorization": f"Bearer {API_KEY}"}) as response:
+            async for _ in response.aiter_bytes():
+                pass
+
+    try:
+        # 超时取消时 httpx 关闭连接，代理收到 http.disconnect
+        await asyncio.wait_for(send(), after)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def _wait_released(client: httpx.AsyncClient, upstream_url: str, timeout: float) -> float:
+    """等待模拟上游所有响应都被关闭，返回等待的秒数"""
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        stats = (await client.get(f"{upstream_url}/stats")).json()
+        if stats["active"] == 0:
+            return time.perf_counter() - start
+        await asyncio.sleep(0.01)
+    raise RuntimeError(f"{timeout:.0f} 秒后模拟上游仍有 {stats['active']} 个响应在输出")
+
+
+async def _cancelled_logs(client: httpx.AsyncClient, base_url: str, expected: int) -> List[dict]:
+    """调用日志由后台批量写入，轮询到出现 expected 条 cancelled 记录为止"""
+    token = (await client.post(f"{base_url}/api/admin/auth/verify", json={"password": API_KEY})).json()["token"]
+    logs: List[dict] = []
+    for _ in range(50):
+        response = await client.get(f"{base_url}/api/admin/call-logs", params={"limit": 1000},
+                                    headers={"Authorization": f"Bearer {token}"})
+        logs = [log for log in response.json()["data"] if log["status"] == "cancelled"]
+        if len(logs) >= expected:
+            break
+        await asyncio.sleep(0.1)
+    return logs
+
+
+async def _scenario(args, base_url: str, upstream_url: str, stream: bool) -> Dict[str, float]:
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=args.requests + 10)) as client:
+        await client.post(f"{upstream_url}/stats/reset")
+        await asyncio.gather(*(
+            _disconnecting_request(client, base_url, stream, index, args.disconnect_after)
+            for index in range(args.requests)
+        ))
+        released = await _wait_released(client, upstream_url, args.timeout)
+        stats = (await client.get(f"{upstream_url}/stats")).json()
+        metrics = (await client.get(f"{base_url}/metrics")).text
+    return {
+        "released_ms": released * 1000,
+        "upstream_requests": stats["requests"],
+        "upstream_cancelled": stats["cancelled"],
+        "upstream_completed": stats["completed"],
+        "pool_active": _metric(metrics, 'smithery_http_pool_connections{state="active"}'),
+        "admission_active": _metric(metrics, "smithery_admission_active_requests"),
+    }
+
+
+async def _run(args, base_url: str, upstream_url: str) -> None:
+    results = {}
+    for stream in (True, False):
+        results[stream] = await _scenario(args, base_url, upstream_url, stream)
+
+    async with httpx.AsyncClient(timeout=60) as client:
+        logs = await _cancelled_logs(client, base_url, args.requests * 2)
+        # Cookie 已归还：完整请求应当成功
+        response = await client.post(
+            f"{base_url}/v1/chat/completions",
+            json={"model": "claude-haiku-4.5", "stream": False, "messages": [{"role": "user", "content": "after"}]},
+            headers={"Authorization": f"Bearer {API_KEY}"}
+        )
+
+    print(f"{args.requests} 个并发请求，{args.disconnect_after:.1f} 秒后断开；上游 {args.tokens} 个 token，"
+          f"间隔 {args.token_interval_ms:.0f} ms；代理环境: {' '.join(args.proxy_env) or '默认'}")
+    for stream, result in results.items():
+        print(f"  {'流式' if stream else '非流式'}: 断开后 {result['released_ms']:6.1f} ms 内上游连接全部关闭  "
+              f"上游请求 {result['upstream_requests']}  被取消 {result['upstream_cancelled']}  "
+              f"完整输出 {result['upstream_completed']}  连接池活动连接 {result['pool_active']:.0f}  "
+              f"准入名额 {result['admission_active']:.0f}")
+    tokens = [log["completion_tokens"] for log in logs]
+    print(f"  cancelled 调用日志 {len(logs)} 条，completion_tokens p50 {_percentile(tokens, 50)}  "
+          f"min {min(tokens, default=None)}  max {max(tokens, default=None)}")
+    print(f"  断开后的完整请求: HTTP {response.status_code}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="客户端断开基准")
+    parser.add_argument("--requests", type=int, default=10, help="每种模式的并发请求数")
+    parser.add_argument("--disconnect-after", type=float, default=1.0, help="客户端在多少秒后断开")
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--token-interval-ms", type=float, default=20.0)
+    parser.add_argument("--cookies", type=int, default=2)
+    parser.add_argument("--timeout", type=float, default=30.0, help="等待上游连接关闭的最长时间（秒）")
+    parser.add_argument("--port", type=int, default=9170)
+    parser.add_argument("--upstream-port", type=int, default=9171)
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="NAME=VALUE")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="smithery-disconnect-") as workdir:
+        upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+        env = {
+            **os.environ,
+            "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'smithery.db')}",
+            "STATE_BACKEND": "sqlite",
+            "STATE_SQLITE_PATH": os.path.join(workdir, "shared_state.db"),
+            "CHAT_API_URL": f"{upstream_url}/api/chat",
+            "API_MASTER_KEY": API_KEY,
+            "TOKEN_REFRESH_ENABLED": "false",
+        }
+        for item in args.proxy_env:
+            name, _, value = item.partition("=")
+            env[name] = value
+        seed = f"from benchmarks.bench_multi_worker import _seed_cookies; _seed_cookies({args.cookies})"
+        subprocess.run([sys.executable, "-c", seed], env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        upstream = _start(
+            ["-m", "benchmarks.mock_upstream", "--port", str(args.upstream_port), "--tokens", str(args.tokens),
+             "--token-interval-ms", str(args.token_interval_ms)],
+            env, f"{upstream_url}/stats"
+        )
+        base_url = f"http://127.0.0.1:{args.port}"
+        try:
+            proxy = _start(
+                ["-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning", "--no-access-log"],
+                env, f"{base_url}/"
+            )
+            try:
+                asyncio.run(_run(args, base_url, upstream_url))
+            finally:
+                proxy.terminate()
+                proxy.wait()
+        finally:
+            upstream.terminate()
+            upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
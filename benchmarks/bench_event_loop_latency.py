@@ -0,0 +1,138 @@
+"""
+事件循环延迟基准：在并发流式负载下测量事件循环的调度延迟
+
+    python -m benchmarks.bench_event_loop_latency --streams 50 --admin-readers 8
+
+并发运行流式补全（本地模拟上游）和管理端日志/Cookie 查询，
+同时用探针任务反复 sleep(1ms)，统计实际唤醒比预期晚了多少。
+管理端查询或日志写入在事件循环上同步访问 SQLite 时，延迟会明显升高。
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import statistics
+import time
+from datetime import datetime
+
+import httpx
+
+from app.core.config import settings
+from benchmarks.mock_upstream import MockUpstreamServer, config as mock_config
+
+PROBE_INTERVAL = 0.001
+
+
+def _fake_cookie() -> str:
+    payload = {"access_token": "bench", "user": {"id": "00000000-0000-0000-0000-00000000bench"}}
+    return "base64-" + base64.b64encode(json.dumps(payload).encode()).decode()
+
+
+def _seed_call_logs(cookie_id: int, count: int):
+    from app.db.database import SessionLocal
+    from app.db import crud
+
+    now = datetime.utcnow()
+    logs = [
+        {"cookie_id": cookie_id, "model": "claude-haiku-4.5", "prompt_tokens": 10, "completion_tokens": 100,
+         "status": "success", "error_message": None, "duration_ms": 500, "created_at": now}
+        for _ in range(count)
+    ]
+    db = SessionLocal()
+    try:
+        crud.write_call_log_batch(db, logs, {})
+    finally:
+        db.close()
+
+
+async def _probe(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append((time.perf_counter() - start - PROBE_INTERVAL) * 1000)
+
+
+async def _run(args) -> dict:
+    from main import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            token = (await client.post("/api/admin/auth/verify", json={"password": settings.API_MASTER_KEY})).json()["token"]
+            admin_headers = {"Authorization": f"Bearer {token}"}
+            api_headers = {"Authorization": f"Bearer {settings.API_MASTER_KEY}"}
+
+            created = await client.post(
+                "/api/admin/cookies",
+                json={"name": f"bench-{time.time_ns()}", "cookie_data": _fake_cookie()},
+                headers=admin_headers
+            )
+            _seed_call_logs(created.json()["data"]["id"], args.seed_logs)
+
+            lags: list = []
+            stop = asyncio.Event()
+            probe = asyncio.create_task(_probe(lags, stop))
+
+            async def stream_once():
+                await client.post(
+                    "/v1/chat/completions",
+                    json={"model": "claude-haiku-4.5", "messages": [{"role": "user", "content": "hi"}]},
+                    headers=api_headers
+                )
+
+            async def admin_reader(deadline: float):
+                reads = 0
+                while time.perf_counter() < deadline:
+                    await client.get("/api/admin/call-logs?limit=200", headers=admin_headers)
+                    await client.get("/api/admin/cookies", headers=admin_headers)
+                    reads += 1
+                return reads
+
+            start = time.perf_counter()
+            deadline = start + args.duration
+            streams = [stream_once() for _ in range(args.streams)]
+            readers = [admin_reader(deadline) for _ in range(args.admin_readers)]
+            results = await asyncio.gather(asyncio.gather(*streams), asyncio.gather(*readers))
+            elapsed = time.perf_counter() - start
+
+            stop.set()
+            await probe
+
+    return {"lags": sorted(lags), "admin_reads": sum(results[1]), "elapsed": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--streams", type=int, default=50)
+    parser.add_argument("--admin-readers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5.0, help="管理端查询持续时间（秒）")
+    parser.add_argument("--seed-logs", type=int, default=5000)
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    # 关闭 INFO/DEBUG 日志，避免日志输出掩盖数据库访问带来的阻塞
+    logging.disable(logging.INFO)
+    mock_config.ttfb_ms = 100
+    mock_config.tokens = 200
+    mock_config.token_interval_ms = 10
+    if not settings.API_MASTER_KEY:
+        settings.API_MASTER_KEY = "bench-key"
+
+    with MockUpstreamServer(port=args.port) as server:
+        settings.CHAT_API_URL = server.chat_url
+        result = asyncio.run(_run(args))
+
+    lags = result["lags"]
+    p99 = lags[int(len(lags) * 0.99) - 1] if lags else 0.0
+    print(f"并发流:            {args.streams}")
+    print(f"管理端查询:        {result['admin_reads']} 轮（{args.admin_readers} 个并发读取方）")
+    print(f"探针样本:          {len(lags)}")
+    print(f"循环延迟 p50:      {statistics.median(lags):.2f} ms")
+    print(f"循环延迟 p99:      {p99:.2f} ms")
+    print(f"循环延迟 max:      {lags[-1]:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
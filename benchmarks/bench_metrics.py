@@ -0,0 +1,56 @@
+"""
+监控指标开销基准：热路径上每次记录（计数器递增、直方图观测）的耗时，以及 /metrics 导出的耗时
+
+    python -m benchmarks.bench_metrics --iterations 1000000
+
+对照组是一次空函数调用，两者之差即记录本身的开销。
+"""
+
+import argparse
+import asyncio
+import time
+
+from app.services.metrics import (
+    db_seconds, inter_token_seconds, metrics, model_label, requests_total, ttfb_seconds
+)
+
+
+def _noop(*args):
+    pass
+
+
+def _per_call_ns(func, args: tuple, iterations: int) -> float:
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        func(*args)
+    return (time.perf_counter_ns() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=1_000_000)
+    args = parser.parse_args()
+    n = args.iterations
+
+    baseline = _per_call_ns(_noop, (0.01, "claude-haiku-4.5"), n)
+    cases = [
+        ("空函数调用（对照）", _noop, (0.01, "claude-haiku-4.5")),
+        ("Counter.inc", requests_total.inc, ("claude-haiku-4.5", "200")),
+        ("Histogram.observe（无锁）", inter_token_seconds.observe, (0.012, "claude-haiku-4.5")),
+        ("Histogram.observe（线程安全）", db_seconds.observe, (0.002, "SELECT")),
+        ("model_label", model_label, ("claude-haiku-4.5",)),
+    ]
+    print(f"每次调用的平均耗时（{n} 次）：")
+    for name, func, call_args in cases:
+        cost = _per_call_ns(func, call_args, n)
+        print(f"  {name:<28} {cost:8.1f} ns  （扣除调用开销 {cost - baseline:6.1f} ns）")
+
+    for model in ("claude-haiku-4.5", "claude-sonnet-4.5", "other"):
+        ttfb_seconds.observe(0.3, model)
+    start = time.perf_counter()
+    text = asyncio.run(metrics.render())
+    print(f"\n/metrics 导出 {len(text.splitlines())} 行，耗时 {(time.perf_counter() - start) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+多 worker 扩展性基准：用不同的 uvicorn worker 数运行 main.py，测量固定并发下的补全吞吐
+
+    python -m benchmarks.bench_multi_worker --workers 1,2,4 --concurrency 32 --duration 10
+
+模拟上游在独立进程中运行（无延迟、一次写出全部 token），代理成为瓶颈；
+每种 worker 数下还会检查共享状态是否生效：
+  - 在一个 worker 登录得到的管理会话在所有 worker 上都有效
+  - 通过管理端新增 Cookie 后，所有 worker 都在 STATE_SYNC_INTERVAL 内加载到它
+  - 负载结束后共享状态中没有残留的租约
+扩展效率 = N 个 worker 的吞吐 / (N × 1 个 worker 的吞吐)，受机器的 CPU 核数限制。
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import httpx
+
+from app.core.config import settings
+from app.db import crud
+from app.db.database import DATABASE_DIR, SessionLocal, init_db
+
+API_KEY = "bench-key"
+
+
+def _fake_cookie(n: int) -> str:
+    payload = {"access_token": f"bench-{n}", "user": {"id": f"00000000-0000-0000-0000-{n:012d}"}}
+    return "base64-" + base64.b64encode(json.dumps(payload).encode()).decode()
+
+
+def _seed_cookies(count: int) -> None:
+    init_db()
+    db = SessionLocal()
+    try:
+        for n in range(1, count + 1):
+            if crud.get_cookie_by_name(db, f"bench-{n}") is None:
+                crud.create_cookie(db, f"bench-{n}", _fake_cookie(n))
+    finally:
+        db.close()
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"进程已退出（{process.returncode}）: {process.args}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"等待 {url} 超时")
+
+
+def _start(args: list, env: dict, ready_url: str) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, *args], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    _wait_ready(ready_url, process)
+    return process
+
+
+async def _load(base_url: str, concurrency: int, duration: float) -> dict:
+    body = {"model": "claude-haiku-4.5", "messages": [{"role": "user", "content": "hi"}]}
+    headers = {"Authorization": f"Bearer {API_KEY}"}
+    completed = failed = 0
+    deadline = time.perf_counter() + duration
+
+    async def client_loop(client: httpx.AsyncClient):
+        nonlocal completed, failed
+        while time.perf_counter() < deadline:
+            try:
+                async with client.stream("POST", "/v1/chat/completions", json=body, headers=headers) as response:
+                    tail = b""
+                    async for chunk in response.aiter_raw():
+                        tail = chunk[-32:]
+                if response.status_code == 200 and tail.endswith(b"[DONE]\n\n"):
+                    completed += 1
+                else:
+                    failed += 1
+            except httpx.HTTPError:
+                failed += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return {"completed": completed, "failed": failed, "throughput": completed / elapsed}
+
+
+def _check_shared_state(base_url: str, cookies: int, sync_interval: float) -> dict:
+    """登录一次后在所有 worker 上验证会话，新增 Cookie 后确认所有 worker 都已加载"""
+    with httpx.Client(base_url=base_url, timeout=10) as client:
+        token = client.post("/api/admin/auth/verify", json={"password": API_KEY}).json()["token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        session_ok = sum(
+            client.get("/api/admin/call-logs/writer", headers=headers).status_code == 200 for _ in range(40)
+        )
+
+        name = f"bench-added-{time.time_ns()}"
+        response = client.post("/api/admin/cookies", json={"name": name, "cookie_data": _fake_cookie(cookies + 1)}, headers=headers)
+        response.raise_for_status()
+        time.sleep(sync_interval * 2 + 0.5)
+        counts = [client.get("/").json()["cookies_configured"] for _ in range(40)]
+        client.delete(f"/api/admin/cookies/{response.json()['data']['id']}", headers=headers)
+    return {"session_ok": session_ok, "pool_synced": sum(c == cookies + 1 for c in counts), "checks": 40}
+
+
+def _leaked_leases(state_path: str) -> int:
+    with sqlite3.connect(state_path) as conn:
+        return conn.execute("SELECT COALESCE(SUM(count), 0) FROM leases").fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", default="1,2,4", help="逗号分隔的 worker 数")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--cookies", type=int, default=4)
+    parser.add_argument("--port", type=int, default=9140)
+    parser.add_argument("--upstream-port", type=int, default=9141)
+    args = parser.parse_args()
+
+    _seed_cookies(args.cookies)
+    sync_interval = 0.5
+    # 与 create_shared_state 相同的默认路径；显式传给代理，检查残留租约时读取同一个文件
+    state_path = settings.STATE_SQLITE_PATH or os.path.join(DATABASE_DIR, "shared_state.db")
+    env = {
+        **os.environ,
+        "CHAT_API_URL": f"http://127.0.0.1:{args.upstream_port}/api/chat",
+        "API_MASTER_KEY": API_KEY,
+        "STATE_BACKEND": "sqlite",
+        "STATE_SQLITE_PATH": state_path,
+        "STATE_SYNC_INTERVAL": str(sync_interval),
+        "TOKEN_REFRESH_ENABLED": "false",
+    }
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    upstream = _start(
+        ["-m", "benchmarks.mock_upstream", "--port", str(args.upstream_port),
+         "--ttfb-ms", "0", "--token-interval-ms", "0", "--tokens", str(args.tokens)],
+        env, f"http://127.0.0.1:{args.upstream_port}/stats"
+    )
+    results = []
+    try:
+        for workers in [int(w) for w in args.workers.split(",")]:
+            proxy = _start(
+                ["-m", "uvicorn", "main:app", "--port", str(args.port), "--workers", str(workers),
+                 "--log-level", "warning", "--no-access-log"],
+                env, f"{base_url}/"
+            )
+            try:
+                # 等所有 worker 都完成启动
+                time.sleep(1 + workers * 0.5)
+                load = asyncio.run(_load(base_url, args.concurrency, args.duration))
+                checks = _check_shared_state(base_url, args.cookies, sync_interval)
+                leaked = _leaked_leases(state_path)
+            finally:
+                proxy.terminate()
+                proxy.wait(timeout=30)
+            results.append((workers, load, checks, leaked))
+    finally:
+        upstream.terminate()
+        upstream.wait(timeout=10)
+
+    print(f"CPU 核数: {os.cpu_count()}，并发: {args.concurrency}，每个响应 {args.tokens} 个 token")
+    print(f"{'workers':>8} {'补全/秒':>10} {'扩展效率':>10} {'失败':>6} {'会话有效':>10} {'池已同步':>10} {'残留租约':>10}")
+    base = results[0][1]["throughput"] / results[0][0]
+    for workers, load, checks, leaked in results:
+        print(
+            f"{workers:>8} {load['throughput']:>10.1f} {load['throughput'] / (workers * base):>10.0%} {load['failed']:>6} "
+            f"{checks['session_ok']:>6}/{checks['checks']} {checks['pool_synced']:>6}/{checks['checks']} {leaked:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
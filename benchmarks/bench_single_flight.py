@@ -0,0 +1,172 @@
+"""
+单飞合并基准：同时发出 N 个相同请求时的上游请求数和首字延迟，并检查订阅者之间互不影响
+
+    python -m benchmarks.bench_single_flight --clients 16
+
+场景：
+  - 合并关闭 / 开启时，N 个相同请求（temperature=0）的上游请求数、TTFB 和输出是否一致
+  - 领导者读了几帧后断开，跟随者仍然收到完整输出
+  - 一个跟随者每帧都停顿（慢客户端），其他订阅者的完成时间不受影响
+  - 所有订阅者都中途断开后，上游连接被关闭、Cookie 租约被释放
+直接驱动 SmitheryProvider.chat_completion，上游为本地模拟服务。
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from typing import List, Optional
+
+import httpx
+
+from app.core.config import settings
+from app.db.database import init_db
+from app.providers.smithery_provider import SmitheryProvider
+from app.services.cookie_pool import cookie_pool
+from benchmarks.bench_single_stream import _fake_cookie
+from benchmarks.mock_upstream import MockUpstreamServer, config as mock_config
+
+REQUEST = {
+    "model": "claude-haiku-4.5",
+    "temperature": 0,
+    "messages": [{"role": "user", "content": "single flight"}],
+}
+
+
+async def _client(
+    provider: SmitheryProvider,
+    delay: float = 0.0,
+    stop_after: Optional[int] = None,
+    frame_pause: float = 0.0
+) -> dict:
+    """发起一个请求并读取 SSE，stop_after 帧后断开；返回 TTFB、完成时间、正文和单飞角色"""
+    await asyncio.sleep(delay)
+    start = time.perf_counter()
+    response = await provider.chat_completion(dict(REQUEST))
+    first = None
+    body = b""
+    frames = 0
+    iterator = response.body_iterator
+    try:
+        async for chunk in iterator:
+            if first is None:
+                first = time.perf_counter()
+            body += chunk
+            frames += 1
+            if stop_after is not None and frames >= stop_after:
+                break
+            if frame_pause:
+                await asyncio.sleep(frame_pause)
+    finally:
+        await iterator.aclose()
+        if response.background:
+            await response.background()
+    return {
+        "ttfb": (first - start) * 1000,
+        "total": (time.perf_counter() - start) * 1000,
+        "complete": body.endswith(b"data: [DONE]\n\n"),
+        "text": b"".join(
+            line for line in body.split(b"\n\n") if b'"content"' in line
+        ).count(b"tok"),
+        "role": response.headers.get("x-single-flight", "-"),
+    }
+
+
+async def _upstream_stats(server: MockUpstreamServer) -> dict:
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"http://{server.host}:{server.port}/stats")).json()
+
+
+async def _reset(server: MockUpstreamServer) -> None:
+    async with httpx.AsyncClient() as client:
+        await client.post(f"http://{server.host}:{server.port}/stats/reset")
+
+
+async def _concurrent(provider: SmitheryProvider, server: MockUpstreamServer, clients: int, mode: str) -> dict:
+    settings.SINGLE_FLIGHT_MODE = mode
+    await _reset(server)
+    # 请求在 50 ms 内陆续到达，后到的跟随者需要回放已产生的增量
+    results = await asyncio.gather(*(_client(provider, delay=i * 0.05 / clients) for i in range(clients)))
+    stats = await _upstream_stats(server)
+    return {"results": results, "upstream": stats["requests"]}
+
+
+async def _scenarios(provider: SmitheryProvider, server: MockUpstreamServer, clients: int) -> None:
+    tokens = mock_config.tokens
+    for mode in ("off", "deterministic"):
+        run = await _concurrent(provider, server, clients, mode)
+        results: List[dict] = run["results"]
+        ttfb = sorted(r["ttfb"] for r in results)
+        consistent = all(r["complete"] and r["text"] == tokens for r in results)
+        print(
+            f"SINGLE_FLIGHT_MODE={mode:<14} 上游请求 {run['upstream']:>3}/{clients}  "
+            f"TTFB p50 {statistics.median(ttfb):7.1f} ms  max {ttfb[-1]:7.1f} ms  输出完整一致: {consistent}"
+        )
+    settings.SINGLE_FLIGHT_MODE = "deterministic"
+
+    # 领导者读 3 帧后断开，跟随者在上游首字前后陆续加入
+    await _reset(server)
+    leader, *followers = await asyncio.gather(
+        _client(provider, stop_after=3),
+        *(_client(provider, delay=(i + 1) * mock_config.ttfb_ms / 3000) for i in range(3))
+    )
+    ok = leader["role"] == "leader" and all(
+        f["role"] == "follower" and f["complete"] and f["text"] == tokens for f in followers
+    )
+    print(f"领导者断开后跟随者完整收到输出: {ok}（上游请求 {(await _upstream_stats(server))['requests']}）")
+
+    # 一个慢跟随者：每帧停顿 50 ms，其他订阅者不应被拖慢
+    await _reset(server)
+    fast, slow, *others = await asyncio.gather(
+        _client(provider),
+        _client(provider, delay=0.01, frame_pause=0.05),
+        *(_client(provider, delay=0.02) for _ in range(2))
+    )
+    print(
+        f"慢订阅者: 快订阅者完成 {fast['total']:.0f} ms / {max(o['total'] for o in others):.0f} ms，"
+        f"慢订阅者完成 {slow['total']:.0f} ms，输出完整: {slow['complete'] and slow['text'] == tokens}"
+    )
+
+    # 所有订阅者中途断开：上游被取消，租约被释放
+    await _reset(server)
+    await asyncio.gather(*(_client(provider, delay=i * 0.01, stop_after=2) for i in range(3)))
+    await asyncio.sleep(0.2)
+    stats = await _upstream_stats(server)
+    leased = sum(cookie_pool.in_flight_counts().values())
+    print(f"全部断开: 上游请求 {stats['requests']}，上游完整输出 {stats['completed']}，残留租约 {leased}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--ttfb-ms", type=float, default=100.0)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--token-interval-ms", type=float, default=5.0)
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    mock_config.ttfb_ms = args.ttfb_ms
+    mock_config.tokens = args.tokens
+    mock_config.token_interval_ms = args.token_interval_ms
+
+    os.environ.setdefault("SMITHERY_COOKIE_1", _fake_cookie())
+    settings.COOKIE_MAX_CONCURRENCY = 0
+    init_db()
+    cookie_pool.load()
+
+    async def run(server: MockUpstreamServer):
+        provider = SmitheryProvider()
+        await provider.start()
+        try:
+            await _scenarios(provider, server, args.clients)
+        finally:
+            await provider.close()
+
+    with MockUpstreamServer(port=args.port) as server:
+        settings.CHAT_API_URL = server.chat_url
+        asyncio.run(run(server))
+
+
+if __name__ == "__main__":
+    main()
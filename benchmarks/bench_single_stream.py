@@ -0,0 +1,86 @@
+"""
+单次上游请求基准：测量每次补全的首字延迟（TTFB）和上游请求数
+
+    python -m benchmarks.bench_single_stream --requests 20
+
+启动本地模拟上游，把 CHAT_API_URL 指向它，然后直接驱动
+SmitheryProvider.chat_completion 并消费返回的流。
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import statistics
+import time
+
+import httpx
+
+from app.core.config import settings
+from app.db.database import init_db
+from app.providers.smithery_provider import SmitheryProvider
+from app.services.cookie_pool import cookie_pool
+from benchmarks.mock_upstream import MockUpstreamServer, config as mock_config
+
+
+def _fake_cookie() -> str:
+    payload = {"access_token": "bench", "user": {"id": "00000000-0000-0000-0000-00000000bench"}}
+    encoded = base64.b64encode(json.dumps(payload).encode()).decode()
+    return f"base64-{encoded}"
+
+
+async def _run(requests: int) -> dict:
+    provider = SmitheryProvider()
+    await provider.start()
+    ttfbs = []
+    totals = []
+    request_data = {"model": "claude-haiku-4.5", "messages": [{"role": "user", "content": "hi"}]}
+    try:
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = await provider.chat_completion(request_data)
+            first = None
+            async for _chunk in response.body_iterator:
+                if first is None:
+                    first = time.perf_counter()
+            if response.background:
+                await response.background()
+            ttfbs.append((first - start) * 1000)
+            totals.append((time.perf_counter() - start) * 1000)
+    finally:
+        await provider.close()
+    return {"ttfb": ttfbs, "total": totals}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--ttfb-ms", type=float, default=200.0)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+
+    mock_config.ttfb_ms = args.ttfb_ms
+    mock_config.tokens = args.tokens
+
+    # 通过环境变量 Cookie 回退路径给 Cookie 池提供一个假账号
+    os.environ.setdefault("SMITHERY_COOKIE_1", _fake_cookie())
+    init_db()
+    cookie_pool.load()
+
+    with MockUpstreamServer(port=args.port) as server:
+        settings.CHAT_API_URL = server.chat_url
+        result = asyncio.run(_run(args.requests))
+        upstream_requests = httpx.get(f"http://{server.host}:{server.port}/stats").json()["requests"]
+
+    ttfb = sorted(result["ttfb"])
+    print(f"补全数:            {args.requests}")
+    print(f"上游请求数:        {upstream_requests} ({upstream_requests / args.requests:.2f} 次/补全)")
+    print(f"TTFB p50:          {statistics.median(ttfb):.1f} ms")
+    print(f"TTFB max:          {ttfb[-1]:.1f} ms")
+    print(f"总耗时 p50:        {statistics.median(result['total']):.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
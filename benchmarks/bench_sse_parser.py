@@ -0,0 +1,184 @@
+"""
+上游 SSE 解析基准：对比按行解码 + 每个事件 json.loads 的旧解析方式
+与字节级增量解析器（app/utils/sse_parser.py）的每事件 CPU 时间和内存分配
+
+分两项报告：
+  - 解析：只比较切分事件和解码 JSON 的部分；字节级解析的收益主要来自不解码无需转发的事件
+  - 端到端：当前的 SmitheryProvider._iter_text_deltas（还包括首字延迟、增量间隔指标和用量解析）
+    与旧解析方式相比，每个事件固定的指标开销摊薄了解析上的收益
+
+    python -m benchmarks.bench_sse_parser --repeat 200
+    python -m benchmarks.bench_sse_parser --file stream.txt
+
+--file 指定录制的上游原始响应体（例如 curl -N 保存的输出）；
+不指定时使用内置的 Smithery（AI SDK）事件流样本。
+响应体按随机大小切成字节块，模拟网络分包，事件会跨块边界。
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import tracemalloc
+from typing import AsyncIterator, List
+
+import httpx
+
+from app.providers.smithery_provider import FINISH_REASON_MAP, FORWARDED_EVENT_TYPES, SmitheryProvider
+from app.utils.sse_parser import SSEDecoder, decode_json, iter_sse_data, sse_event_type
+
+
+def _sample_stream(deltas: int) -> bytes:
+    """按 Smithery 上游的事件格式（紧凑 JSON）生成一段推理 + 正文的响应体"""
+    rng = random.Random(0)
+    words = ["The", " quick", " brown", " fox", "，", "跳过", "了", "懒狗", "。", "\n", " `code`", " \"quoted\""]
+    events = [
+        {"type": "start", "messageId": "msg_0123456789abcdef"},
+        {"type": "start-step"},
+        {"type": "reasoning-start", "id": "r0"},
+    ]
+    for _ in range(deltas // 4):
+        events.append({"type": "reasoning-delta", "id": "r0", "delta": rng.choice(words),
+                       "providerMetadata": {"anthropic": {"signature": ""}}})
+    events.append({"type": "reasoning-end", "id": "r0"})
+    events.append({"type": "text-start", "id": "t0"})
+    for _ in range(deltas):
+        events.append({"type": "text-delta", "id": "t0", "delta": "".join(rng.choices(words, k=rng.randint(1, 3)))})
+    events += [
+        {"type": "text-end", "id": "t0"},
+        {"type": "finish-step"},
+        {"type": "finish", "finishReason": "stop"},
+    ]
+    body = "".join(f"data: {json.dumps(event, ensure_ascii=False, separators=(',', ':'))}\n\n" for event in events)
+    return (body + "data: [DONE]\n\n").encode("utf-8")
+
+
+def _split(body: bytes, max_chunk: int, seed: int = 1) -> List[bytes]:
+    rng = random.Random(seed)
+    chunks, offset = [], 0
+    while offset < len(body):
+        size = rng.randint(1, max_chunk)
+        chunks.append(body[offset:offset + size])
+        offset += size
+    return chunks
+
+
+def _response(chunks: List[bytes]) -> httpx.Response:
+    async def stream() -> AsyncIterator[bytes]:
+        for chunk in chunks:
+            yield chunk
+    return httpx.Response(200, content=stream())
+
+
+async def _legacy_text_deltas(response: httpx.Response, result: dict) -> AsyncIterator[str]:
+    """旧的解析方式：逐行解码为 str，每个事件都完整 json.loads"""
+    async for line in response.aiter_lines():
+        if not line or not line.startswith("data:"):
+            continue
+        content = line[5:].strip()
+        if content == "[DONE]":
+            break
+        try:
+            data = json.loads(content)
+        except json.JSONDecodeError:
+            continue
+        event_type = data.get("type")
+        if event_type == "text-delta":
+            delta_content = data.get("delta", "")
+            if delta_content:
+                yield delta_content
+        elif event_type == "finish":
+            finish_reason = data.get("finishReason")
+            if finish_reason:
+                result["finish_reason"] = FINISH_REASON_MAP.get(finish_reason, "stop")
+
+
+async def _legacy_deltas(response: httpx.Response, result: dict) -> List[str]:
+    return [delta async for delta in _legacy_text_deltas(response, result)]
+
+
+async def _parsed_deltas(response: httpx.Response, result: dict) -> List[str]:
+    """只有字节级解析（与 _iter_text_deltas 相同的切分和跳过方式，不记录指标）"""
+    deltas = []
+    async for content in iter_sse_data(response.aiter_bytes()):
+        if content == b"[DONE]":
+            break
+        if sse_event_type(content) not in FORWARDED_EVENT_TYPES:
+            continue
+        data = decode_json(content)
+        if data.get("type") == "text-delta":
+            delta_content = data.get("delta", "")
+            if delta_content:
+                deltas.append(delta_content)
+        elif data.get("type") == "finish" and data.get("finishReason"):
+            result["finish_reason"] = FINISH_REASON_MAP.get(data["finishReason"], "stop")
+    return deltas
+
+
+async def _current_deltas(response: httpx.Response, result: dict) -> List[str]:
+    provider = SmitheryProvider.__new__(SmitheryProvider)
+    return [delta async for delta in provider._iter_text_deltas(response, result, "bench", time.time())]
+
+
+async def _measure(parse, chunks: List[bytes], repeat: int) -> dict:
+    start = time.process_time()
+    for _ in range(repeat):
+        await parse(_response(chunks), {})
+    cpu = time.process_time() - start
+
+    tracemalloc.start()
+    await parse(_response(chunks), {})
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"cpu": cpu, "peak": peak}
+
+
+async def _verify(body: bytes) -> None:
+    """两种解析方式在各种分包方式下必须产出相同的文本和结束原因"""
+    expected_result = {}
+    expected = await _legacy_deltas(_response([body]), expected_result)
+    for chunks in ([body], _split(body, 1), _split(body, 7), _split(body, 4096)):
+        for parse in (_parsed_deltas, _current_deltas):
+            result = {}
+            assert await parse(_response(chunks), result) == expected
+            assert result.get("finish_reason") == expected_result.get("finish_reason")
+
+    # 多行 data 字段、\r\n 换行以及没有以空行结尾的最后一个事件
+    decoder = SSEDecoder()
+    events = [event for byte in b"data: a\r\ndata: b\r\n\r\n: comment\nevent: x\ndata: c" for event in decoder.feed(bytes([byte]))]
+    assert events + decoder.flush() == [b"a\nb", b"c"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--file", help="录制的上游原始响应体")
+    parser.add_argument("--deltas", type=int, default=400, help="内置样本中的 text-delta 数量")
+    parser.add_argument("--max-chunk", type=int, default=1024, help="模拟分包的最大字节数")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            body = f.read()
+    else:
+        body = _sample_stream(args.deltas)
+    events = body.count(b"\n\n")
+    chunks = _split(body, args.max_chunk)
+
+    asyncio.run(_verify(body))
+    legacy = asyncio.run(_measure(_legacy_deltas, chunks, args.repeat))
+    parsed = asyncio.run(_measure(_parsed_deltas, chunks, args.repeat))
+    current = asyncio.run(_measure(_current_deltas, chunks, args.repeat))
+
+    per_event = lambda r: r["cpu"] / (args.repeat * events) * 1e6
+    print(f"响应体:            {len(body)} 字节，{events} 个事件，{len(chunks)} 个字节块")
+    print(f"旧解析 CPU:        {per_event(legacy):.2f} µs/事件，峰值内存 {legacy['peak'] / 1024:.1f} KiB")
+    print(f"字节级解析 CPU:    {per_event(parsed):.2f} µs/事件，峰值内存 {parsed['peak'] / 1024:.1f} KiB"
+          f"  （解析加速 {legacy['cpu'] / parsed['cpu']:.2f}x）")
+    print(f"_iter_text_deltas: {per_event(current):.2f} µs/事件，峰值内存 {current['peak'] / 1024:.1f} KiB"
+          f"  （端到端加速 {legacy['cpu'] / current['cpu']:.2f}x）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+token 计数基准：计数精度以及长对话逐轮增长时按消息哈希缓存的效果
+
+    python -m benchmarks.bench_token_counter --bpe-file data/cl100k_base.tiktoken --turns 50
+
+指定 --bpe-file 时以该词表的精确计数为基准，比较估算（heuristic）的误差，
+并比较纯 Python BPE 与 tiktoken（如已安装）的结果是否一致；
+不指定时只测量估算的耗时。
+对话每轮追加一问一答，旧实现（len(str(messages))）与逐轮重新计数的耗时作为对照。
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+import app.services.token_counter as token_counter
+from app.services.token_counter import BPETokenCounter, TokenCounter, UsageEstimator
+
+WORDS = [
+    "the", "request", "stream", "upstream", "cookie", "latency", "configuration", "asynchronous",
+    "你好", "请求", "上游", "并发", "缓存", "。", "，", "(", ")", "{", "}", "=", "->", "42", "2025",
+    "def", "return", "self", "\n", "    ", "`code`", "\"quoted\"", "internationalization",
+]
+
+
+def _conversation(turns: int, words_per_message: int) -> list:
+    rng = random.Random(0)
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(turns):
+        for role in ("user", "assistant"):
+            text = " ".join(rng.choice(WORDS) for _ in range(words_per_message))
+            messages.append({"role": role, "content": text})
+    return messages
+
+
+def _accuracy(reference: TokenCounter, candidates: dict, texts: list) -> None:
+    expected = sum(reference.count(text) for text in texts)
+    print(f"基准（{reference.name}）: {expected} 个 token")
+    for name, counter in candidates.items():
+        actual = sum(counter.count(text) for text in texts)
+        print(f"  {name:<16} {actual:>8}  误差 {(actual - expected) / expected:+.1%}")
+
+
+async def _incremental(counter: TokenCounter, messages: list) -> dict:
+    """模拟客户端每轮发送完整历史：统计每轮计数的平均耗时"""
+    estimator = UsageEstimator(counter)
+    uncached = UsageEstimator(counter)
+    legacy = cached = full = 0.0
+    for end in range(3, len(messages) + 1, 2):
+        history = messages[:end]
+        start = time.perf_counter()
+        len(str(history))
+        legacy += time.perf_counter() - start
+
+        start = time.perf_counter()
+        await estimator.count_prompt(history)
+        cached += time.perf_counter() - start
+
+        uncached._messages.clear()
+        start = time.perf_counter()
+        await uncached.count_prompt(history)
+        full += time.perf_counter() - start
+    rounds = (len(messages) - 1) // 2
+    return {"legacy": legacy / rounds, "cached": cached / rounds, "full": full / rounds, "stats": estimator.stats()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bpe-file", help="tiktoken 格式的 BPE 词表")
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--words", type=int, default=200, help="每条消息的单词数")
+    args = parser.parse_args()
+
+    messages = _conversation(args.turns, args.words)
+    texts = [m["content"] for m in messages]
+    counters = {"heuristic": TokenCounter()}
+    if args.bpe_file:
+        tiktoken = token_counter.tiktoken
+        token_counter.tiktoken = None
+        counters["bpe（纯 Python）"] = BPETokenCounter(args.bpe_file)
+        token_counter.tiktoken = tiktoken
+        if tiktoken is not None:
+            counters["bpe（tiktoken）"] = BPETokenCounter(args.bpe_file)
+        reference = list(counters.values())[-1]
+        _accuracy(reference, counters, texts)
+
+    print(f"\n{len(messages)} 条消息、每条 {args.words} 词的对话逐轮增长，每轮 prompt 计数的平均耗时：")
+    for name, counter in counters.items():
+        result = asyncio.run(_incremental(counter, messages))
+        print(
+            f"  {name:<16} 按消息缓存 {result['cached'] * 1e3:8.3f} ms  每轮全部重算 {result['full'] * 1e3:8.3f} ms  "
+            f"（旧实现 len(str()) {result['legacy'] * 1e3:.3f} ms，缓存命中 {result['stats']['hits']}）"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+"""
+端到端压测：用本地模拟上游运行 main.py，以固定并发或开环到达率驱动 /v1/chat/completions
+
+    # 固定并发（闭环）：32 个客户端各自连续发送请求
+    python -m benchmarks.load_test --concurrency 32 --duration 30
+    # 开环：按 50 请求/秒的泊松到达发起请求，不等待前面的请求完成
+    python -m benchmarks.load_test --rate 50 --duration 30
+    # 注入上游错误：5% 的请求返回 429/503，2% 的流中途断开，5% 的流中途停顿 2 秒
+    python -m benchmarks.load_test --rate 50 --error-rate 0.05 --error-statuses 429,503 --drop-rate 0.02 --stall-rate 0.05
+    # 对比配置：--proxy-env 传给代理进程的环境变量，可重复
+    python -m benchmarks.load_test --concurrency 64 --workers 2 --proxy-env SINGLE_FLIGHT_MODE=off
+    # 压测已在运行的代理（其 CHAT_API_URL 需自行指向模拟上游），--pid 为采集 CPU/RSS 的进程
+    python -m benchmarks.load_test --url http://127.0.0.1:8000 --api-key sk-xxx --pid 1234 --rate 20
+
+默认在临时目录中启动模拟上游和 uvicorn main:app（数据库、共享状态都在临时目录，不影响 data/），
+结果可离线复现。报告包括：
+  - 吞吐（完成的补全/秒、内容帧/秒）和按结果分类的请求数
+  - 首字延迟（TTFB）与帧间隔的 p50/p95/p99
+  - 代理进程树的平均 CPU 占用和峰值 RSS，以及压测端自身的 CPU 占用
+开环模式下延迟从计划发送时间算起，压测端排队的时间也计入，避免协同遗漏（coordinated omission）。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# 只有内容帧带 "finish_reason": null；结束帧、usage 帧和 [DONE] 不计入帧间隔
+CONTENT_FRAME = b'"finish_reason": null'
+# 代理在流中途出错时以一个带 finish_reason 的帧告知客户端
+STREAM_ERROR_MARKER = json.dumps("流式传输错误")[1:-1].encode("ascii")
+DONE_FRAME = b"data: [DONE]\n\n"
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(q / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class ProcessMonitor:
+    """
+    定期采样进程及其所有子进程（uvicorn 的多个 worker）的 CPU 时间和 RSS。
+    安装了 psutil 时使用 psutil，否则读取 Linux 的 /proc；两者都不可用时不报告。
+    """
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self._cpu_start = self._cpu_end = 0.0
+        self._wall = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.available = psutil is not None or os.path.exists(f"/proc/{pid}/stat")
+
+    def _tree(self) -> List[int]:
+        if psutil is not None:
+            try:
+                process = psutil.Process(self.pid)
+                return [self.pid] + [child.pid for child in process.children(recursive=True)]
+            except psutil.Error:
+                return []
+        parents: Dict[int, int] = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat", "rb") as f:
+                        parents[int(entry)] = int(f.read().rsplit(b")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+        tree, frontier = [self.pid], [self.pid]
+        while frontier:
+            frontier = [pid for pid, ppid in parents.items() if ppid in frontier]
+            tree.extend(frontier)
+        return tree
+
+    def _sample(self) -> tuple:
+        """(进程树的累计 CPU 秒数, 进程树的 RSS 字节数)"""
+        cpu = rss = 0.0
+        for pid in self._tree():
+            try:
+                if psutil is not None:
+                    process = psutil.Process(pid)
+                    times = process.cpu_times()
+                    cpu += times.user + times.system
+                    rss += process.memory_info().rss
+                else:
+                    with open(f"/proc/{pid}/stat", "rb") as f:
+                        fields = f.read().rsplit(b")", 1)[1].split()
+                    cpu += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+                    with open(f"/proc/{pid}/statm", "rb") as f:
+                        rss += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            except Exception:
+                continue
+        return cpu, rss
+
+    def _run(self) -> None:
+        start = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            cpu, rss = self._sample()
+            self._cpu_end = cpu
+            self.peak_rss = max(self.peak_rss, rss)
+        self._wall = time.perf_counter() - start
+
+    def start(self) -> None:
+        if self.available:
+            self._cpu_start, self.peak_rss = self._sample()
+            self._cpu_end = self._cpu_start
+            self._thread.start()
+
+    def stop(self) -> dict:
+        if not self.available:
+            return {"cpu_percent": None, "peak_rss_mb": None}
+        self._stop.set()
+        self._thread.join()
+        cpu = (self._cpu_end - self._cpu_start) / self._wall * 100 if self._wall else 0.0
+        return {"cpu_percent": round(cpu, 1), "peak_rss_mb": round(self.peak_rss / 2 ** 20, 1)}
+
+
+async def _request(client: httpx.AsyncClient, body: dict, headers: dict, scheduled: float) -> dict:
+    """发送一个流式请求并读完响应；时间从 scheduled（计划发送时间）算起"""
+    result = {"outcome": "ok", "status": None, "ttfb": None, "gaps": [], "frames": 0, "total": None}
+    try:
+        async with client.stream("POST", "/v1/chat/completions", json=body, headers=headers) as response:
+            result["status"] = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                result["outcome"] = f"http_{response.status_code}"
+                return result
+            last = None
+            tail = b""
+            errored = False
+            async for chunk in response.aiter_raw():
+                frames = chunk.count(CONTENT_FRAME)
+                if frames:
+                    now = time.perf_counter()
+                    if last is None:
+                        result["ttfb"] = now - scheduled
+                    else:
+                        result["gaps"].append(now - last)
+                    last = now
+                    result["frames"] += frames
+                errored = errored or STREAM_ERROR_MARKER in chunk
+                tail = (tail + chunk)[-len(DONE_FRAME):]
+            if errored:
+                result["outcome"] = "stream_error"
+            elif tail != DONE_FRAME:
+                result["outcome"] = "incomplete"
+    except httpx.TimeoutException:
+        result["outcome"] = "timeout"
+    except httpx.HTTPError:
+        result["outcome"] = "transport_error"
+    finally:
+        result["total"] = time.perf_counter() - scheduled
+    return result
+
+
+class LoadGenerator:
+    """闭环（固定并发）或开环（固定到达率）地发送请求，汇总每个请求的结果"""
+
+    def __init__(self, base_url: str, api_key: str, args):
+        self.base_url = base_url
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.args = args
+        self.results: List[dict] = []
+        self._sequence = 0
+
+    def _body(self) -> dict:
+        # 默认每个请求的提示词不同，避免被单飞合并或补全缓存合并掉
+        self._sequence += 1
+        suffix = "" if self.args.identical else f" #{self._sequence}"
+        return {
+            "model": self.args.model,
+            "temperature": 0,
+            "messages": [{"role": "user", "content": "x" * self.args.prompt_chars + suffix}],
+        }
+
+    async def _closed_loop(self, client: httpx.AsyncClient, deadline: float) -> None:
+        async def worker():
+            while time.perf_counter() < deadline:
+                self.results.append(await _request(client, self._body(), self.headers, time.perf_counter()))
+
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+
+    async def _open_loop(self, client: httpx.AsyncClient, deadline: float) -> None:
+        rng = random.Random(self.args.seed)
+        tasks = []
+        scheduled = time.perf_counter()
+        while True:
+            scheduled += rng.expovariate(self.args.rate) if self.args.arrival == "poisson" else 1 / self.args.rate
+            if scheduled >= deadline:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(_request(client, self._body(), self.headers, scheduled)))
+        self.results.extend(await asyncio.gather(*tasks))
+
+    async def run(self) -> float:
+        """执行压测，返回实际耗时（秒）"""
+        # 开环模式下压测端的连接池不能成为排队点
+        connections = self.args.concurrency if self.args.rate is None else 10000
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+        timeout = httpx.Timeout(self.args.timeout, connect=10.0)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=timeout, limits=limits) as client:
+            start = time.perf_counter()
+            deadline = start + self.args.duration
+            if self.args.rate is None:
+                await self._closed_loop(client, deadline)
+            else:
+                await self._open_loop(client, deadline)
+            return time.perf_counter() - start
+
+
+def summarize(results: List[dict], elapsed: float) -> dict:
+    outcomes: Dict[str, int] = {}
+    for result in results:
+        outcomes[result["outcome"]] = outcomes.get(result["outcome"], 0) + 1
+    ok = [r for r in results if r["outcome"] == "ok"]
+    ttfb = [r["ttfb"] * 1000 for r in results if r["ttfb"] is not None]
+    gaps = [gap * 1000 for r in results for gap in r["gaps"]]
+    totals = [r["total"] * 1000 for r in ok]
+
+    def quantiles(values: List[float]) -> dict:
+        return {f"p{q}": _round(_percentile(values, q)) for q in (50, 95, 99)}
+
+    return {
+        "requests": len(results),
+        "outcomes": outcomes,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "frames_per_s": round(sum(r["frames"] for r in ok) / elapsed, 1) if elapsed else 0.0,
+        "ttfb_ms": quantiles(ttfb),
+        "inter_token_ms": quantiles(gaps),
+        "latency_ms": quantiles(totals),
+    }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 1)
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"进程已退出（{process.returncode}）: {' '.join(process.args)}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"等待 {url} 超时")
+
+
+def _start(args: list, env: dict, ready_url: str) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, *args], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        _wait_ready(ready_url, process)
+    except BaseException:
+        process.kill()
+        raise
+    return process
+
+
+def _spawn(args, workdir: str) -> tuple:
+    """在临时目录中启动模拟上游和代理，返回 (代理地址, API Key, 代理进程, 模拟上游进程)"""
+    api_key = "load-test-key"
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}"
+    env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'smithery.db')}",
+        "STATE_BACKEND": "sqlite",
+        "STATE_SQLITE_PATH": os.path.join(workdir, "shared_state.db"),
+        "CHAT_API_URL": f"{upstream_url}/api/chat",
+        "API_MASTER_KEY": api_key,
+        "TOKEN_REFRESH_ENABLED": "false",
+    }
+    for item in args.proxy_env:
+        name, _, value = item.partition("=")
+        env[name] = value
+
+    # 在代理使用的临时数据库中创建 Cookie（调用日志因此会写入数据库，与生产一致）
+    seed = (
+        "from benchmarks.bench_multi_worker import _seed_cookies; "
+        f"_seed_cookies({args.cookies})"
+    )
+    subprocess.run([sys.executable, "-c", seed], env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    upstream = _start(
+        ["-m", "benchmarks.mock_upstream", "--port", str(args.upstream_port),
+         "--ttfb-ms", str(args.ttfb_ms), "--tokens", str(args.tokens),
+         "--token-interval-ms", str(args.token_interval_ms),
+         "--error-rate", str(args.error_rate), "--error-statuses", args.error_statuses,
+         "--drop-rate", str(args.drop_rate), "--stall-rate", str(args.stall_rate),
+         "--stall-ms", str(args.stall_ms), "--seed", str(args.seed)],
+        env, f"{upstream_url}/stats"
+    )
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        proxy = _start(
+            ["-m", "uvicorn", "main:app", "--port", str(args.port), "--workers", str(args.workers),
+             "--log-level", "warning", "--no-access-log"],
+            env, f"{base_url}/"
+        )
+    except BaseException:
+        upstream.terminate()
+        raise
+    # 等所有 worker 都完成启动
+    time.sleep(0.5 + args.workers * 0.5)
+    return base_url, api_key, proxy, upstream
+
+
+def _print_report(report: dict) -> None:
+    summary = report["summary"]
+    mode = f"开环 {report['rate']} 请求/秒" if report["rate"] else f"并发 {report['concurrency']}"
+    print(f"\n{mode}，持续 {summary['elapsed_s']} 秒，共 {summary['requests']} 个请求")
+    print("结果: " + "，".join(f"{name} {count}" for name, count in sorted(summary["outcomes"].items())))
+    print(f"吞吐: {summary['throughput_rps']} 补全/秒，{summary['frames_per_s']} 内容帧/秒")
+    for label, key in (("TTFB", "ttfb_ms"), ("帧间隔", "inter_token_ms"), ("完整耗时", "latency_ms")):
+        q = summary[key]
+        print(f"{label:<8} p50 {q['p50']} ms  p95 {q['p95']} ms  p99 {q['p99']} ms")
+    proxy = report["proxy"]
+    if proxy["cpu_percent"] is not None:
+        print(f"代理进程: 平均 CPU {proxy['cpu_percent']}%（100% 为一个核），峰值 RSS {proxy['peak_rss_mb']} MB")
+    print(f"压测端: CPU {report['client_cpu_percent']}%", end="")
+    print("（接近 100% 时压测端可能成为瓶颈）" if report["client_cpu_percent"] > 90 else "")
+    if report.get("upstream"):
+        print("模拟上游: " + json.dumps(report["upstream"], ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    load = parser.add_argument_group("负载")
+    load.add_argument("--concurrency", type=int, default=16, help="闭环模式的并发客户端数")
+    load.add_argument("--rate", type=float, help="开环模式的到达率（请求/秒），指定后忽略 --concurrency")
+    load.add_argument("--arrival", choices=("poisson", "uniform"), default="poisson")
+    load.add_argument("--duration", type=float, default=20.0)
+    load.add_argument("--timeout", type=float, default=120.0, help="单个请求的读取超时（秒）")
+    load.add_argument("--model", default="claude-haiku-4.5")
+    load.add_argument("--prompt-chars", type=int, default=200)
+    load.add_argument("--identical", action="store_true", help="所有请求使用相同的提示词")
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--json", help="把完整报告写入该文件，便于比较不同版本")
+
+    target = parser.add_argument_group("目标")
+    target.add_argument("--url", help="已在运行的代理地址；不指定则自动启动模拟上游和代理")
+    target.add_argument("--api-key", help="--url 模式下使用的 API Key")
+    target.add_argument("--pid", type=int, help="--url 模式下采集 CPU/RSS 的代理进程 ID")
+    target.add_argument("--workers", type=int, default=1)
+    target.add_argument("--cookies", type=int, default=4)
+    target.add_argument("--port", type=int, default=9150)
+    target.add_argument("--proxy-env", action="append", default=[], metavar="NAME=VALUE")
+
+    upstream = parser.add_argument_group("模拟上游")
+    upstream.add_argument("--upstream-port", type=int, default=9151)
+    upstream.add_argument("--ttfb-ms", type=float, default=200.0)
+    upstream.add_argument("--tokens", type=int, default=100)
+    upstream.add_argument("--token-interval-ms", type=float, default=10.0)
+    upstream.add_argument("--error-rate", type=float, default=0.0)
+    upstream.add_argument("--error-statuses", default="401,403,429,500,502,503")
+    upstream.add_argument("--drop-rate", type=float, default=0.0)
+    upstream.add_argument("--stall-rate", type=float, default=0.0)
+    upstream.add_argument("--stall-ms", type=float, default=2000.0)
+    args = parser.parse_args()
+
+    proxy = upstream_process = None
+    workdir = tempfile.TemporaryDirectory(prefix="smithery-load-")
+    try:
+        if args.url:
+            base_url, api_key, pid = args.url, args.api_key or os.environ.get("API_MASTER_KEY", ""), args.pid
+        else:
+            base_url, api_key, proxy, upstream_process = _spawn(args, workdir.name)
+            pid = proxy.pid
+
+        monitor = ProcessMonitor(pid) if pid else None
+        if monitor is not None:
+            monitor.start()
+        client_start = resource.getrusage(resource.RUSAGE_SELF)
+        generator = LoadGenerator(base_url, api_key, args)
+        elapsed = asyncio.run(generator.run())
+        client_end = resource.getrusage(resource.RUSAGE_SELF)
+        client_cpu = (client_end.ru_utime + client_end.ru_stime - client_start.ru_utime - client_start.ru_stime)
+
+        report = {
+            "rate": args.rate,
+            "concurrency": None if args.rate else args.concurrency,
+            "workers": None if args.url else args.workers,
+            "proxy_env": args.proxy_env,
+            "summary": summarize(generator.results, elapsed),
+            "proxy": monitor.stop() if monitor is not None else {"cpu_percent": None, "peak_rss_mb": None},
+            "client_cpu_percent": round(client_cpu / elapsed * 100, 1),
+        }
+        if upstream_process is not None:
+            report["upstream"] = httpx.get(f"http://127.0.0.1:{args.upstream_port}/stats").json()
+    finally:
+        for process in (proxy, upstream_process):
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+        workdir.cleanup()
+
+    _print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+本地 Smithery 上游模拟服务
+
+以 Smithery 的 SSE 格式（data: {"type":"text-delta",...}）输出固定数量的 token，
+并统计收到的请求数，用于离线测量代理的首字延迟和上游请求次数。
+可以按比例注入错误：首字节前返回 401/403/429/5xx、流中途断开连接、流中途停顿。
+/stats 中的 active 为正在输出的响应数，cancelled 为下游（代理）提前关闭连接的响应数。
+
+独立运行：
+    python -m benchmarks.mock_upstream --port 9100
+    python -m benchmarks.mock_upstream --error-rate 0.05 --error-statuses 429,503 --drop-rate 0.02 --stall-rate 0.05
+然后将 CHAT_API_URL 指向 http://127.0.0.1:9100/api/chat。
+运行中可以通过 POST /config（JSON，字段同 MockConfig）修改行为参数。
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from typing import AsyncGenerator, Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+class MockConfig:
+    """模拟上游的行为参数"""
+    ttfb_ms: float = 200.0  # 首个事件前的延迟
+    tokens: int = 50  # 每次响应输出的 token 数
+    token_interval_ms: float = 5.0  # token 之间的间隔
+    token_text: str = "tok "
+    session_ttl: int = 3600  # 模拟令牌端点签发的会话有效期（秒）
+    token_refresh_status: int = 200  # 令牌端点返回的状态码，非 200 时返回 invalid_grant（refresh_token 已失效）
+    # 按账号注入错误：X-Posthog-Distinct-Id（Cookie 中的用户 ID）-> HTTP 状态码
+    fail_users: Dict[str, int] = {}
+    # 按比例注入错误（每个请求独立抽样）
+    error_rate: float = 0.0  # 首字节前返回错误状态码的比例
+    error_statuses: List[int] = [429, 500, 502, 503]  # 从中随机选择；429 和 503 带 Retry-After
+    drop_rate: float = 0.0  # 输出到一半时直接断开连接（不发送 finish 和 [DONE]）的比例
+    stall_rate: float = 0.0  # 输出到一半时停顿 stall_ms 的比例
+    stall_ms: float = 2000.0
+    seed: int = 0
+
+
+config = MockConfig()
+_random = random.Random(config.seed)
+
+# 请求统计
+stats = {
+    "requests": 0, "completed": 0, "token_refreshes": 0, "errors": 0, "drops": 0, "stalls": 0,
+    "active": 0, "cancelled": 0,
+}
+
+app = FastAPI(title="mock-smithery-upstream")
+
+
+def _event(data: dict) -> bytes:
+    return f"data: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+class InjectedDrop(Exception):
+    """在流中途抛出，uvicorn 随即断开连接，客户端收到不完整的分块响应"""
+
+
+async def _generate(drop: bool, stall: bool) -> AsyncGenerator[bytes, None]:
+    stats["active"] += 1
+    try:
+        async for chunk in _events(drop, stall):
+            yield chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        # 代理关闭了连接（Starlette 监听到断开后取消输出）
+        stats["cancelled"] += 1
+        raise
+    finally:
+        stats["active"] -= 1
+
+
+async def _events(drop: bool, stall: bool) -> AsyncGenerator[bytes, None]:
+    # 响应头立即返回，模拟上游生成首字前的耗时
+    await asyncio.sleep(config.ttfb_ms / 1000)
+    yield _event({"type": "start"})
+    delta = _event({"type": "text-delta", "id": "0", "delta": config.token_text})
+    half = config.tokens // 2
+    if config.token_interval_ms or drop or stall:
+        for i in range(config.tokens):
+            if i == half:
+                if drop:
+                    stats["drops"] += 1
+                    raise InjectedDrop("injected mid-stream drop")
+                if stall:
+                    stats["stalls"] += 1
+                    await asyncio.sleep(config.stall_ms / 1000)
+            await asyncio.sleep(config.token_interval_ms / 1000)
+            yield delta
+    else:
+        # 没有间隔时一次写出全部 token，模拟上游本身的开销尽量小（用于吞吐测试）
+        yield delta * config.tokens
+    yield _event({"type": "finish", "finishReason": "stop"})
+    yield b"data: [DONE]\n\n"
+    stats["completed"] += 1
+
+
+def _injected_error() -> JSONResponse:
+    status = _random.choice(config.error_statuses)
+    stats["errors"] += 1
+    headers = {"Retry-After": "1"} if status in (429, 503) else None
+    return JSONResponse({"error": f"injected {status}"}, status_code=status, headers=headers)
+
+
+@app.post("/api/chat")
+async def chat(request: Request):
+    stats["requests"] += 1
+    await request.body()
+    status = config.fail_users.get(request.headers.get("x-posthog-distinct-id", ""))
+    if status:
+        return JSONResponse({"error": f"injected {status}"}, status_code=status)
+    if config.error_rate and _random.random() < config.error_rate:
+        return _injected_error()
+    drop = bool(config.drop_rate) and _random.random() < config.drop_rate
+    stall = not drop and bool(config.stall_rate) and _random.random() < config.stall_rate
+    return StreamingResponse(_generate(drop, stall), media_type="text/event-stream")
+
+
+@app.post("/auth/v1/token")
+async def refresh_token(request: Request):
+    """模拟 Supabase 的 refresh_token 换新会话接口（TOKEN_REFRESH_URL 指向这里）"""
+    body = await request.json()
+    if not body.get("refresh_token") or not request.headers.get("apikey"):
+        return JSONResponse({"error": "invalid_grant"}, status_code=400)
+    if config.token_refresh_status != 200:
+        return JSONResponse({"error": "invalid_grant"}, status_code=config.token_refresh_status)
+    stats["token_refreshes"] += 1
+    n = stats["token_refreshes"]
+    return {
+        "access_token": f"mock-access-{n}",
+        "token_type": "bearer",
+        "expires_in": config.session_ttl,
+        "expires_at": int(time.time()) + config.session_ttl,
+        "refresh_token": f"mock-refresh-{n}",
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+def _config_dict() -> dict:
+    return {name: getattr(config, name) for name in MockConfig.__annotations__}
+
+
+@app.get("/config")
+async def get_config():
+    return _config_dict()
+
+
+@app.post("/config")
+async def update_config(request: Request):
+    """运行中修改行为参数，返回修改后的全部参数"""
+    for name, value in (await request.json()).items():
+        if not hasattr(MockConfig, name):
+            return JSONResponse({"error": f"unknown field {name}"}, status_code=400)
+        setattr(config, name, value)
+        if name == "seed":
+            _random.seed(value)
+    return _config_dict()
+
+
+@app.post("/stats/reset")
+async def reset_stats():
+    for key in stats:
+        if key != "active":  # 正在输出的响应数不是累计值
+            stats[key] = 0
+    return stats
+
+
+class MockUpstreamServer:
+    """在后台线程中运行模拟上游，供基准脚本直接使用"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9100):
+        self.host = host
+        self.port = port
+        self._server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    @property
+    def chat_url(self) -> str:
+        return f"http://{self.host}:{self.port}/api/chat"
+
+    @property
+    def token_url(self) -> str:
+        return f"http://{self.host}:{self.port}/auth/v1/token?grant_type=refresh_token"
+
+    def __enter__(self) -> "MockUpstreamServer":
+        self._thread.start()
+        deadline = time.time() + 10
+        while not self._server.started:
+            if time.time() > deadline:
+                raise RuntimeError("模拟上游启动超时")
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 Smithery 上游模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttfb-ms", type=float, default=config.ttfb_ms)
+    parser.add_argument("--tokens", type=int, default=config.tokens)
+    parser.add_argument("--token-interval-ms", type=float, default=config.token_interval_ms)
+    parser.add_argument("--error-rate", type=float, default=config.error_rate)
+    parser.add_argument("--error-statuses", default=",".join(map(str, config.error_statuses)),
+                        help="逗号分隔的状态码，例如 401,403,429,500")
+    parser.add_argument("--drop-rate", type=float, default=config.drop_rate)
+    parser.add_argument("--stall-rate", type=float, default=config.stall_rate)
+    parser.add_argument("--stall-ms", type=float, default=config.stall_ms)
+    parser.add_argument("--seed", type=int, default=config.seed)
+    parser.add_argument("--ssl-certfile", help="提供 HTTPS（与 --ssl-keyfile 一起使用），用于测量 TLS 握手")
+    parser.add_argument("--ssl-keyfile")
+    args = parser.parse_args()
+
+    config.ttfb_ms = args.ttfb_ms
+    config.tokens = args.tokens
+    config.token_interval_ms = args.token_interval_ms
+    config.error_rate = args.error_rate
+    config.error_statuses = [int(status) for status in args.error_statuses.split(",") if status]
+    config.drop_rate = args.drop_rate
+    config.stall_rate = args.stall_rate
+    config.stall_ms = args.stall_ms
+    config.seed = args.seed
+    _random.seed(args.seed)
+    uvicorn.run(
+        app, host=args.host, port=args.port, log_level="warning",
+        ssl_certfile=args.ssl_certfile, ssl_keyfile=args.ssl_keyfile
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,28 @@
+import asyncio
 import logging
+import uuid
 from contextlib import asynccontextmanager
 from typing import Optional
 
 from fastapi import FastAPI, Request, HTTPException, Depends, Header
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.background import BackgroundTasks
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
 
-from app.core.config import settings, mark_db_initialized
+from app.core.config import settings
 from app.providers.smithery_provider import SmitheryProvider
+from app.services.call_log_archiver import call_log_archiver
+from app.services.call_log_writer import call_log_writer
+from app.services.cookie_pool import cookie_pool
+from app.middleware.auth import validate_session
+from app.services.admission import AdmissionPermit, admission
+from app.services.api_keys import APIKeyEntry, api_keys
+from app.services.profiler import SamplingProfiler, profile_store
+from app.services.metrics import CONTENT_TYPE, metrics, model_label, register_http_client, requests_total
+from app.services.token_counter import BPETokenCounter, bpe_file_path, usage_estimator
+from app.services.token_refresher import token_refresher
 from app.routers import admin
 from app.db.database import init_db
 
@@ -23,24 +38,59 @@ async def lifespan(app: FastAPI):
     # 初始化数据库
     logger.info("初始化数据库...")
     init_db()
-    mark_db_initialized()
     logger.info("数据库初始化完成")
     
+    # 加载内存 Cookie 池，并开始跟随其他 worker 的变更
+    cookie_pool.load()
+    cookie_pool.start()
+    
+    # 启动调用日志后台写入器
+    call_log_writer.start()
+    # 超过保留期的调用日志移到归档文件（多 worker 时只在一个 worker 中执行）
+    call_log_archiver.start()
+    
+    # 跟随其他 worker 对客户端 API Key 的修改
+    api_keys.start()
+    
+    # 启动会话自动续期任务
+    token_refresher.start()
+    
+    # 创建上游 HTTP 客户端并预热连接，首个请求不必等待建连和 TLS 握手
+    await provider.start()
+    register_http_client(provider.client)
+    
+    # 多 worker 时定期发布本 worker 的监控指标快照
+    metrics.start()
+    
     # 检查 Cookie 配置
-    if not settings.AUTH_COOKIES:
+    if not len(cookie_pool):
         logger.warning("=" * 80)
         logger.warning("⚠️  未找到任何 Cookie 配置")
         logger.warning("请访问管理页面添加 Cookie 后才能使用 API 功能")
         logger.warning(f"管理页面地址: http://localhost:{settings.NGINX_PORT}/admin/login.html")
         logger.warning("=" * 80)
     else:
-        logger.info(f"✅ 已加载 {len(settings.AUTH_COOKIES)} 个 Cookie")
+        logger.info(f"✅ 已加载 {len(cookie_pool)} 个 Cookie")
+    
+    # 没有 BPE 词表时 token 用量只是估算
+    if not isinstance(usage_estimator.counter, BPETokenCounter) and settings.TOKENIZER.lower() != "heuristic":
+        logger.warning(f"⚠️  未找到 BPE 词表 {bpe_file_path()}，usage 和调用日志中的 token 数为估算值（误差约 ±15%）")
+        logger.warning("下载 https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken 放到该位置后重启即可精确计数")
     
     logger.info("服务已进入 'Cloudscraper' 模式，将自动处理 Cloudflare 挑战。")
     logger.info(f"🚀 服务已启动: http://localhost:{settings.NGINX_PORT}")
     logger.info(f"📋 管理页面: http://localhost:{settings.NGINX_PORT}/admin/login.html")
     logger.info(f"📖 API 文档: http://localhost:{settings.NGINX_PORT}/docs")
     yield
+    await metrics.stop()
+    await token_refresher.stop()
+    await api_keys.stop()
+    await call_log_archiver.stop()
+    # 客户端断开后补记的调用日志先交给写入器
+    await provider.flush_cancelled_logs()
+    await call_log_writer.stop()
+    await cookie_pool.stop()
+    await provider.close()
     logger.info("应用关闭。")
 
 app = FastAPI(
@@ -59,31 +109,178 @@ static_dir = os.path.join(os.path.dirname(__file__), "app", "static")
 if os.path.exists(static_dir):
     app.mount("/admin", StaticFiles(directory=static_dir, html=True), name="static")
 
-async def verify_api_key(authorization: Optional[str] = Header(None)):
+def _bearer_token(authorization: Optional[str]) -> str:
+    if not authorization or "bearer" not in authorization.lower():
+        raise HTTPException(status_code=401, detail="需要 Bearer Token 认证")
+    return authorization.split(" ")[-1]
+
+async def verify_master_key(authorization: Optional[str] = Header(None)):
+    """只接受 API_MASTER_KEY（管理类接口）"""
     if not settings.API_MASTER_KEY:
         raise HTTPException(status_code=503, detail="服务未配置 API 密钥")
     
-    if not authorization or "bearer" not in authorization.lower():
-        raise HTTPException(status_code=401, detail="需要 Bearer Token 认证")
+    if _bearer_token(authorization) != settings.API_MASTER_KEY:
+        raise HTTPException(status_code=403, detail="无效的 API Key")
+
+async def verify_api_key(authorization: Optional[str] = Header(None)) -> Optional[APIKeyEntry]:
+    """接受 API_MASTER_KEY（返回 None，不受限制）或管理界面创建的客户端 API Key"""
+    token = _bearer_token(authorization)
+    if settings.API_MASTER_KEY and token == settings.API_MASTER_KEY:
+        return None
     
-    token = authorization.split(" ")[-1]
-    if token != settings.API_MASTER_KEY:
+    entry = await api_keys.lookup(token)
+    if entry is None:
         raise HTTPException(status_code=403, detail="无效的 API Key")
+    return entry
+
+async def _start_profiler(admin_token: str) -> SamplingProfiler:
+    """X-Profile 请求头携带管理员会话令牌时，为这个请求开启采样剖析"""
+    if not await run_in_threadpool(validate_session, admin_token):
+        raise HTTPException(status_code=403, detail="X-Profile 需要有效的管理员会话令牌")
+    return profile_store.start()
+
+async def _profile_response(response, profile_id: str, profiler: SamplingProfiler):
+    """流式响应在输出结束（或客户端断开）时停止采样，其他响应立即停止；响应头 X-Profile-Id 为结果 ID"""
+    response.headers["X-Profile-Id"] = profile_id
+    if not isinstance(response, StreamingResponse):
+        await profile_store.finish(profile_id, profiler)
+        return response
+    body_iterator = response.body_iterator
+
+    async def profiled_body():
+        try:
+            async for chunk in body_iterator:
+                yield chunk
+        finally:
+            await profile_store.finish(profile_id, profiler)
 
-@app.post("/v1/chat/completions", dependencies=[Depends(verify_api_key)])
-async def chat_completions(request: Request) -> StreamingResponse:
+    response.body_iterator = profiled_body()
+    return response
+
+async def _wait_for_disconnect(request: Request) -> None:
+    """请求体读完后继续监听 ASGI receive 通道，收到 http.disconnect 时返回"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+async def _until_disconnect(awaitable, disconnected: asyncio.Task):
+    """
+    等待 awaitable 完成；客户端先断开时立即取消它（排队、等待上游响应头、非流式读取上游），
+    等它关闭上游并释放 Cookie 后抛出 ClientDisconnect。流式响应开始输出后由 Starlette 监听断开
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        await asyncio.wait((task, disconnected), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if task.done():
+        return task.result()
+    task.cancel()
+    await asyncio.wait((task,))
+    if not task.cancelled() and task.exception() is None:
+        # 取消的同时刚好完成（例如刚获得名额），把结果交给调用方清理
+        return task.result()
+    raise ClientDisconnect()
+
+def _release_after(response, permit: AdmissionPermit, key_stream=None):
+    """
+    流式响应在输出结束（或客户端断开）时归还准入名额和 API Key 的并发名额，其他响应立即归还；
+    排队时间加入 Server-Timing
+    """
+    releases = [permit.release] + ([key_stream.release] if key_stream is not None else [])
+    if "Server-Timing" in response.headers:
+        response.headers["Server-Timing"] = f"queue;dur={round(permit.waited * 1000, 1)}, " + response.headers["Server-Timing"]
+    if not isinstance(response, StreamingResponse):
+        for release in releases:
+            release()
+        return response
+    body_iterator = response.body_iterator
+
+    async def admitted_body():
+        try:
+            async for chunk in body_iterator:
+                yield chunk
+        finally:
+            for release in releases:
+                release()
+
+    response.body_iterator = admitted_body()
+    # 输出开始前客户端就断开时 body 可能没有被迭代，后台任务兜底（release 可重复调用）
+    background = response.background
+    response.background = BackgroundTasks()
+    if background is not None:
+        response.background.add_task(background)
+    for release in releases:
+        response.background.add_task(release)
+    return response
+
+@app.post("/v1/chat/completions")
+async def chat_completions(
+    request: Request,
+    api_key: Optional[APIKeyEntry] = Depends(verify_api_key),
+    x_profile: Optional[str] = Header(None),
+    x_queue_timeout_ms: Optional[str] = Header(None)
+):
+    model = "other"
+    profiler: Optional[SamplingProfiler] = None
+    permit: Optional[AdmissionPermit] = None
+    key_stream = None
+    disconnected: Optional[asyncio.Task] = None
+    profile_id = uuid.uuid4().hex
+    if x_profile:
+        profiler = await _start_profiler(x_profile)
     try:
         request_data = await request.json()
-        return await provider.chat_completion(request_data)
+        requested_model = request_data.get("model", "claude-haiku-4.5")
+        model = model_label(requested_model)
+        disconnected = asyncio.create_task(_wait_for_disconnect(request))
+        # 客户端 API Key 的模型权限、速率和并发限制在排队之前检查，超限的租户不占用全局名额
+        if api_key is not None:
+            key_stream = await api_keys.authorize(api_key, requested_model)
+        permit = await _until_disconnect(
+            admission.acquire(requested_model, admission.deadline(x_queue_timeout_ms)), disconnected
+        )
+        response = await _until_disconnect(
+            provider.chat_completion(request_data, request.headers, api_key.id if api_key is not None else None),
+            disconnected
+        )
+        requests_total.inc(model, str(response.status_code))
+        permit, admitted = None, permit
+        key_stream, key_admitted = None, key_stream
+        response = _release_after(response, admitted, key_admitted)
+        if profiler is not None:
+            profiler, running = None, profiler
+            response = await _profile_response(response, profile_id, running)
+        return response
+    except ClientDisconnect:
+        # 客户端在响应开始前断开：上游已取消，Cookie 和名额已释放
+        requests_total.inc(model, "499")
+        return Response(status_code=499)
+    except HTTPException as e:
+        requests_total.inc(model, str(e.status_code))
+        raise
     except Exception as e:
+        requests_total.inc(model, "500")
         logger.error(f"处理聊天请求时发生顶层错误: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"内部服务器错误: {str(e)}")
+    finally:
+        if disconnected is not None:
+            disconnected.cancel()
+        if permit is not None:
+            permit.release()
+        if key_stream is not None:
+            key_stream.release()
+        if profiler is not None:
+            # 请求出错时也保存已采集的样本
+            await profile_store.finish(profile_id, profiler)
 
 @app.get("/v1/models", dependencies=[Depends(verify_api_key)], response_class=JSONResponse)
 async def list_models():
     return await provider.get_models()
 
-@app.post("/v1/cookies/add", dependencies=[Depends(verify_api_key)])
+@app.post("/v1/cookies/add", dependencies=[Depends(verify_master_key)])
 async def add_cookie_via_api(request: Request):
     """
     通过 API 添加 Cookie（使用 API_MASTER_KEY 认证）
@@ -97,7 +294,6 @@ async def add_cookie_via_api(request: Request):
     try:
         from app.db.database import SessionLocal
         from app.db import crud
-        from app.core.config import reload_cookies_from_db
         
         data = await request.json()
         name = data.get("name")
@@ -106,13 +302,19 @@ async def add_cookie_via_api(request: Request):
         if not name or not cookie_data:
             raise HTTPException(status_code=400, detail="缺少必要参数：name 和 cookie_data")
         
-        db = SessionLocal()
+        def _create(name: str, cookie_data: str):
+            db = SessionLocal()
+            try:
+                return crud.create_cookie(db, name, cookie_data)
+            finally:
+                db.close()
+        
         try:
-            # 创建 Cookie
-            db_cookie = crud.create_cookie(db, name, cookie_data)
+            # 创建 Cookie（在线程池中执行，避免阻塞事件循环）
+            db_cookie = await run_in_threadpool(_create, name, cookie_data)
             
-            # 重新加载配置
-            reload_cookies_from_db()
+            # 增量更新内存 Cookie 池（会访问共享状态，同样放到线程池中）
+            await run_in_threadpool(cookie_pool.sync, db_cookie)
             
             return {
                 "success": True,
@@ -125,8 +327,6 @@ async def add_cookie_via_api(request: Request):
             }
         except ValueError as e:
             raise HTTPException(status_code=400, detail=str(e))
-        finally:
-            db.close()
             
     except HTTPException:
         raise
@@ -134,9 +334,18 @@ async def add_cookie_via_api(request: Request):
         logger.error(f"添加 Cookie 失败: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"添加失败: {str(e)}")
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(authorization: Optional[str] = Header(None)):
+    """Prometheus 抓取端点，多 worker 时汇总所有存活 worker 的指标"""
+    if not settings.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if settings.METRICS_TOKEN and authorization != f"Bearer {settings.METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="需要 Bearer Token 认证")
+    return Response(content=await metrics.render(), media_type=CONTENT_TYPE)
+
 @app.get("/", summary="根路径")
 def root():
-    cookie_count = len(settings.AUTH_COOKIES)
+    cookie_count = len(cookie_pool)
     return {
         "message": f"欢迎来到 {settings.APP_NAME} v{settings.APP_VERSION}",
         "status": "running",
@@ -10,7 +10,7 @@ from pathlib import Path
 
 DB_PATH = "data/smithery.db"
 
-def migrate():
+def migrate(vacuum: bool = False):
     if not Path(DB_PATH).exists():
         print("数据库文件不存在，跳过迁移")
         return
@@ -56,13 +56,139 @@ def migrate():
         """)
         print("✓ api_call_logs 表检查/创建成功")
         
-        # 创建索引
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_call_logs_cookie_id ON api_call_logs(cookie_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_call_logs_model ON api_call_logs(model)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_call_logs_created_at ON api_call_logs(created_at)")
+        # 添加 timings 列（各阶段耗时）
+        cursor.execute("PRAGMA table_info(api_call_logs)")
+        if 'timings' not in [row[1] for row in cursor.fetchall()]:
+            print("添加 timings 列...")
+            cursor.execute("ALTER TABLE api_call_logs ADD COLUMN timings TEXT")
+            print("✓ timings 列添加成功")
+        
+        # 添加 coalesced 列（单飞跟随者的调用）
+        cursor.execute("PRAGMA table_info(api_call_logs)")
+        if 'coalesced' not in [row[1] for row in cursor.fetchall()]:
+            print("添加 coalesced 列...")
+            cursor.execute("ALTER TABLE api_call_logs ADD COLUMN coalesced BOOLEAN")
+            print("✓ coalesced 列添加成功")
+        
+        # 创建 api_keys 表（客户端 API Key）并为调用日志添加 api_key_id 列
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS api_keys (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name VARCHAR(100) NOT NULL UNIQUE,
+                key_hash VARCHAR(64) NOT NULL UNIQUE,
+                key_prefix VARCHAR(16) NOT NULL,
+                is_active BOOLEAN NOT NULL DEFAULT 1,
+                rate_limit FLOAT,
+                burst INTEGER,
+                max_concurrency INTEGER,
+                allowed_models TEXT,
+                created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("PRAGMA table_info(api_call_logs)")
+        if 'api_key_id' not in [row[1] for row in cursor.fetchall()]:
+            print("添加 api_key_id 列...")
+            cursor.execute("ALTER TABLE api_call_logs ADD COLUMN api_key_id INTEGER REFERENCES api_keys (id)")
+            print("✓ api_key_id 列添加成功")
+        
+        # smithery_cookies 重建为 AUTOINCREMENT 表：删除 Cookie 时保留其调用日志，新 Cookie 不能复用已删除的 ID
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'smithery_cookies'")
+        if 'AUTOINCREMENT' not in cursor.fetchone()[0].upper():
+            print("重建 smithery_cookies 表（AUTOINCREMENT）...")
+            cursor.execute("""
+                CREATE TABLE smithery_cookies_new (
+                    id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                    name VARCHAR(100) NOT NULL,
+                    cookie_data TEXT(50000) NOT NULL,
+                    is_active BOOLEAN NOT NULL,
+                    usage_count INTEGER NOT NULL DEFAULT 0,
+                    last_used_at DATETIME,
+                    created_at DATETIME NOT NULL,
+                    updated_at DATETIME NOT NULL
+                )
+            """)
+            cursor.execute("""
+                INSERT INTO smithery_cookies_new
+                    (id, name, cookie_data, is_active, usage_count, last_used_at, created_at, updated_at)
+                SELECT id, name, cookie_data, is_active, usage_count, last_used_at, created_at, updated_at
+                FROM smithery_cookies
+            """)
+            cursor.execute("DROP TABLE smithery_cookies")
+            cursor.execute("ALTER TABLE smithery_cookies_new RENAME TO smithery_cookies")
+            cursor.execute("CREATE UNIQUE INDEX ix_smithery_cookies_name ON smithery_cookies (name)")
+            cursor.execute("CREATE INDEX ix_smithery_cookies_id ON smithery_cookies (id)")
+            # 之前已删除的 Cookie 中 ID 最大的一个也不能再分配（表为空时 sqlite_sequence 中还没有这一行）
+            cursor.execute("SELECT MAX(COALESCE((SELECT MAX(id) FROM smithery_cookies), 0), COALESCE(MAX(cookie_id), 0)) FROM api_call_logs")
+            last_id = cursor.fetchone()[0]
+            cursor.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'smithery_cookies'", (last_id,))
+            if cursor.rowcount == 0:
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('smithery_cookies', ?)", (last_id,))
+            print("✓ smithery_cookies 表重建成功")
+        
+        # 创建索引，与新建数据库（models.py）一致：单列的 cookie_id、model、api_key_id 索引已被下面的组合索引取代，
+        # 旧版本建立的删除掉，避免每次写入日志都多维护几个索引（与 database.py 的 _SUPERSEDED_INDEXES 相同）
+        for name in ("cookie_id", "model", "api_key_id"):
+            cursor.execute(f"DROP INDEX IF EXISTS idx_call_logs_{name}")
+            cursor.execute(f"DROP INDEX IF EXISTS ix_api_call_logs_{name}")
+        cursor.execute("DROP INDEX IF EXISTS idx_call_logs_created_at")
+        cursor.execute("DROP INDEX IF EXISTS ix_api_call_logs_id")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_api_call_logs_created_at ON api_call_logs(created_at)")
+        # 调用日志按 (created_at, id) 分页时各筛选条件使用的组合索引
+        for column in ("cookie_id", "api_key_id", "model", "status"):
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS ix_api_call_logs_{column}_created_at ON api_call_logs({column}, created_at)"
+            )
         print("✓ 索引创建成功")
         
+        # 创建按状态累计调用次数的计数表，为空时按现有日志初始化
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS call_log_counters (
+                status VARCHAR(20) NOT NULL PRIMARY KEY,
+                calls INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        cursor.execute("""
+            INSERT INTO call_log_counters (status, calls)
+            SELECT COALESCE(status, 'success'), COUNT(*) FROM api_call_logs
+            WHERE NOT EXISTS (SELECT 1 FROM call_log_counters)
+            GROUP BY COALESCE(status, 'success')
+        """)
+        print("✓ call_log_counters 表检查/创建成功")
+        
+        # 创建按 API Key 累计用量的计数表，为空时按现有日志初始化
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS api_key_usage (
+                api_key_id INTEGER NOT NULL PRIMARY KEY REFERENCES api_keys (id),
+                calls INTEGER NOT NULL DEFAULT 0,
+                error_calls INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        cursor.execute("""
+            INSERT INTO api_key_usage (api_key_id, calls, error_calls, prompt_tokens, completion_tokens)
+            SELECT api_key_id, COUNT(*), SUM(CASE WHEN status = 'error' THEN 1 ELSE 0 END),
+                   COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0)
+            FROM api_call_logs
+            WHERE api_key_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM api_key_usage)
+            GROUP BY api_key_id
+        """)
+        print("✓ api_key_usage 表检查/创建成功")
+        
         conn.commit()
+        
+        # 启用增量 auto_vacuum（已有数据库需要 VACUUM 重建一次，耗时与数据库大小成正比，只在指定 --vacuum 时执行，请在停机时运行）
+        cursor.execute("PRAGMA auto_vacuum")
+        if cursor.fetchone()[0] != 2:
+            if vacuum:
+                print("启用增量 auto_vacuum（VACUUM 重建数据库）...")
+                cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                cursor.execute("VACUUM")
+                print("✓ 增量 auto_vacuum 已启用")
+            else:
+                print("未启用增量 auto_vacuum：开启调用日志归档时，可在停机时运行 python migrate_db.py --vacuum 重建数据库")
+        
         print("\n数据库迁移完成！")
         
     except Exception as e:
@@ -73,5 +199,5 @@ def migrate():
         conn.close()
 
 if __name__ == "__main__":
-    migrate()
+    migrate(vacuum="--vacuum" in sys.argv[1:])
 
@@ -0,0 +1,110 @@
+"""
+测试环境：配置在 app 导入时读取，所以在导入任何 app 模块之前设置环境变量。
+主数据库放在临时目录，共享状态使用内存实现；上游由测试启动的本地模拟服务（benchmarks.mock_upstream）提供。
+"""
+
+import os
+import tempfile
+
+_workdir = tempfile.mkdtemp(prefix="smithery-tests-")
+
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(_workdir, 'smithery.db')}",
+    "STATE_BACKEND": "memory",
+    "API_MASTER_KEY": "test-master-key",
+    "TOKEN_REFRESH_ENABLED": "false",
+    "CALL_LOG_RETENTION_DAYS": "0",
+    "UPSTREAM_WARMUP_CONNECTIONS": "0",
+})
+
+import asyncio  # noqa: E402
+import base64  # noqa: E402
+import json  # noqa: E402
+import socket  # noqa: E402
+import time  # noqa: E402
+from typing import Awaitable, Callable, List  # noqa: E402
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+import uvicorn  # noqa: E402
+
+from app.core.config import settings  # noqa: E402
+from app.db import crud  # noqa: E402
+from app.db.database import SessionLocal, init_db  # noqa: E402
+from benchmarks.mock_upstream import MockUpstreamServer, config as mock_config, stats as mock_stats  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def fake_cookie(n: int, **session) -> str:
+    """模拟上游接受任意令牌；用户 ID 各不相同，可以按账号注入错误。session 中的字段（expires_at、refresh_token 等）并入会话"""
+    payload = {"access_token": f"test-{n}", "user": {"id": f"00000000-0000-0000-0000-{n:012d}"}, **session}
+    return "base64-" + base64.b64encode(json.dumps(payload).encode()).decode()
+
+
+@pytest.fixture
+def seed_cookies() -> Callable[[int], List[int]]:
+    """在数据库中建好 count 个 Cookie（已存在的不重复创建），返回它们的 ID；只有数据库中的 Cookie 会记录调用日志"""
+    def seed(count: int) -> List[int]:
+        init_db()
+        db = SessionLocal()
+        try:
+            ids = []
+            for n in range(1, count + 1):
+                cookie = crud.get_cookie_by_name(db, f"test-{n}") or crud.create_cookie(db, f"test-{n}", fake_cookie(n))
+                ids.append(cookie.id)
+            return ids
+        finally:
+            db.close()
+
+    return seed
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """
+    在后台线程中运行模拟上游并把 CHAT_API_URL 指向它。
+    测试可以直接修改 mock_config，结束后恢复；统计在开始时清零
+    """
+    saved = dict(vars(mock_config))
+    for key in mock_stats:
+        if key != "active":
+            mock_stats[key] = 0
+    with MockUpstreamServer(port=free_port()) as server:
+        monkeypatch.setattr(settings, "CHAT_API_URL", server.chat_url)
+        yield server
+    vars(mock_config).clear()
+    vars(mock_config).update(saved)
+
+
+@pytest.fixture
+def serve_app() -> Callable[[Callable[[httpx.AsyncClient], Awaitable[None]]], None]:
+    """
+    返回 run(scenario)：在当前进程中用 uvicorn 运行代理（执行 lifespan），
+    以指向它的 httpx 客户端调用 scenario，结束后立即关闭服务（不等待后台任务完成）
+    """
+    from main import app
+
+    async def serve(scenario) -> None:
+        config = uvicorn.Config(app, host="127.0.0.1", port=free_port(), log_level="warning", lifespan="on")
+        server = uvicorn.Server(config)
+        serving = asyncio.create_task(server.serve())
+        deadline = time.monotonic() + 5
+        while not server.started:
+            assert time.monotonic() < deadline, "等待服务启动超时"
+            await asyncio.sleep(0.01)
+        try:
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{server.config.port}", timeout=10) as client:
+                await scenario(client)
+        finally:
+            server.should_exit = True
+            await serving
+
+    def run(scenario) -> None:
+        asyncio.run(serve(scenario))
+
+    return run
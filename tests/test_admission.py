@@ -0,0 +1,139 @@
+"""
+准入控制：名额不足且不愿等待或队列已满时返回 429，排队超时返回 503，两者都带 Retry-After；
+归还名额时按到达顺序放行，某个模型满额不挡住其他模型，排队期间取消的请求离开队列。
+"""
+
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.services.admission import AdmissionController, admission
+from benchmarks.mock_upstream import config as mock_config, stats as mock_stats
+
+MODEL = "claude-haiku-4.5"
+OTHER_MODEL = "claude-sonnet-4.5"
+
+
+@pytest.fixture(autouse=True)
+def _limits(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(settings, "ADMISSION_MODEL_LIMITS", {})
+    monkeypatch.setattr(settings, "ADMISSION_QUEUE_SIZE", 1)
+
+
+async def _rejected(acquire) -> HTTPException:
+    with pytest.raises(HTTPException) as excinfo:
+        await acquire
+    return excinfo.value
+
+
+def test_busy_queue_full_and_timeout_rejections():
+    async def run():
+        controller = AdmissionController()
+        held = await controller.acquire(MODEL, 1.0)
+
+        busy = await _rejected(controller.acquire(MODEL, 0))
+        assert busy.status_code == 429 and int(busy.headers["Retry-After"]) >= 1
+
+        queued = asyncio.create_task(controller.acquire(MODEL, 0.05))
+        await asyncio.sleep(0)
+        assert controller.queue_depth == 1
+        full = await _rejected(controller.acquire(MODEL, 1.0))
+        assert full.status_code == 429 and int(full.headers["Retry-After"]) >= 1
+
+        timeout = await _rejected(queued)
+        assert timeout.status_code == 503 and int(timeout.headers["Retry-After"]) >= 1
+        assert controller.queue_depth == 0
+        held.release()
+        assert controller.active == 0
+
+    asyncio.run(run())
+
+
+def test_release_admits_waiters_in_order_without_head_of_line_blocking(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_MAX_CONCURRENCY", 2)
+    monkeypatch.setattr(settings, "ADMISSION_MODEL_LIMITS", {MODEL: 1})
+    monkeypatch.setattr(settings, "ADMISSION_QUEUE_SIZE", 10)
+
+    async def run():
+        controller = AdmissionController()
+        first = await controller.acquire(MODEL, 1.0)
+        other = await controller.acquire(OTHER_MODEL, 1.0)
+        # 全局名额用完：两个 MODEL 请求和一个 OTHER_MODEL 请求依次排队
+        waiters = [asyncio.create_task(controller.acquire(model, 1.0)) for model in (MODEL, OTHER_MODEL, MODEL)]
+        await asyncio.sleep(0)
+        assert controller.queue_depth == 3
+
+        # 空出的是 OTHER_MODEL 的名额：排在最前的 MODEL 请求仍然满额，跳过它放行 OTHER_MODEL
+        other.release()
+        await asyncio.sleep(0.01)
+        assert [task.done() for task in waiters] == [False, True, False]
+
+        # MODEL 的名额空出后放行最早排队的 MODEL 请求
+        first.release()
+        await asyncio.sleep(0.01)
+        assert [task.done() for task in waiters] == [True, True, False]
+        assert controller.active_counts() == {MODEL: 1, "other": 1}
+
+        for task in waiters[:2]:
+            task.result().release()
+        await asyncio.sleep(0.01)
+        waiters[2].result().release()
+        assert controller.active == 0 and controller.queue_depth == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        controller = AdmissionController()
+        held = await controller.acquire(MODEL, 1.0)
+        queued = asyncio.create_task(controller.acquire(MODEL, 1.0))
+        await asyncio.sleep(0)
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        assert controller.queue_depth == 0
+        held.release()
+        assert controller.active == 0
+
+    asyncio.run(run())
+
+
+def test_rejections_reach_the_client_with_retry_after(seed_cookies, upstream, serve_app):
+    mock_config.ttfb_ms = 300
+    mock_config.tokens = 1
+    seed_cookies(1)
+
+    def chat(client: httpx.AsyncClient, content: str, queue_timeout_ms: str = None):
+        headers = {"Authorization": f"Bearer {settings.API_MASTER_KEY}"}
+        if queue_timeout_ms is not None:
+            headers["X-Queue-Timeout-Ms"] = queue_timeout_ms
+        body = {"model": MODEL, "stream": False, "messages": [{"role": "user", "content": content}]}
+        return client.post("/v1/chat/completions", json=body, headers=headers)
+
+    async def scenario(client: httpx.AsyncClient) -> None:
+        running = asyncio.create_task(chat(client, "admitted"))
+        while admission.active == 0:
+            await asyncio.sleep(0.01)
+
+        busy = await chat(client, "busy", "0")
+        assert busy.status_code == 429 and int(busy.headers["Retry-After"]) >= 1
+
+        timed_out = await chat(client, "queued", "50")
+        assert timed_out.status_code == 503 and int(timed_out.headers["Retry-After"]) >= 1
+
+        assert (await running).status_code == 200
+        # 名额在响应发送完后归还
+        for _ in range(100):
+            if admission.active == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert admission.active == 0 and admission.queue_depth == 0
+
+    serve_app(scenario)
+    # 被拒绝的请求没有访问上游
+    assert mock_stats["requests"] == 1
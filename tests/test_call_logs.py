@@ -0,0 +1,100 @@
+"""
+调用日志的写入、统计与查询：按 API Key 累计的用量与全局统计使用同样的状态分类；
+管理接口按 (created_at, id) 游标分页，翻页期间写入的新日志不会让后面的页重复或遗漏。
+"""
+
+from datetime import datetime, timedelta
+from typing import List
+
+import httpx
+
+from app.core.config import settings
+from app.db import crud
+from app.db.database import SessionLocal
+from app.services.call_log_writer import CallLogWriter
+
+PAGINATION_MODEL = "pagination-test"
+
+
+def _entry(cookie_id: int, api_key_id: int, status: str, model: str = "claude-haiku-4.5", created_at: datetime = None) -> dict:
+    return {
+        "cookie_id": cookie_id, "api_key_id": api_key_id, "model": model, "prompt_tokens": 10,
+        "completion_tokens": 5, "status": status, "error_message": None, "duration_ms": 1, "timings": None,
+        "coalesced": False, "created_at": created_at or datetime.utcnow(),
+    }
+
+
+def test_api_key_error_calls_exclude_cancelled(seed_cookies):
+    cookie_id, = seed_cookies(1)
+    db = SessionLocal()
+    try:
+        key, _ = crud.create_api_key(db, "usage-status")
+        stats_before = crud.get_call_stats(db)
+    finally:
+        db.close()
+
+    CallLogWriter._write_batch([_entry(cookie_id, key.id, status) for status in ("success", "error", "cancelled")])
+
+    db = SessionLocal()
+    try:
+        usage = crud.get_api_key_usage(db)[key.id]
+        stats = crud.get_call_stats(db)
+    finally:
+        db.close()
+    assert usage == {"calls": 3, "error_calls": 1, "prompt_tokens": 30, "completion_tokens": 15}
+    assert stats["error_calls"] - stats_before["error_calls"] == usage["error_calls"]
+    assert stats["cancelled_calls"] - stats_before["cancelled_calls"] == 1
+
+
+async def _admin_headers(client: httpx.AsyncClient) -> dict:
+    response = await client.post("/api/admin/auth/verify", json={"password": settings.API_MASTER_KEY})
+    return {"Authorization": f"Bearer {response.json()['token']}"}
+
+
+async def _page(client: httpx.AsyncClient, headers: dict, **params) -> dict:
+    response = await client.get(
+        "/api/admin/call-logs", params={"model": PAGINATION_MODEL, **params}, headers=headers
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_call_log_cursor_is_stable_across_new_writes(seed_cookies, serve_app):
+    cookie_id, = seed_cookies(1)
+    base = datetime.utcnow() - timedelta(hours=1)
+    # 两两相同的创建时间：游标必须用 id 区分同一时刻的日志
+    CallLogWriter._write_batch([
+        _entry(cookie_id, None, "success", PAGINATION_MODEL, base + timedelta(seconds=n // 2)) for n in range(8)
+    ])
+
+    async def scenario(client: httpx.AsyncClient) -> None:
+        headers = await _admin_headers(client)
+        expected = [log["id"] for log in (await _page(client, headers, limit=1000))["data"]]
+        assert len(expected) == 8
+
+        first = await _page(client, headers, limit=3)
+        seen: List[int] = [log["id"] for log in first["data"]]
+        # 翻页期间写入更新的日志，以及与游标位置同一时刻的日志
+        CallLogWriter._write_batch([
+            _entry(cookie_id, None, "success", PAGINATION_MODEL, datetime.utcnow()),
+            _entry(cookie_id, None, "success", PAGINATION_MODEL, base + timedelta(seconds=2)),
+        ])
+        cursor = first["next_cursor"]
+        while cursor:
+            page = await _page(client, headers, limit=3, cursor=cursor)
+            seen.extend(log["id"] for log in page["data"])
+            cursor = page["next_cursor"]
+        # 新日志的 id 更大，排在游标之前，不出现在后面的页中
+        assert seen == expected
+
+        # 游标与 until 组合时仍从游标位置继续
+        until = (base + timedelta(seconds=2)).isoformat()
+        first = await _page(client, headers, limit=1, until=until)
+        rest = await _page(client, headers, limit=10, until=until, cursor=first["next_cursor"])
+        assert [log["id"] for log in first["data"] + rest["data"]] == expected[-4:]
+        assert rest["next_cursor"] is None
+
+        response = await client.get("/api/admin/call-logs", params={"cursor": "not-a-cursor"}, headers=headers)
+        assert response.status_code == 400
+
+    serve_app(scenario)
@@ -0,0 +1,58 @@
+"""
+Cookie 池的熔断选取：半开状态的 Cookie 只放行一个探测请求，
+即使共享状态的租约调用让出了事件循环，并发的请求也不会被当作普通请求发给它。
+"""
+
+import asyncio
+
+from app.core.config import AuthCookie
+from app.services.cookie_health import HALF_OPEN, OPEN
+from app.services.cookie_pool import CookiePool, PooledCookie
+from app.services.shared_state import shared_state
+from tests.conftest import fake_cookie
+
+
+def _half_open_pool() -> CookiePool:
+    pool = CookiePool()
+    cookie = PooledCookie(None, "probe-test", AuthCookie(fake_cookie(1)))
+    pool._env_cookies = (cookie,)
+    pool._rebuild_snapshot()
+    health = pool._health_for(cookie.key)
+    health.state = OPEN
+    health.failures = 1
+    health.open_until = 0.0
+    return pool
+
+
+def test_half_open_cookie_admits_a_single_probe(monkeypatch):
+    original_call = shared_state.call
+
+    async def yielding_call(method, *args, undo=None):
+        # SQLite / Redis 后端在线程中执行，期间其他请求可以继续选取
+        await asyncio.sleep(0)
+        return await original_call(method, *args, undo=undo)
+
+    monkeypatch.setattr(shared_state, "call", yielding_call)
+    pool = _half_open_pool()
+
+    async def run():
+        return await asyncio.gather(pool.acquire(), pool.acquire())
+
+    first, second = asyncio.run(run())
+    assert first is not None and first.probe
+    assert second is None
+    assert pool._health["probe-test"].state == HALF_OPEN
+    first.release()
+    assert shared_state.in_flight_counts() == {}
+
+
+def test_probe_slot_is_freed_when_the_probe_is_released():
+    pool = _half_open_pool()
+    lease = asyncio.run(pool.acquire())
+    assert lease.probe
+    lease.release()
+    # 探测没有得出结论就释放时，下一个请求继续探测
+    lease = asyncio.run(pool.acquire())
+    assert lease.probe
+    lease.release()
+    assert shared_state.in_flight_counts() == {}
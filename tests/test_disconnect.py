@@ -0,0 +1,112 @@
+"""
+客户端中途断开：代理应当取消上游请求、只关闭一次上游响应并释放 Cookie 租约，
+非流式请求返回 499，并且在关闭服务时补记的 cancelled 调用日志不会丢失。
+"""
+
+import asyncio
+import time
+
+import httpx
+
+from app.core.config import settings
+from app.db import models
+from app.db.database import SessionLocal
+from app.services.cookie_pool import cookie_pool
+from app.services.metrics import requests_total
+from app.services.shared_state import shared_state
+from benchmarks.mock_upstream import config as mock_config, stats as mock_stats
+from main import provider
+
+MODEL = "claude-haiku-4.5"
+
+
+async def _wait_for(condition, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "等待超时"
+        await asyncio.sleep(0.01)
+
+
+async def _disconnect(client: httpx.AsyncClient, stream: bool) -> None:
+    body = {"model": MODEL, "stream": stream, "messages": [{"role": "user", "content": f"disconnect {stream}"}]}
+    headers = {"Authorization": f"Bearer {settings.API_MASTER_KEY}"}
+    if stream:
+        # 读到第一个分块后关闭响应；响应体没有读完，httpx 随即关闭连接
+        async with client.stream("POST", "/v1/chat/completions", json=body, headers=headers) as response:
+            assert response.status_code == 200
+            async for _ in response.aiter_bytes():
+                break
+    else:
+        try:
+            await asyncio.wait_for(client.post("/v1/chat/completions", json=body, headers=headers), 0.5)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("非流式请求应当在上游输出完之前被断开")
+
+
+def _cancelled_logs() -> int:
+    db = SessionLocal()
+    try:
+        return db.query(models.APICallLog).filter(models.APICallLog.status == "cancelled").count()
+    finally:
+        db.close()
+
+
+def _scenario(monkeypatch, seed_cookies, serve_app, stream: bool) -> None:
+    mock_config.ttfb_ms = 50
+    mock_config.tokens = 200
+    mock_config.token_interval_ms = 20
+
+    closes = []
+    releases = []
+    original_aclose = httpx.Response.aclose
+    original_release = cookie_pool._release
+    original_usage = provider._usage
+
+    async def counting_aclose(response):
+        if response.request.method == "POST" and str(response.request.url) == settings.CHAT_API_URL:
+            closes.append(response)
+        await original_aclose(response)
+
+    def counting_release(key, probe=False):
+        releases.append(key)
+        original_release(key, probe)
+
+    async def slow_usage(*args):
+        # 补记日志的任务在服务开始关闭之后才提交日志
+        await asyncio.sleep(0.3)
+        return await original_usage(*args)
+
+    monkeypatch.setattr(httpx.Response, "aclose", counting_aclose)
+    monkeypatch.setattr(cookie_pool, "_release", counting_release)
+    monkeypatch.setattr(provider, "_usage", slow_usage)
+
+    async def scenario(client: httpx.AsyncClient) -> None:
+        await _disconnect(client, stream)
+        # 上游在断开后立即被取消，Cookie 租约归还
+        await _wait_for(lambda: mock_stats["cancelled"] == 1 and mock_stats["active"] == 0)
+        await _wait_for(lambda: len(releases) == 1)
+        # 不等待调用日志写入就关闭服务：补记的 cancelled 日志必须在关闭过程中写入
+
+    seed_cookies(1)
+    logged = _cancelled_logs()
+    serve_app(scenario)
+
+    assert mock_stats["requests"] == 1
+    assert mock_stats["completed"] == 0
+    assert len(releases) == 1
+    assert shared_state.in_flight_counts() == {}
+    # close_upstream 只执行一次（流式响应的生成器和后台任务都会调用它）
+    assert len(closes) == 1
+    assert _cancelled_logs() == logged + 1
+
+
+def test_stream_disconnect_cancels_upstream(monkeypatch, seed_cookies, upstream, serve_app):
+    _scenario(monkeypatch, seed_cookies, serve_app, stream=True)
+
+
+def test_non_stream_disconnect_returns_499(monkeypatch, seed_cookies, upstream, serve_app):
+    before = requests_total._values.get((MODEL, "499"), 0)
+    _scenario(monkeypatch, seed_cookies, serve_app, stream=False)
+    assert requests_total._values.get((MODEL, "499"), 0) == before + 1
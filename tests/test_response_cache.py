@@ -0,0 +1,105 @@
+"""
+响应缓存的淘汰：条目过期后不再命中，内存层按条目数和字节数从最久未使用的一端淘汰，
+磁盘层按最近访问时间淘汰，内存未命中时从磁盘层回填。
+"""
+
+import asyncio
+import types
+
+import pytest
+
+from app.core.config import settings
+from app.services import response_cache as response_cache_module
+from app.services.response_cache import ENTRY_OVERHEAD, ResponseCache
+
+USAGE = {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """可以手动推进的时钟，替换缓存模块使用的 time.time"""
+    now = [1_000_000.0]
+    monkeypatch.setattr(response_cache_module, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+@pytest.fixture
+def cache(monkeypatch, clock):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_MODE", "deterministic")
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_DISK_PATH", None)
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_TTL", 60)
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_MAX_ENTRIES", 1000)
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_MAX_BYTES", 1024 * 1024)
+    return ResponseCache()
+
+
+def _put(cache: ResponseCache, key: str, content: str = "cached") -> None:
+    asyncio.run(cache.put(key, content, "stop", USAGE))
+
+
+def _get(cache: ResponseCache, key: str):
+    return asyncio.run(cache.get(key))
+
+
+def test_entry_expires_after_ttl(cache, clock):
+    _put(cache, "a")
+    clock[0] += 59
+    assert _get(cache, "a").content == "cached"
+    clock[0] += 1
+    assert _get(cache, "a") is None
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["hits"], stats["misses"]) == (0, 0, 1, 1)
+
+
+def test_expired_entries_are_evicted_on_store(cache, clock):
+    _put(cache, "old")
+    clock[0] += 60
+    _put(cache, "new")
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch, cache):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_MAX_ENTRIES", 2)
+    _put(cache, "a")
+    _put(cache, "b")
+    # 读取 a 之后 b 成为最久未使用的条目
+    assert _get(cache, "a") is not None
+    _put(cache, "c")
+    assert _get(cache, "b") is None
+    assert _get(cache, "a") is not None and _get(cache, "c") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_byte_budget_evicts_oldest_and_skips_oversized(monkeypatch, cache):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_MAX_BYTES", 2 * (ENTRY_OVERHEAD + 100))
+    for key in ("a", "b", "c"):
+        _put(cache, key, "x" * 100)
+    assert _get(cache, "a") is None
+    assert cache.stats()["bytes"] == 2 * (ENTRY_OVERHEAD + 100)
+    # 单个结果超过预算时不缓存，也不挤掉已有条目
+    _put(cache, "huge", "x" * 1000)
+    assert _get(cache, "huge") is None
+    assert _get(cache, "b") is not None and _get(cache, "c") is not None
+
+
+def test_disk_tier_backfills_memory_and_evicts_by_access_time(monkeypatch, tmp_path, cache, clock):
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_DISK_PATH", str(tmp_path / "responses.db"))
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_DISK_MAX_BYTES", 2 * (ENTRY_OVERHEAD + 100))
+    writer = ResponseCache()
+    for key in ("a", "b"):
+        _put(writer, key, "x" * 100)
+        clock[0] += 1
+    # 另一个 worker 的内存层为空，从磁盘层回填；读取 a 刷新了它的访问时间
+    reader = ResponseCache()
+    assert _get(reader, "a").content == "x" * 100
+    assert reader.stats()["disk_hits"] == 1
+    assert _get(reader, "a") is not None and reader.stats()["hits"] == 1
+    clock[0] += 1
+    _put(writer, "c", "x" * 100)
+    assert writer._disk.stats()["entries"] == 2
+    assert _get(ResponseCache(), "b") is None
+
+    # 磁盘层的条目同样按 TTL 过期
+    clock[0] += 60
+    assert _get(ResponseCache(), "c") is None
@@ -0,0 +1,170 @@
+"""
+单飞合并：相同的请求只打开一个上游流，跟随者各自记录一条 coalesced 调用日志，
+不计入 Cookie 的使用次数；跟随者中途断开时记录 cancelled。
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from app.core.config import settings
+from app.db import crud, models
+from app.db.database import SessionLocal
+from app.services.single_flight import SubscriberTooSlow, single_flight
+from benchmarks.mock_upstream import config as mock_config, stats as mock_stats
+
+MODEL = "claude-haiku-4.5"
+
+
+@pytest.fixture(autouse=True)
+def _setup(monkeypatch, upstream):
+    mock_config.ttfb_ms = 200
+    mock_config.tokens = 20
+    mock_config.token_interval_ms = 10
+    monkeypatch.setattr(settings, "SINGLE_FLIGHT_MODE", "deterministic")
+
+
+def _body(content: str, stream: bool) -> dict:
+    return {"model": MODEL, "stream": stream, "temperature": 0, "messages": [{"role": "user", "content": content}]}
+
+
+def _headers(key: str = None) -> dict:
+    return {"Authorization": f"Bearer {key or settings.API_MASTER_KEY}"}
+
+
+def _logs(after_id: int):
+    db = SessionLocal()
+    try:
+        return db.query(models.APICallLog).filter(models.APICallLog.id > after_id).order_by(models.APICallLog.id).all()
+    finally:
+        db.close()
+
+
+def _last_log_id() -> int:
+    db = SessionLocal()
+    try:
+        last = db.query(models.APICallLog).order_by(models.APICallLog.id.desc()).first()
+        return last.id if last else 0
+    finally:
+        db.close()
+
+
+def _usage_count(cookie_id: int) -> int:
+    db = SessionLocal()
+    try:
+        return db.get(models.SmitheryCookie, cookie_id).usage_count
+    finally:
+        db.close()
+
+
+def test_followers_are_logged_as_coalesced(seed_cookies, serve_app):
+    cookie_id, = seed_cookies(1)
+    last_id = _last_log_id()
+    usage_before = _usage_count(cookie_id)
+
+    async def scenario(client: httpx.AsyncClient) -> None:
+        leader = asyncio.create_task(client.post("/v1/chat/completions", json=_body("flight", False), headers=_headers()))
+        await asyncio.sleep(0.05)
+        followers = [
+            client.post("/v1/chat/completions", json=_body("flight", stream), headers=_headers())
+            for stream in (False, True)
+        ]
+        responses = await asyncio.gather(leader, *followers)
+        assert [response.status_code for response in responses] == [200, 200, 200]
+        assert [response.headers["X-Single-Flight"] for response in responses] == ["leader", "follower", "follower"]
+
+    serve_app(scenario)
+
+    assert mock_stats["requests"] == 1
+    logs = _logs(last_id)
+    assert [(log.status, bool(log.coalesced)) for log in logs] == [
+        ("success", False), ("success", True), ("success", True)
+    ]
+    assert all(log.cookie_id == cookie_id for log in logs)
+    assert len({(log.prompt_tokens, log.completion_tokens) for log in logs}) == 1
+    # 只有领导者请求了上游
+    assert _usage_count(cookie_id) == usage_before + 1
+
+
+def test_follower_usage_is_charged_to_its_own_api_key(seed_cookies, serve_app):
+    seed_cookies(1)
+    db = SessionLocal()
+    try:
+        (key_a, secret_a), (key_b, secret_b) = (crud.create_api_key(db, name) for name in ("flight-a", "flight-b"))
+        key_ids = (key_a.id, key_b.id)
+    finally:
+        db.close()
+
+    async def scenario(client: httpx.AsyncClient) -> None:
+        leader = asyncio.create_task(
+            client.post("/v1/chat/completions", json=_body("tenants", False), headers=_headers(secret_a))
+        )
+        await asyncio.sleep(0.05)
+        follower = await client.post("/v1/chat/completions", json=_body("tenants", False), headers=_headers(secret_b))
+        assert follower.headers["X-Single-Flight"] == "follower"
+        assert (await leader).status_code == 200
+
+    serve_app(scenario)
+
+    db = SessionLocal()
+    try:
+        usage = crud.get_api_key_usage(db)
+    finally:
+        db.close()
+    a, b = (usage[key_id] for key_id in key_ids)
+    assert a["calls"] == b["calls"] == 1
+    assert a["completion_tokens"] == b["completion_tokens"] > 0
+
+
+def test_follower_disconnect_is_logged_as_cancelled(seed_cookies, serve_app):
+    seed_cookies(1)
+    last_id = _last_log_id()
+
+    async def scenario(client: httpx.AsyncClient) -> None:
+        leader = asyncio.create_task(client.post("/v1/chat/completions", json=_body("leave", False), headers=_headers()))
+        await asyncio.sleep(0.05)
+        async with client.stream("POST", "/v1/chat/completions", json=_body("leave", True), headers=_headers()) as response:
+            assert response.headers["X-Single-Flight"] == "follower"
+            async for _ in response.aiter_bytes():
+                break
+        assert (await leader).status_code == 200
+
+    serve_app(scenario)
+
+    logs = _logs(last_id)
+    assert sorted((log.status, bool(log.coalesced)) for log in logs) == [("cancelled", True), ("success", False)]
+
+
+def test_slow_subscriber_is_detached(monkeypatch):
+    monkeypatch.setattr(settings, "SINGLE_FLIGHT_MAX_LAG_CHARS", 10)
+
+    async def run():
+        flight = single_flight.lead("slow-subscriber-test")
+        fast, slow = flight.subscribe(), flight.subscribe()
+        produced = asyncio.Event()
+
+        async def producer():
+            for _ in range(5):
+                flight.append("abcd")
+                await asyncio.sleep(0)
+            flight.finish("stop", {})
+            produced.set()
+            await asyncio.Event().wait()
+
+        flight.start(producer(), None, 0)
+        slow_deltas = slow.__aiter__()
+        assert await slow_deltas.__anext__() == "abcd"
+        # 慢订阅者不再读取，快订阅者读完全部输出
+        received = "".join([delta async for delta in fast])
+        await produced.wait()
+        with pytest.raises(SubscriberTooSlow):
+            await slow_deltas.__anext__()
+        assert received == "abcd" * 5
+        assert flight.subscribers == 1
+        await fast.aclose()
+        flight._producer.cancel()
+        single_flight.forget(flight)
+        return single_flight.stats()["detached"]
+
+    assert asyncio.run(run()) >= 1
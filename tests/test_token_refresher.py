@@ -0,0 +1,113 @@
+"""
+会话续期：即将过期的数据库 Cookie 用 refresh_token 向令牌端点换取新会话，
+写回数据库并替换池中的条目；续期失败时保留原会话，在重试间隔内不再请求令牌端点。
+"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from app.core.config import decode_session, settings
+from app.db import crud
+from app.db.database import SessionLocal, init_db
+from app.services.cookie_pool import cookie_pool
+from app.services.token_refresher import TokenRefresher
+from benchmarks.mock_upstream import config as mock_config, stats as mock_stats
+from tests.conftest import fake_cookie
+
+
+@pytest.fixture
+def cookies(monkeypatch, upstream):
+    """建好一个即将过期和一个远未过期的 Cookie 并放入池中，结束后从池和数据库中删除"""
+    monkeypatch.setattr(settings, "TOKEN_REFRESH_URL", upstream.token_url)
+    init_db()
+    now = int(time.time())
+    sessions = {
+        "refresh-due": fake_cookie(101, expires_at=now + 60, refresh_token="due-refresh"),
+        "refresh-fresh": fake_cookie(102, expires_at=now + 3600, refresh_token="fresh-refresh"),
+    }
+    db = SessionLocal()
+    try:
+        ids = []
+        for name, cookie_data in sessions.items():
+            db_cookie = crud.create_cookie(db, name, cookie_data)
+            cookie_pool.sync(db_cookie)
+            ids.append(db_cookie.id)
+    finally:
+        db.close()
+    yield ids
+
+    db = SessionLocal()
+    try:
+        for cookie_id in ids:
+            cookie_pool.remove(cookie_id)
+            crud.delete_cookie(db, cookie_id)
+    finally:
+        db.close()
+
+
+def _session(cookie_id: int) -> dict:
+    db = SessionLocal()
+    try:
+        return decode_session(crud.get_cookie_by_id(db, cookie_id).cookie_data)
+    finally:
+        db.close()
+
+
+def _refresh_due(refresher: TokenRefresher) -> int:
+    async def run() -> int:
+        async with httpx.AsyncClient() as client:
+            refresher._client = client
+            return await refresher.refresh_due()
+
+    return asyncio.run(run())
+
+
+def test_expiring_session_is_refreshed_and_resynced(cookies):
+    due_id, fresh_id = cookies
+    fresh_session = _session(fresh_id)
+    refresher = TokenRefresher()
+
+    assert _refresh_due(refresher) == 1
+    assert mock_stats["token_refreshes"] == 1
+    assert refresher.refreshed == 1
+
+    # 新令牌写回数据库，原会话中的其他字段保留
+    session = _session(due_id)
+    assert session["access_token"] == "mock-access-1"
+    assert session["refresh_token"] == "mock-refresh-1"
+    assert session["expires_at"] > time.time() + settings.TOKEN_REFRESH_MARGIN
+    assert session["user"]["id"].endswith("000000000101")
+    # 池中的条目同步替换为新会话，远未过期的 Cookie 不受影响
+    pooled = cookie_pool.get(due_id)
+    assert pooled.refresh_token == "mock-refresh-1"
+    assert pooled.expires_at == session["expires_at"]
+    assert _session(fresh_id) == fresh_session
+
+    # 续期后不再到期
+    assert _refresh_due(refresher) == 0
+    assert mock_stats["token_refreshes"] == 1
+
+
+def test_failed_refresh_keeps_session_and_waits_before_retrying(cookies):
+    due_id, _ = cookies
+    mock_config.token_refresh_status = 400
+    before = _session(due_id)
+    refresher = TokenRefresher()
+
+    assert _refresh_due(refresher) == 0
+    assert refresher.failed == 1
+    assert _session(due_id) == before
+    assert cookie_pool.get(due_id).refresh_token == "due-refresh"
+
+    # 重试间隔内不再请求令牌端点
+    assert _refresh_due(refresher) == 0
+    assert refresher.failed == 1
+
+    # 间隔过后重试成功
+    mock_config.token_refresh_status = 200
+    refresher._retry_after.clear()
+    assert _refresh_due(refresher) == 1
+    assert _session(due_id)["refresh_token"] == "mock-refresh-1"
@@ -0,0 +1,79 @@
+"""
+上游故障的归因：5xx 和网络错误计入所有 Cookie 共用的上游退避，不隔离任何 Cookie，
+上游恢复后退避结束即可继续服务；401/403/429 仍只隔离出问题的 Cookie。
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from app.core.config import settings
+from app.services.cookie_health import UpstreamBackoff
+from app.services.cookie_pool import cookie_pool
+from benchmarks.mock_upstream import config as mock_config, stats as mock_stats
+
+MODEL = "claude-haiku-4.5"
+
+
+async def _chat(client: httpx.AsyncClient, content: str) -> httpx.Response:
+    return await client.post(
+        "/v1/chat/completions",
+        json={"model": MODEL, "stream": False, "messages": [{"role": "user", "content": content}]},
+        headers={"Authorization": f"Bearer {settings.API_MASTER_KEY}"}
+    )
+
+
+@pytest.fixture(autouse=True)
+def _setup(monkeypatch, seed_cookies, upstream):
+    mock_config.ttfb_ms = 0
+    mock_config.tokens = 5
+    mock_config.token_interval_ms = 0
+    mock_config.error_statuses = [503]
+    mock_config.fail_users = {}
+    monkeypatch.setattr(settings, "UPSTREAM_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(settings, "UPSTREAM_BACKOFF_THRESHOLD", 3)
+    monkeypatch.setattr(settings, "UPSTREAM_BACKOFF_BASE", 0.5)
+    monkeypatch.setattr(cookie_pool, "_health", {})
+    monkeypatch.setattr(cookie_pool, "_upstream", UpstreamBackoff())
+    seed_cookies(3)
+
+
+def test_upstream_outage_does_not_quarantine_cookies(serve_app):
+    async def scenario(client: httpx.AsyncClient) -> None:
+        mock_config.error_rate = 1.0
+        # 每个 Cookie 各失败一次，达到阈值后开始退避
+        response = await _chat(client, "outage 1")
+        assert response.status_code == 503
+        assert mock_stats["requests"] == 3
+        assert all(cookie_pool.health(cookie)["state"] == "closed" for cookie in cookie_pool.all())
+        assert cookie_pool.upstream_health()["backing_off"]
+
+        # 退避期间不再访问上游
+        response = await _chat(client, "outage 2")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        assert mock_stats["requests"] == 3
+
+        # 上游恢复，退避结束后立即可以服务，不需要等待任何 Cookie 的熔断退避
+        mock_config.error_rate = 0.0
+        await asyncio.sleep(0.6)
+        response = await _chat(client, "recovered")
+        assert response.status_code == 200
+        assert cookie_pool.upstream_health()["consecutive_failures"] == 0
+
+    serve_app(scenario)
+
+
+def test_auth_failure_quarantines_only_that_cookie(serve_app):
+    async def scenario(client: httpx.AsyncClient) -> None:
+        broken = cookie_pool.all()[0]
+        mock_config.fail_users = {broken.user_id: 401}
+        for n in range(3):
+            response = await _chat(client, f"auth {n}")
+            assert response.status_code == 200
+        assert cookie_pool.health(broken)["state"] == "open"
+        assert all(cookie_pool.health(cookie)["state"] == "closed" for cookie in cookie_pool.all()[1:])
+        assert not cookie_pool.upstream_health()["backing_off"]
+
+    serve_app(scenario)